@@ -17,35 +17,81 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import sys
+import time
 import logging
 from passkeeper.tools import *
 from passkeeper.git import Git
-from passkeeper.crypt import encrypt, decrypt
-try:
-    import ConfigParser
-except ImportError:
-    import configparser as ConfigParser
+from passkeeper.crypt import GnupgBackend, Result, DecryptionError
+from passkeeper.openpgp import is_armored
+from passkeeper.manifest import Manifest
+from passkeeper.index import SearchIndex
+from passkeeper.bundle import Bundle, LAYOUTS
+from passkeeper.chunks import ChunkStore, dump_list, load_list, MAGIC
+from passkeeper.search import SearchEngine, search_files, get_files
+from passkeeper.shred import Shredder, ShredError
+from passkeeper.scanner import VaultScanner, write_selection
+from passkeeper.stats import STATS
+from passkeeper.verify import FileCheck, VerifyReport
 from os.path import dirname
-from os.path import relpath as relative_path
 from os.path import join as os_join
+try:
+    raw_input
+except NameError:
+    raw_input = input
 
 LOG = logging.getLogger(__name__)
 
 
+class EncryptPlan(object):
+    "Files to encrypt and state of one encryption, see Passkeeper.encrypt"
+
+    def __init__(self):
+        self.scanner = None
+        # (name, source, output, armor) tuples and their git files
+        self.tasks = []
+        self.git_files = []
+        # (name, path) of all ini files
+        self.ini_files = []
+        self.ini_names = set()
+        self.ini_changed = True
+        self.bundle = False
+        self.manifest = None
+        # New manifest entries
+        self.entries = {}
+        self.store = None
+        self.chunked = set()
+
+    def store_for(self, task):
+        "Return the ChunkStore of a task, None if not chunked"
+        return self.store if task[0] in self.chunked else None
+
+
 class Passkeeper(object):
 
-    def __init__(self, directory):
+    def __init__(self, directory, backend=None, shredder=None):
         self.directory = directory
         self.git = Git(self.directory)
+        # Crypto backend (see passkeeper.crypt)
+        self.crypt = backend if backend is not None else GnupgBackend()
+        self.shredder = shredder if shredder is not None else Shredder()
         self.encrypted_dir = 'encrypted'
+        self.manifest_file = 'manifest.passkeeper'
+        self.index_file = 'index.passkeeper'
+        self.bundle_file = 'bundle.passkeeper'
+        self.chunks_dir = 'chunks'
+        # Files decrypted by selective decryptions (see decrypt)
+        self.selection_file = '.decrypted'
+        self.search_engine = SearchEngine()
 
 
+    @STATS.timed('init_dir')
     def init_dir(self, passphrase):
         LOG.info('Init directory %s' % self.directory)
         create_dir(self.directory)
 
         self.git.init()
-        self.git.add_gitignore(['*.ini', '/*.raw'])
+        self.git.add_gitignore(['*.ini', '/*.raw', '/%s' % self.selection_file])
 
         # Write default template file
         sample_file = ("""[foo]
@@ -70,152 +116,689 @@ MIIEpAIBAAKCA
         with open(os_join(self.directory, 'default.raw', 'ssh_id.rsa'), 'w') as f:
             f.write(sample_raw)
 
-        self.encrypt(passphrase=passphrase)
+        scanner = self.scan()
+        self.encrypt(passphrase=passphrase, scanner=scanner)
         # Remove old passkeeper files
-        self.remove_old_encrypted_files(force_remove=True)
-        self.cleanup()
+        self.remove_old_encrypted_files(force_remove=True, scanner=scanner,
+                                        passphrase=passphrase)
+        self.cleanup(scanner=scanner)
+
+
+    def scan(self, raw=True):
+        """
+        Return the inventory of the directory, to share between operations
+        of one command
+
+        :param raw: Scan raw directories and encrypted raw files too
+        :type raw: bool
+        :return: VaultScanner
+        """
+        return VaultScanner(self.directory, self.encrypted_dir,
+                            self.selection_file).scan(raw=raw)
+
+
+    def bundled(self):
+        "Return True if ini files are encrypted in one bundle (see Bundle)"
+        return os.path.isfile(os_join(self.directory, self.bundle_file))
+
+
+    def _scanner(self, scanner=None, raw=True):
+        "Return scanner, or a new inventory of the directory if None"
+        if scanner is None:
+            scanner = self.scan(raw=raw)
+        return scanner
+
+
+    def _encrypt_file(self, task, passphrase, store=None):
+        """
+        Encrypt one file. Task is a (name, source, output, armor) tuple
+
+        With a ChunkStore, the file is stored in chunks and the output only
+        contains the encrypted list of its chunks.
+        """
+        name, source, output, armor = task
+        LOG.info('Encrypt file %s' % name)
+        if store is not None:
+            return self._encrypt_chunks(task, passphrase, store)
+        encrypted = self.crypt.encrypt(source=source,
+                                       output=output,
+                                       passphrase=passphrase,
+                                       armor=armor)
+        if not encrypted.ok:
+            LOG.error("Encrypt file %s - %s" % (name, encrypted.stderr))
+        return encrypted
+
+
+    def _chunk_store(self, key):
+        "Return the ChunkStore of the chunks directory"
+        return ChunkStore(os_join(self.directory, self.chunks_dir),
+                          self.crypt, key=key)
+
+
+    def _encrypt_chunks(self, task, passphrase, store):
+        "Encrypt one file in chunks, see _encrypt_file"
+        name, source, output, armor = task
+        stored = store.store(source, passphrase=passphrase)
+        if stored is None:
+            return Result(ok=False, status='encryption failed',
+                          stderr='Unable to encrypt chunks')
+        names, new_names = stored
+        encrypted = self.crypt.encrypt_data(dump_list(names,
+                                                      os.path.getsize(source)),
+                                            passphrase, armor=armor)
+        if not encrypted.ok:
+            LOG.error("Encrypt file %s - %s" % (name, encrypted.stderr))
+            return encrypted
+        with open(output, 'wb') as f:
+            f.write(encrypted.data)
+        encrypted.chunks = names
+        encrypted.new_chunks = new_names
+        return encrypted
 
 
-    def encrypt(self, passphrase, commit_message='Update encrypted files'):
+    @STATS.timed('encrypt')
+    def encrypt(self, passphrase, commit_message='Update encrypted files',
+                jobs=1, incremental=True, binary_raw=False, index=False,
+                chunk_threshold=None, scanner=None):
+        """
+        Encrypt all ini files and files in raw directories
+
+        Files are encrypted by a pool of jobs workers. All encrypted files
+        are then added in git and committed at once.
+
+        In incremental mode, only files changed since the last encryption
+        are encrypted. Changes are detected with the encrypted manifest
+        (see Manifest). If the manifest can't be decrypted with the
+        passphrase, all files are encrypted. The manifest is written by
+        all encryptions, so a full encryption refreshes it.
+
+        Files in raw directories can be stored binary (not ASCII armored)
+        to save space on big files. Both are decrypted.
+
+        With index, the encrypted search index of ini files is written
+        (see SearchIndex). Once created, the index is updated by each
+        encryption.
+
+        If the directory uses the bundle layout (see migrate), ini files
+        are encrypted together in the bundle when one of them changed.
+
+        Files of raw directories bigger than chunk_threshold are split in
+        content-defined chunks encrypted once in the chunks directory (see
+        ChunkStore). Only new chunks are written, and chunks no longer used
+        by a file are removed. Chunk names are keyed with the manifest key.
+
+        :param passphrase: Passphrase used to encrypt files
+        :type passphrase: str
+        :param commit_message: Git commit message
+        :type commit_message: str
+        :param jobs: Number of gpg processes launched concurrently
+        :type jobs: int
+        :param incremental: Encrypt only changed files
+        :type incremental: bool
+        :param binary_raw: Don't ASCII armor files of raw directories
+        :type binary_raw: bool
+        :param index: Write the search index
+        :type index: bool
+        :param chunk_threshold: Size in bytes from which raw files are
+                                chunked, None to never chunk
+        :type chunk_threshold: int
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: False if at least one file has not been encrypted
+        """
+        plan = self._plan_encrypt(passphrase, jobs=jobs,
+                                  incremental=incremental,
+                                  binary_raw=binary_raw,
+                                  chunk_threshold=chunk_threshold,
+                                  scanner=scanner)
+        results = run_pool(lambda task: self._encrypt_file(
+                               task, passphrase, store=plan.store_for(task)),
+                           plan.tasks, jobs=jobs)
+        return self._finish_encrypt(plan, results, passphrase,
+                                    commit_message=commit_message,
+                                    index=index)
+
+
+    def _plan_encrypt(self, passphrase, jobs=1, incremental=True,
+                      binary_raw=False, chunk_threshold=None, scanner=None):
+        """
+        List files to encrypt, see encrypt for parameters
+
+        :return: EncryptPlan, tasks are encrypted by _encrypt_file then
+                 results are given to _finish_encrypt
+        """
         LOG.info('Encryption')
         create_dir(os_join(self.directory, self.encrypted_dir))
 
         LOG.info('Encrypt files :')
-        # Encrypt files
-        for fname in os.listdir(self.directory):
-            file_path = os_join(self.directory, fname)
-            # Handle ini file
-            if (fname.endswith('.ini')
-            and os.path.isfile(file_path)):
-                LOG.info('Encrypt file %s' % fname)
-                git_relative_encrypted_file_path = os_join(self.encrypted_dir,
-                                                       '%s.passkeeper' % fname)
-                encrypted_file_path = os_join(self.directory,
-                                              git_relative_encrypted_file_path)
-                encrypted = encrypt(source=file_path,
-                                    output=encrypted_file_path,
-                                    passphrase=passphrase)
-                if not encrypted.ok:
-                    LOG.error("Encrypt file %s - %s" % (fname, encrypted.stderr))
-                self.git.add([git_relative_encrypted_file_path])
-            # Handle .raw directory
-            if (fname.endswith('.raw')
-            and os.path.isdir(file_path)):
-                for root, dirs, files in os.walk(file_path, topdown=False):
-                    for name in files:
-                        # /git/foo.raw/file
-                        root_raw_file_path = os.path.join(root, name)
-                        # foo.raw/file
-                        git_relative_file_path = relative_path(root_raw_file_path, self.directory).lstrip('/')
-                        LOG.info('Encrypt file %s' % git_relative_file_path)
-
-                        # encrypt/foo.raw/file.passkeeper
-                        git_encrypted_relative_file_path = os_join(self.encrypted_dir,
-                                                         '%s.passkeeper' % git_relative_file_path)
-                        # /git/encrypt/foo.raw/file.passkeeper
-                        root_encrypted_file_path = os_join(self.directory,
-                                                      git_encrypted_relative_file_path)
-
-                        # /git/encrypt/foo.raw
-                        root_encrypted_dirname_path = dirname(root_encrypted_file_path)
-
-                        create_dir(root_encrypted_dirname_path)
-                        encrypted = encrypt(source=root_raw_file_path,
-                                            output=root_encrypted_file_path,
-                                            passphrase=passphrase)
-                        if not encrypted.ok:
-                            LOG.error("Encrypt file %s - %s" % (fname, encrypted.stderr))
-                        self.git.add([git_encrypted_relative_file_path])
+        plan = EncryptPlan()
+        scanner = plan.scanner = self._scanner(scanner)
+        # List files to encrypt, a task is (name, source, output, armor)
+        tasks = []
+        git_files = []
+        ini_files = plan.ini_files
+        for fname, info in sorted(scanner.ini_files.items()):
+            tasks.append((fname, info.path, scanner.encrypted_path(fname), True))
+            ini_files.append((fname, info.path))
+            git_files.append(os_join(self.encrypted_dir, '%s.passkeeper' % fname))
+        encrypted_dirs = set()
+        for fname, info in sorted(scanner.raw_files.items()):
+            # /git/encrypt/foo.raw/file.passkeeper
+            encrypted_file_path = scanner.encrypted_path(fname)
+            encrypted_dirs.add(dirname(encrypted_file_path))
+            tasks.append((fname, info.path, encrypted_file_path, not binary_raw))
+            # encrypt/foo.raw/file.passkeeper
+            git_files.append(os_join(self.encrypted_dir, '%s.passkeeper' % fname))
+        # Create dirs before starting workers
+        for encrypted_dirname in sorted(encrypted_dirs):
+            create_dir(encrypted_dirname)
+        infos = scanner.plain_files()
+
+        bundle = plan.bundle = self.bundled()
+        # The manifest is rebuilt by all encryptions, incremental or not
+        manifest = plan.manifest = Manifest(
+            os_join(self.directory, self.manifest_file), self.crypt)
+        manifest.load(passphrase=passphrase)
+        previous_files = set(manifest.entries)
+        checks = run_pool(lambda task: manifest.check(task[0], task[1],
+                                                      infos[task[0]].stat),
+                          tasks, jobs=jobs)
+        # Keep only changed files or files without encrypted file
+        entries = plan.entries
+        changed_tasks = []
+        changed_git_files = []
+        for task, git_file, (changed, entry) in zip(tasks, git_files, checks):
+            previous = manifest.entries.get(task[0])
+            if not changed and previous and 'chunks' in previous:
+                entry = dict(entry, chunks=previous['chunks'])
+            entries[task[0]] = entry
+            encrypted = (task[0] in scanner.encrypted_files
+                         or bundle and task[0] in scanner.ini_files)
+            if changed or not encrypted or not incremental:
+                changed_tasks.append(task)
+                changed_git_files.append(git_file)
+            else:
+                LOG.debug('Unchanged file %s' % task[0])
+        LOG.info('%d/%d file(s) changed' % (len(changed_tasks), len(tasks)))
+        tasks, git_files = changed_tasks, changed_git_files
+
+        # Ini files changed or removed since the last encryption
+        ini_names = plan.ini_names = set(scanner.ini_files)
+        previous_ini_names = set(name for name in previous_files
+                                 if '/' not in name)
+        plan.ini_changed = (not incremental
+                            or ini_names & set(task[0] for task in tasks)
+                            or previous_ini_names - ini_names
+                            - set(scanner.not_decrypted(previous_ini_names)))
+        if bundle:
+            git_files = [git_file for task, git_file in zip(tasks, git_files)
+                         if task[0] not in ini_names]
+            tasks = [task for task in tasks if task[0] not in ini_names]
+
+        # Raw files stored in chunks
+        if chunk_threshold is not None:
+            plan.store = self._chunk_store(manifest.key)
+            plan.store.names()
+            plan.chunked = set(task[0] for task in tasks
+                               if task[0] in scanner.raw_files
+                               and infos[task[0]].stat.st_size >= chunk_threshold)
+        plan.tasks, plan.git_files = tasks, git_files
+        return plan
+
+
+    def _finish_encrypt(self, plan, results, passphrase,
+                        commit_message='Update encrypted files', index=False,
+                        staged=()):
+        """
+        Write the bundle, the manifest and the index, then stage and commit
+        encrypted files of an EncryptPlan
+
+        :param results: Result of each task of plan
+        :param staged: Files already staged
+        :return: False if at least one file has not been encrypted
+        """
+        tasks, git_files = plan.tasks, plan.git_files
+        scanner, manifest, entries = plan.scanner, plan.manifest, plan.entries
+        chunked = plan.chunked
+        ini_files, ini_names = plan.ini_files, plan.ini_names
+
+        # Stage all encrypted files and commit once
+        encrypted_files = [git_file for git_file, encrypted
+                           in zip(git_files, results) if encrypted.ok]
+        errors = [task[0] for task, encrypted
+                  in zip(tasks, results) if not encrypted.ok]
+        chunk_files = set()
+        for task, encrypted in zip(tasks, results):
+            if encrypted.ok:
+                if task[0] in chunked:
+                    entries[task[0]] = dict(entries[task[0]],
+                                            chunks=encrypted.chunks)
+                    chunk_files.update(encrypted.new_chunks)
+                elif 'chunks' in entries[task[0]]:
+                    entries[task[0]] = dict(
+                        (key, value) for key, value in entries[task[0]].items()
+                        if key != 'chunks')
+        encrypted_files.extend(os_join(self.chunks_dir, '%s.passkeeper' % name)
+                               for name in sorted(chunk_files))
+        if plan.bundle and plan.ini_changed:
+            if self._write_bundle(ini_files, passphrase):
+                encrypted_files.append(self.bundle_file)
+            else:
+                errors.extend(sorted(ini_names))
+        # Failed files will be encrypted again next time
+        for name in errors:
+            del entries[name]
+        # Chunks of encrypted files not removed yet are still used,
+        # files not decrypted are unchanged
+        not_decrypted = set(scanner.not_decrypted(manifest.entries))
+        for name, entry in manifest.entries.items():
+            if name not in entries and (
+                    name in not_decrypted
+                    or 'chunks' in entry
+                    and name in scanner.encrypted_files):
+                entries[name] = entry
+        manifest.entries = entries
+        if not errors:
+            self._remove_old_chunks(entries)
+        if manifest.modified() and manifest.save(passphrase=passphrase):
+            encrypted_files.append(self.manifest_file)
+
+        index_path = os_join(self.directory, self.index_file)
+        if index or os.path.isfile(index_path):
+            # Index is up to date if no ini file changed or was removed
+            if plan.ini_changed or not os.path.isfile(index_path):
+                if self._write_index(ini_files, passphrase, scanner):
+                    encrypted_files.append(self.index_file)
 
+        encrypted_files = [git_file for git_file in encrypted_files
+                           if git_file not in staged]
+        if encrypted_files:
+            self.git.add(encrypted_files)
         self.git.commit('%s' % commit_message)
+
+        if errors:
+            LOG.error('%d file(s) not encrypted : %s' % (len(errors),
+                                                         ', '.join(errors)))
+            return False
         return True
 
 
-    def decrypt(self, passphrase):
+    def _remove_old_chunks(self, entries):
+        "Remove chunks not used by manifest entries"
+        chunks_path = os_join(self.directory, self.chunks_dir)
+        if not os.path.isdir(chunks_path):
+            return []
+        used = set()
+        for entry in entries.values():
+            used.update(entry.get('chunks', []))
+        old_chunks = [os_join(self.chunks_dir, fname)
+                      for fname in sorted(os.listdir(chunks_path))
+                      if fname.endswith('.passkeeper')
+                      and fname[:-len('.passkeeper')] not in used]
+        if old_chunks:
+            LOG.info('Remove %d unused chunk(s)' % len(old_chunks))
+            self.git.force_remove(old_chunks)
+        return old_chunks
+
+
+    @STATS.timed('encrypt.index')
+    def _write_index(self, ini_files, passphrase, scanner=None):
+        """
+        Write the search index of ini files, list of (name, path). Indexed
+        ini files not decrypted (see VaultScanner.not_decrypted) are
+        decrypted in memory to stay in the index.
+        """
+        LOG.info('Write search index')
+        contents = []
+        for name, path in ini_files:
+            with open(path, 'rb') as f:
+                contents.append((name, f.read()))
+        search_index = SearchIndex(os_join(self.directory, self.index_file),
+                                   self.crypt)
+        if (scanner is not None and scanner.selection is not None
+        and search_index.load(passphrase=passphrase)):
+            names = scanner.not_decrypted(search_index.files)
+            if names:
+                kept = self._decrypt_ini_files(passphrase, names=names,
+                                               scanner=scanner)
+                if kept is None:
+                    return False
+                contents.extend(kept)
+        search_index.build(contents)
+        return search_index.save(passphrase=passphrase)
+
+
+    @STATS.timed('encrypt.bundle')
+    def _write_bundle(self, ini_files, passphrase):
+        """
+        Write the bundle of ini files, list of (name, path)
+
+        Ini files of the previous bundle not found in the directory are
+        kept, they are removed by remove_old_encrypted_files.
+        """
+        LOG.info('Encrypt %d ini file(s) in bundle' % len(ini_files))
+        bundle = Bundle(os_join(self.directory, self.bundle_file), self.crypt)
+        if os.path.isfile(bundle.path) and not bundle.load(passphrase):
+            return False
+        names = set(name for name, path in ini_files)
+        kept = [(name, content) for name, content in bundle.files
+                if name not in names]
+        bundle.files = []
+        for name, path in ini_files:
+            with open(path, 'rb') as f:
+                bundle.files.append((name, f.read()))
+        bundle.files.extend(kept)
+        return bundle.save(passphrase=passphrase)
+
+
+    def _decrypt_file(self, task, passphrase):
+        "Decrypt one file. Task is a (name, source, output) tuple"
+        name, source, output = task
+        LOG.info('Decrypt file %s' % name)
+        decrypted = self.crypt.decrypt(source=source,
+                                       output=output,
+                                       passphrase=passphrase)
+        # Only files of raw directories are chunked
+        if decrypted.ok and '/' in name:
+            decrypted = self._decrypt_chunks(name, output, passphrase,
+                                             decrypted)
+        LOG.info(decrypted.status)
+        if not decrypted.ok:
+            LOG.error("Decrypt file %s - %s" % (name, decrypted.stderr))
+        return decrypted
+
+
+    def _decrypt_chunks(self, name, output, passphrase, decrypted):
+        "Rebuild output from its chunks if it is a chunk list"
+        with open(output, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return decrypted
+            f.seek(0)
+            names = load_list(f.read())
+        LOG.debug('Decrypt %d chunk(s) of %s' % (len(names), name))
+        store = self._chunk_store(key=None)
+        restored = store.restore(names, output, passphrase=passphrase)
+        if not restored.ok:
+            os.remove(output)
+            return Result(ok=False, status='decryption failed',
+                          stderr=restored.stderr)
+        return restored
+
+
+    @STATS.timed('decrypt')
+    def decrypt(self, passphrase, jobs=1, patterns=None, matching=None,
+                scanner=None):
+        """
+        Decrypt all .passkeeper files, or only selected files
+
+        The passphrase is checked on one file first. Remaining files are
+        then decrypted by a pool of jobs workers, pending files are
+        cancelled at the first failed decryption. With the bundle layout,
+        ini files are decrypted from the bundle first.
+
+        Files can be selected with glob patterns on their path (a raw
+        directory selects all its files) and with matching, a search
+        pattern. Ini files are then decrypted in memory and only the
+        selected ones or the ones with a section matching are written.
+        Decrypted files are added to selection_file, so encrypt and
+        remove_old_encrypted_files keep files not decrypted. A full
+        decryption removes it.
+
+        :param passphrase: Passphrase used to decrypt files
+        :type passphrase: str
+        :param jobs: Number of gpg processes launched concurrently
+        :type jobs: int
+        :param patterns: Glob patterns of files to decrypt, like *.ini or
+                         default.raw
+        :type patterns: list
+        :param matching: Decrypt ini files where this pattern is found
+                         (see search)
+        :type matching: str
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: False if a file has not been decrypted
+        """
         LOG.info('Decrypt files :')
-        source_dir = os_join(self.directory, self.encrypted_dir)
-        status = True
-        for root, dirs, files in os.walk(source_dir, topdown=False):
-            for name in files:
-                file_path = os_join(root, name)
-                relative_file_path = relative_path(file_path, source_dir).lstrip('/')
-
-                if (name.endswith('.passkeeper')
-                and os.path.isfile(file_path)):
-                    LOG.info('Decrypt file %s' % relative_file_path)
-                    decrypted_file_path = os_join(self.directory,
-                                                  re.sub('.passkeeper$', '', relative_file_path))
-                    create_dir(path=dirname(decrypted_file_path))
-                    decrypted = decrypt(source=file_path,
-                            output=decrypted_file_path,
-                            passphrase=passphrase)
-                    if decrypted.status == "decryption failed":
-                        status = False
-                    LOG.info(decrypted.status)
-                    if not decrypted.ok:
-                        LOG.error("Decrypt file %s - %s" % (name, decrypted.stderr))
-        return status
-
-
-    def remove_old_encrypted_files(self, force_remove=False):
-        "remove old passkeeper files"
-        root_dir = os_join(self.directory, self.encrypted_dir)
-        for root, dirs, files in os.walk(root_dir, topdown=False):
-            for efname in files:
-                # /git/encrypt/foo/bar.passkeeper
-                root_file_path = os_join(root, efname)
-                # encrypt/foo/bar.passkeeper
-                git_relative_encrypted_file_path = relative_path(path=root_file_path, start=self.directory)
-                LOG.debug('Check %s.' % git_relative_encrypted_file_path)
-
-                # /git/foo/bar
-                orig_file_path = os_join(self.directory, re.sub('.passkeeper$', '',
-                                                                relative_path(path=root_file_path, start=root_dir)))
-                # Skip if file exist
-                if os.path.isfile(orig_file_path):
-                    continue
-
-                if not force_remove:
-                    # If not force, ask
-                    req = raw_input("File %s will be deleted because origin file hasn't been found, are you sure (y/n)\n" % git_relative_encrypted_file_path)
-                    if req != "y":
-                        LOG.info('File %s has been concerved.' % git_relative_encrypted_file_path)
-                        continue
-
-                # Remove the file
-                LOG.info('File %s will be deleted because origin file hasn t been found.' % git_relative_encrypted_file_path)
-                # shred file and then git remove because git remove automaticaly empty dirs
-                run_cmd('shred %s' % root_file_path)
-                self.git.force_remove([git_relative_encrypted_file_path])
-                self.git.commit('Remove file %s' % git_relative_encrypted_file_path)
-
-
-
-    def cleanup(self):
-        "Shred all ini and raw files"
+        scanner = self._scanner(scanner)
+        names = sorted(scanner.encrypted_files)
+        if patterns or matching is not None:
+            selected = self._select_files(passphrase, patterns or [], matching,
+                                          jobs=jobs, scanner=scanner)
+            if selected is None:
+                return False
+            names, ini_files = selected
+            # Files not selected must not look removed to encrypt
+            write_selection(os_join(self.directory, self.selection_file),
+                            (scanner.selection or set()) | set(names)
+                            | set(name for name, content in ini_files))
+            self._write_decrypted(ini_files)
+        else:
+            if os.path.isfile(os_join(self.directory, self.selection_file)):
+                os.remove(os_join(self.directory, self.selection_file))
+            if self.bundled() and not self._decrypt_bundle(passphrase):
+                return False
+        # List files to decrypt, a task is (name, source, output)
+        tasks = []
+        for name in names:
+            decrypted_file_path = os_join(self.directory, name)
+            tasks.append(('%s.passkeeper' % name,
+                          scanner.encrypted_files[name].path,
+                          decrypted_file_path))
+        for decrypted_dirname in sorted(set(dirname(task[2]) for task in tasks)):
+            create_dir(path=decrypted_dirname)
+        if not tasks:
+            return True
+
+        # Check the passphrase on an ini file (smaller than raw files)
+        tasks.sort(key=lambda task: not task[0].endswith('.ini.passkeeper'))
+        decrypted = self._decrypt_file(tasks[0], passphrase)
+        if decrypted.status == "decryption failed":
+            LOG.error('Unable to decrypt %s, stop decryption' % tasks[0][0])
+            return False
+
+        failed = lambda decrypted: decrypted.status == "decryption failed"
+        results = run_pool(lambda task: self._decrypt_file(task, passphrase),
+                           tasks[1:], jobs=jobs, stop=failed)
+        # Cancelled files have no result
+        return all(decrypted is not None and not failed(decrypted)
+                   for decrypted in [decrypted] + results)
+
 
+    def _decrypt_bundle(self, passphrase):
+        "Write ini files of the bundle in the directory"
+        bundle = Bundle(os_join(self.directory, self.bundle_file), self.crypt)
+        if not bundle.load(passphrase=passphrase):
+            LOG.error('Unable to decrypt %s, stop decryption' % self.bundle_file)
+            return False
+        self._write_decrypted(bundle.files)
+        return True
+
+
+    def _write_decrypted(self, files):
+        "Write files decrypted in memory, list of (name, content)"
+        create_dir(path=self.directory)
+        for name, content in files:
+            LOG.info('Write decrypted file %s' % name)
+            with open(os_join(self.directory, name), 'wb') as f:
+                f.write(content)
+
+
+    def _select_files(self, passphrase, patterns, matching=None, jobs=1,
+                      scanner=None):
+        """
+        Select files to decrypt with glob patterns and a search pattern
+        (see decrypt). Ini files are decrypted in memory, only those which
+        can match are decrypted if the search index exists.
+
+        :return: (names of other files to decrypt, list of selected ini
+                 files (name, content)), None if ini files can't be
+                 decrypted
+        """
+        bundle = self.bundled()
+        ini_names = scanner.encrypted_ini_files()
+        names = [name for name in sorted(scanner.encrypted_files)
+                 if name not in ini_names and match_paths(name, patterns)]
+        if bundle:
+            # One decryption for all ini files
+            to_decrypt = None
+        else:
+            selected = [name for name in ini_names
+                        if match_paths(name, patterns)]
+            candidates = []
+            if matching is not None:
+                candidates = None
+                if os.path.isfile(os_join(self.directory, self.index_file)):
+                    candidates = self._index_candidates(matching, passphrase,
+                                                        scanner)
+                if candidates is None:
+                    candidates = ini_names
+            to_decrypt = sorted(set(selected) | set(candidates))
+        if to_decrypt == []:
+            ini_files = []
+        else:
+            ini_files = self._decrypt_ini_files(passphrase, jobs=jobs,
+                                                names=to_decrypt,
+                                                scanner=scanner)
+            if ini_files is None:
+                LOG.error('Unable to decrypt ini files, stop decryption')
+                return None
+        matched = set()
+        if matching is not None:
+            engine = SearchEngine()
+            for name, content in ini_files:
+                engine.add_file(name, content)
+            matched = set(hit.file for hit in engine.search(matching))
+        ini_files = [(name, content) for name, content in ini_files
+                     if name in matched or match_paths(name, patterns)]
+        if not names and not ini_files:
+            LOG.warning('No encrypted file selected')
+        LOG.info('%d file(s) selected' % (len(names) + len(ini_files)))
+        return names, ini_files
+
+
+    @STATS.timed('remove_old')
+    def remove_old_encrypted_files(self, force_remove=False, scanner=None,
+                                   passphrase=None):
+        """
+        Remove encrypted files without original file
+
+        Files are asked for confirmation at once unless force_remove,
+        then shredded and removed from git in batches and committed once.
+        With the bundle layout, ini files of the bundle without original
+        file are removed from the bundle too, only if passphrase is given.
+
+        :param force_remove: Don't ask confirmation
+        :type force_remove: bool
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :param passphrase: Passphrase of the bundle
+        :type passphrase: str
+        :return: list of removed files, relative to the directory
+        """
+        scanner = self._scanner(scanner)
+        old_files = scanner.old_encrypted_files()
+        # encrypt/foo/bar.passkeeper
+        git_files = [os_join(self.encrypted_dir, '%s.passkeeper' % name)
+                     for name in old_files]
+        bundle = None
+        old_ini_files = []
+        if passphrase is not None and self.bundled():
+            bundle = Bundle(os_join(self.directory, self.bundle_file),
+                            self.crypt)
+            if bundle.load(passphrase=passphrase):
+                names = bundle.names()
+                old_ini_files = sorted(set(names) - set(scanner.ini_files)
+                                       - set(scanner.not_decrypted(names)))
+        # bundle.passkeeper:foo.ini
+        bundle_files = ['%s:%s' % (self.bundle_file, name)
+                        for name in old_ini_files]
+        if not git_files and not bundle_files:
+            return []
+
+        if not force_remove:
+            # If not force, ask once for all files
+            req = raw_input("%s\n%d file(s) will be deleted because origin files haven't been found, are you sure (y/n)\n"
+                            % ('\n'.join(git_files + bundle_files),
+                               len(git_files) + len(bundle_files)))
+            if req != "y":
+                LOG.info('%d file(s) have been concerved.' % (
+                         len(git_files) + len(bundle_files)))
+                return []
+
+        LOG.info('%d file(s) will be deleted because origin files haven t been found.' % (
+                 len(git_files) + len(bundle_files)))
+        if bundle_files:
+            bundle.files = [(name, content) for name, content in bundle.files
+                            if name not in old_ini_files]
+            if not bundle.save(passphrase=passphrase):
+                return []
+            self.git.add([self.bundle_file])
+        if git_files:
+            # shred files and then git remove because git remove automaticaly empty dirs
+            report = self.shredder.shred([scanner.encrypted_files[name].path
+                                          for name in old_files],
+                                         remove=False)
+            if report.errors:
+                raise ShredError('Unable to shred %d file(s)' % len(report.errors))
+            self.git.force_remove(git_files)
+        removed = git_files + bundle_files
+        if len(removed) == 1:
+            self.git.commit('Remove file %s' % removed[0])
+        else:
+            self.git.commit('Remove %d files' % len(removed))
+        return removed
+
+
+    @STATS.timed('cleanup')
+    def cleanup(self, scanner=None):
+        """
+        Shred all ini and raw files
+
+        All files are shredded in one run of the shredder (batches of
+        files run concurrently, see Shredder).
+
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: ShredReport, None if there is nothing to shred
+        """
+        scanner = self._scanner(scanner)
+        files = []
+        directories = []
         # Remove ini files
-        for fname in os.listdir(self.directory):
-            file_path = os_join(self.directory, fname)
-            if (fname.endswith('.ini')
-            and os.path.isfile(file_path)):
-                LOG.info('Clean file %s' % fname)
-                run_cmd('shred --remove %s' % file_path)
+        for fname, info in sorted(scanner.ini_files.items()):
+            LOG.info('Clean file %s' % fname)
+            files.append(info.path)
         # Remove raw files
-            elif (fname.endswith('.raw')
-            and os.path.isdir(file_path)):
-                LOG.info('Clean directory %s' % fname)
-                shred_dir(file_path)
+        for fname in scanner.raw_dirs:
+            LOG.info('Clean directory %s' % fname)
+            directories.append(os_join(self.directory, fname))
+        # Selection of the last decryptions
+        if (scanner.selection is not None
+        and os.path.isfile(scanner.selection_path)):
+            files.append(scanner.selection_path)
+        if not files and not directories:
+            return None
+        return self.shredder.shred_tree(directories, files)
 
 
 
-    def flush_history(self):
+    @STATS.timed('flush_history')
+    def flush_history(self, pack=False):
         """
         Flush the git history
 
         Destroy .git directory by shred all files and init git again.
         This allow to clear git history and to insure more security
 
+        Files are shredded in parallel batches (see Shredder). With pack,
+        git objects are first packed in a few files to shred much less
+        files. Loose objects are then removed by git without being
+        overwritten, they stay readable on the disk until reused.
+
+        :param pack: Pack git objects before shredding
+        :type pack: bool
+        :return: ShredReport of the .git directory
+
         :Example:
 
         >>> flush_history()
@@ -223,62 +806,579 @@ MIIEpAIBAAKCA
         Clean file HEAD
         Clean file exclude
         ...
+        Shred 3 file(s), 1132 bytes in 0.021s (shred)
         Dépôt Git vide initialisé dans /opt/mypasskeeper/.git/
         master (commit racine) 9e4a2a0] Clean git History
 
-        .. seealso:: shred_dir(), git.init(), git.add(), git.commit()
+        .. seealso:: shred_dir(), git.gc(), git.init(), git.add(), git.commit()
         """
-        shred_dir(os_join(self.directory, '.git'))
+        start = time.time()
+        if pack:
+            LOG.info('Pack git objects')
+            self.git.gc()
+        report = shred_dir(os_join(self.directory, '.git'),
+                           shredder=self.shredder)
+        LOG.info('Flush history : %d file(s), %d bytes destroyed in %.3fs'
+                 % (report.files, report.bytes, time.time() - start))
         self.git.init()
-        self.git.add([self.encrypted_dir, '.gitignore'])
+        files = [self.encrypted_dir, '.gitignore']
+        for fname in [self.manifest_file, self.index_file, self.bundle_file]:
+            if os.path.isfile(os_join(self.directory, fname)):
+                files.append(fname)
+        if os.path.isdir(os_join(self.directory, self.chunks_dir)):
+            files.append(self.chunks_dir)
+        self.git.add(files)
         self.git.commit('Clean git History')
+        return report
 
 
-    def search(self, pattern):
-        LOG.info('Search in files :')
-        pattern = pattern.lower()
-        config = ConfigParser.RawConfigParser()
-
-        # Load files
-        for fname in os.listdir(self.directory):
-            file_path = os_join(self.directory, fname)
-            if (fname.endswith('.ini')
-            and os.path.isfile(file_path)):
-                LOG.info('Loading file %s' % fname)
-                config.read(file_path)
-        # Search
-        re_prep = re.compile(pattern)
-        matching_sections = []
-        for section in config.sections():
-
-            # Section name match ?
-            match = re_prep.search(section.lower())
-            if match is not None:
-                matching_sections.append(section)
+    def _encrypted_git_files(self, scanner):
+        """
+        Return all encrypted files (files, chunks, manifest, index and
+        bundle) relative to the directory
+        """
+        git_files = [os_join(self.encrypted_dir, '%s.passkeeper' % name)
+                     for name in sorted(scanner.encrypted_files)]
+        chunks_path = os_join(self.directory, self.chunks_dir)
+        if os.path.isdir(chunks_path):
+            git_files.extend(os_join(self.chunks_dir, fname)
+                             for fname in sorted(os.listdir(chunks_path))
+                             if fname.endswith('.passkeeper'))
+        for fname in [self.manifest_file, self.index_file, self.bundle_file]:
+            if os.path.isfile(os_join(self.directory, fname)):
+                git_files.append(fname)
+        return git_files
+
+
+    def _rekey_file(self, path, passphrase, new_passphrase):
+        """
+        Encrypt the content of an encrypted file with new_passphrase in
+        path.rekey.tmp, keeping its armor. Return a Result
+        """
+        with open(path, 'rb') as f:
+            armor = is_armored(f.read(64))
+        output = '%s.rekey.tmp' % path
+        encrypted = self.crypt.reencrypt(path, output, passphrase,
+                                         new_passphrase, armor=armor)
+        if not encrypted.ok and os.path.exists(output):
+            os.remove(output)
+        return encrypted
+
+
+    @STATS.timed('rekey')
+    def rekey(self, passphrase, new_passphrase, jobs=1, scanner=None):
+        """
+        Change the passphrase of all encrypted files
+
+        Each encrypted file (files, chunks, manifest, index and bundle) is
+        decrypted in memory and encrypted again with new_passphrase by a
+        pool of jobs workers, nothing is written in clear. New files are
+        written next to the old ones and renamed only once all files are
+        encrypted, then committed at once. Old encrypted files stay in
+        the git history (see flush_history).
+
+        :param passphrase: Current passphrase
+        :type passphrase: str
+        :param new_passphrase: New passphrase
+        :type new_passphrase: str
+        :param jobs: Number of files encrypted concurrently
+        :type jobs: int
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: False if a file can't be decrypted or encrypted, nothing
+                 is changed then
+        """
+        scanner = self._scanner(scanner)
+        git_files = self._encrypted_git_files(scanner)
+        if not git_files:
+            return True
+        # Check the passphrase on the smallest file first
+        paths = sorted((os_join(self.directory, git_file)
+                        for git_file in git_files), key=os.path.getsize)
+        LOG.info('Change passphrase of %d file(s)' % len(paths))
+
+        failed = lambda encrypted: not encrypted.ok
+        rekeyed = self._rekey_file(paths[0], passphrase, new_passphrase)
+        results = [rekeyed]
+        if rekeyed.ok:
+            results += run_pool(lambda path: self._rekey_file(path, passphrase,
+                                                              new_passphrase),
+                                paths[1:], jobs=jobs, stop=failed)
+        # Cancelled files have no result
+        errors = [(path, encrypted) for path, encrypted in zip(paths, results)
+                  if encrypted is not None and not encrypted.ok]
+        for path, encrypted in zip(paths, results):
+            if encrypted is not None and encrypted.ok:
+                if errors:
+                    os.remove('%s.rekey.tmp' % path)
+                else:
+                    os.rename('%s.rekey.tmp' % path, path)
+        if errors:
+            path, encrypted = errors[0]
+            LOG.error('Unable to change passphrase of %s - %s' % (
+                      path, encrypted.stderr))
+            return False
+
+        self.git.add(git_files)
+        self.git.commit('Change passphrase of %d files' % len(git_files))
+        return True
+
+
+    def _verify_file(self, git_file, passphrase):
+        "Decrypt one encrypted file without writing it, return a FileCheck"
+        path = os_join(self.directory, git_file)
+        start = time.time()
+        decrypted = self.crypt.verify(path, passphrase)
+        seconds = time.time() - start
+        if decrypted.ok:
+            status = 'ok'
+        else:
+            status = getattr(decrypted, 'status', None) or 'decryption failed'
+        return FileCheck(git_file, bool(decrypted.ok), status, seconds,
+                         os.path.getsize(path))
+
+
+    @STATS.timed('verify')
+    def verify(self, passphrase, jobs=1, scanner=None):
+        """
+        Check the integrity of all encrypted files
+
+        Each encrypted file (files, chunks, manifest, index and bundle) is
+        decrypted by a pool of jobs workers without writing the plaintext,
+        which checks the passphrase and the integrity (MDC) of the file.
+        Encrypted files without plaintext source (neither in the directory
+        nor in the manifest), not in git or in git but removed, and chunks
+        used by the manifest but missing are reported too.
+
+        :param passphrase: Passphrase of encrypted files
+        :type passphrase: str
+        :param jobs: Number of files decrypted concurrently
+        :type jobs: int
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: VerifyReport
+        """
+        scanner = self._scanner(scanner)
+        report = VerifyReport()
+        start = time.time()
+        git_files = self._encrypted_git_files(scanner)
+        LOG.info('Verify %d file(s)' % len(git_files))
+        report.checks = run_pool(lambda git_file: self._verify_file(
+                                     git_file, passphrase),
+                                 git_files, jobs=jobs)
+
+        # Sources known by the directory or by the last encryption
+        manifest = Manifest(os_join(self.directory, self.manifest_file),
+                            self.crypt)
+        loaded = manifest.load(passphrase=passphrase)
+        sources = set(scanner.plain_files()) | set(manifest.entries)
+        if loaded or sources:
+            report.orphans = [
+                os_join(self.encrypted_dir, '%s.passkeeper' % name)
+                for name in sorted(scanner.encrypted_files)
+                if name not in sources]
+        used = set()
+        for entry in manifest.entries.values():
+            used.update(entry.get('chunks', []))
+        report.missing_chunks = [
+            os_join(self.chunks_dir, '%s.passkeeper' % name)
+            for name in sorted(used) if not os.path.isfile(os_join(
+                self.directory, self.chunks_dir, '%s.passkeeper' % name))]
+
+        # Encrypted files of the git index
+        tracked = set(path for path in self.git.ls_files()
+                      if path.endswith('.passkeeper'))
+        report.untracked = [git_file for git_file in git_files
+                            if git_file not in tracked]
+        report.missing = sorted(tracked - set(git_files))
+        report.seconds = time.time() - start
+
+        for check in report.failed:
+            LOG.error('Unable to decrypt %s - %s' % (check.path, check.status))
+        return report
+
+
+    @STATS.timed('migrate')
+    def migrate(self, passphrase, layout, jobs=1, scanner=None):
+        """
+        Convert encrypted ini files to layout
+
+        files : one encrypted file per ini file in the encrypted directory.
+        bundle : all ini files in one encrypted message (see Bundle),
+        encrypted and decrypted with one key derivation.
+
+        Ini files are decrypted in memory only. Replaced encrypted files
+        are shredded and removed from git, and the conversion is committed
+        once.
+
+        :param passphrase: Passphrase of encrypted files
+        :type passphrase: str
+        :param layout: files or bundle
+        :type layout: str
+        :param jobs: Number of files encrypted or decrypted concurrently
+        :type jobs: int
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: False if ini files can't be decrypted or encrypted
+        """
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown layout %s' % layout)
+        if self.bundled() == (layout == 'bundle'):
+            LOG.info('Ini files already in %s layout' % layout)
+            return True
+        LOG.info('Migrate ini files to %s layout' % layout)
+        scanner = self._scanner(scanner, raw=False)
+        ini_files = self._decrypt_ini_files(passphrase, jobs=jobs,
+                                            scanner=scanner)
+        if ini_files is None:
+            return False
+
+        bundle_path = os_join(self.directory, self.bundle_file)
+        git_files = [os_join(self.encrypted_dir, '%s.passkeeper' % name)
+                     for name, content in ini_files]
+        if layout == 'bundle':
+            bundle = Bundle(bundle_path, self.crypt)
+            bundle.files = ini_files
+            if not bundle.save(passphrase=passphrase):
+                return False
+            added, removed = [self.bundle_file], git_files
+            removed_paths = [scanner.encrypted_files[name].path
+                             for name, content in ini_files]
+        else:
+            create_dir(os_join(self.directory, self.encrypted_dir))
+
+            def _encrypt(ini_file):
+                name, content = ini_file
+                LOG.info('Encrypt file %s' % name)
+                encrypted = self.crypt.encrypt_data(content, passphrase)
+                if encrypted.ok:
+                    with open(scanner.encrypted_path(name), 'wb') as f:
+                        f.write(encrypted.data)
+                else:
+                    LOG.error('Encrypt file %s - %s' % (name,
+                                                        encrypted.stderr))
+                return encrypted
+
+            results = run_pool(_encrypt, ini_files, jobs=jobs)
+            if not all(encrypted.ok for encrypted in results):
+                return False
+            added, removed = git_files, [self.bundle_file]
+            removed_paths = [bundle_path]
+
+        report = self.shredder.shred(removed_paths, remove=False)
+        if report.errors:
+            raise ShredError('Unable to shred %d file(s)' % len(report.errors))
+        self.git.add(added)
+        self.git.force_remove(removed)
+        self.git.commit('Migrate ini files to %s layout' % layout)
+        return True
+
+
+    def _decrypt_ini_file(self, name, passphrase, scanner):
+        "Decrypt an encrypted ini file in memory, return a Result"
+        LOG.info('Decrypt file %s in memory' % name)
+        with open(scanner.encrypted_files[name].path, 'rb') as f:
+            return self.crypt.decrypt_data(f.read(), passphrase)
+
+
+    def _decrypt_ini_files(self, passphrase, jobs=1, names=None,
+                           scanner=None):
+        """
+        Decrypt encrypted ini files in memory
+
+        :param names: Ini files to decrypt, all encrypted ini files if None
+        :return: list of (ini file name, content), None if a file can't
+                 be decrypted
+        """
+        if self.bundled():
+            bundle = Bundle(os_join(self.directory, self.bundle_file),
+                            self.crypt)
+            if not bundle.load(passphrase=passphrase):
+                return None
+            return [(name, content) for name, content in bundle.files
+                    if names is None or name in names]
+        scanner = self._scanner(scanner, raw=False)
+        if names is None:
+            names = scanner.encrypted_ini_files()
+
+        failed = lambda decrypted: not decrypted.ok
+        results = run_pool(lambda name: self._decrypt_ini_file(name, passphrase,
+                                                               scanner),
+                           names, jobs=jobs, stop=failed)
+        for name, decrypted in zip(names, results):
+            if decrypted is None or not decrypted.ok:
+                LOG.error('Unable to decrypt %s - %s' % (
+                          name, decrypted.stderr if decrypted else 'cancelled'))
+                return None
+        return [(name, decrypted.data)
+                for name, decrypted in zip(names, results)]
+
+
+    def _index_candidates(self, pattern, passphrase, scanner):
+        """
+        Return encrypted ini files which can match pattern according to
+        the search index, None if the index can't be used
+        """
+        search_index = SearchIndex(os_join(self.directory, self.index_file),
+                                   self.crypt)
+        if not search_index.load(passphrase=passphrase):
+            return None
+        candidates = search_index.candidates(pattern)
+        if candidates is None:
+            return None
+        # Files not indexed are always candidates
+        indexed = set(search_index.files)
+        names = [name for name in scanner.encrypted_ini_files()
+                 if name in candidates or name not in indexed]
+        LOG.info('Search index : %d candidate file(s)' % len(names))
+        return names
+
+
+    @STATS.timed('load_encrypted')
+    def load_encrypted(self, engine, passphrase, jobs=1, names=None,
+                       scanner=None):
+        """
+        Load encrypted ini files in a SearchEngine, decrypted in memory.
+        Files already loaded and unchanged since are not decrypted again.
+
+        :param engine: Search engine filled
+        :type engine: SearchEngine
+        :param passphrase: Passphrase of encrypted files
+        :type passphrase: str
+        :param jobs: Number of files decrypted concurrently
+        :type jobs: int
+        :param names: Ini files to load, all encrypted ini files if None.
+                      Other files are removed from engine when all are
+                      loaded.
+        :type names: list
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: False if a file can't be decrypted
+        """
+        if self.bundled():
+            return self._load_bundle(engine, passphrase, names=names)
+        scanner = self._scanner(scanner, raw=False)
+        all_files = names is None
+        if all_files:
+            names = scanner.encrypted_ini_files()
+        # Signatures by ini file name
+        signatures = {}
+        changed = []
+        for name in names:
+            stat = scanner.encrypted_files[name].stat
+            signatures[name] = (stat.st_size, stat.st_mtime)
+            if not engine.loaded(name, signatures[name]):
+                changed.append(name)
+        ini_files = self._decrypt_ini_files(passphrase, jobs=jobs,
+                                            names=changed, scanner=scanner)
+        if ini_files is None:
+            return False
+        for fname, content in ini_files:
+            engine.add_file(fname, content, signatures[fname])
+        if all_files:
+            engine.keep_files(signatures)
+        return True
+
+
+    def _load_bundle(self, engine, passphrase, names=None):
+        """
+        Load ini files of the bundle in engine. The bundle is not
+        decrypted again if unchanged since engine loaded it
+        """
+        stat = os.stat(os_join(self.directory, self.bundle_file))
+        signature = (stat.st_size, stat.st_mtime)
+        loaded = names if names is not None else list(engine.files)
+        if loaded and all(engine.loaded(name, signature) for name in loaded):
+            return True
+        ini_files = self._decrypt_ini_files(passphrase, names=names)
+        if ini_files is None:
+            return False
+        for fname, content in ini_files:
+            engine.add_file(fname, content, signature)
+        if names is None:
+            engine.keep_files([fname for fname, content in ini_files])
+        return True
+
+
+    def _load_engine(self, pattern, passphrase=None, jobs=1, use_index=True,
+                     scanner=None):
+        """
+        Return a SearchEngine with ini files which can match pattern,
+        None if encrypted files can't be decrypted
+        """
+        scanner = self._scanner(scanner, raw=False)
+        if passphrase is not None:
+            # Decrypted files are never kept between searches
+            engine = SearchEngine()
+            names = None
+            # The bundle is decrypted at once, the index is useless
+            if (use_index and not self.bundled()
+            and os.path.isfile(os_join(self.directory, self.index_file))):
+                names = self._index_candidates(pattern, passphrase, scanner)
+            if not self.load_encrypted(engine, passphrase, jobs=jobs,
+                                       names=names, scanner=scanner):
+                return None
+            return engine
+
+        engine = self.search_engine
+        for fname, info in scanner.ini_files.items():
+            signature = (info.stat.st_size, info.stat.st_mtime)
+            if engine.loaded(fname, signature):
                 continue
+            with open(info.path, 'rb') as f:
+                engine.add_file(fname, f.read(), signature)
+        engine.keep_files(scanner.ini_files)
+        return engine
+
 
-            for option, value in config.items(section):
-                # Value match ?
-                match = re_prep.search(value.lower())
-                if match is not None:
-                    matching_sections.append(section)
-                    break
+    @STATS.timed('search')
+    def search(self, pattern, passphrase=None, jobs=1, use_index=True,
+               scanner=None):
+        """
+        Search pattern in sections and values of ini files
 
-        return config, matching_sections
+        Without passphrase, search in decrypted ini files. They are parsed
+        once and parsed again only when changed on disk. With a
+        passphrase, search in encrypted ini files decrypted in memory by
+        jobs workers. Nothing is written on disk. If the search index
+        exists and the pattern is not a regex, only ini files which can
+        match are decrypted.
 
+        :param pattern: Regex searched, case insensitive
+        :type pattern: str
+        :param passphrase: Passphrase of encrypted files
+        :type passphrase: str
+        :param jobs: Number of files decrypted concurrently
+        :type jobs: int
+        :param use_index: Use the search index if it exists
+        :type use_index: bool
+        :param scanner: Inventory of the directory, scanned if None
+        :type scanner: VaultScanner
+        :return: list of Hit (file, section, options)
+        """
+        LOG.info('Search in files :')
+        engine = self._load_engine(pattern, passphrase=passphrase,
+                                   jobs=jobs, use_index=use_index,
+                                   scanner=scanner)
+        if engine is None:
+            return []
+        return engine.search(pattern)
 
-    def print_sections(self, config, matching_sections, pattern):
+
+    @STATS.timed('get')
+    def get(self, section, passphrase=None, jobs=1, use_index=True,
+            scanner=None):
+        """
+        Get sections by name, see search for parameters
+
+        :param section: Section name, case insensitive
+        :type section: str
+        :return: list of Hit (file, section, options)
+        """
+        LOG.info('Get section %s :' % section)
+        engine = self._load_engine(section, passphrase=passphrase,
+                                   jobs=jobs, use_index=use_index,
+                                   scanner=scanner)
+        if engine is None:
+            return []
+        return engine.get(section)
+
+
+    def _iter_ini_files(self, pattern, passphrase=None, jobs=1,
+                        use_index=True, scanner=None):
+        """
+        Yield (name, content) of ini files which can match pattern, sorted,
+        read or decrypted one at a time. Raise DecryptionError at the
+        first file which can't be decrypted.
+        """
+        scanner = self._scanner(scanner, raw=False)
+        if passphrase is None:
+            for name, info in sorted(scanner.ini_files.items()):
+                with open(info.path, 'rb') as f:
+                    yield name, f.read()
+            return
+        if self.bundled():
+            # The bundle is decrypted at once
+            ini_files = self._decrypt_ini_files(passphrase)
+            if ini_files is None:
+                raise DecryptionError('Unable to decrypt %s'
+                                      % self.bundle_file)
+            for ini_file in ini_files:
+                yield ini_file
+            return
+        names = None
+        if (use_index
+        and os.path.isfile(os_join(self.directory, self.index_file))):
+            names = self._index_candidates(pattern, passphrase, scanner)
+        if names is None:
+            names = scanner.encrypted_ini_files()
+        results = iter_pool(lambda name: (name, self._decrypt_ini_file(
+                                              name, passphrase, scanner)),
+                            names, jobs=jobs)
+        try:
+            for name, decrypted in results:
+                if not decrypted.ok:
+                    raise DecryptionError('Unable to decrypt %s - %s' % (
+                                          name, decrypted.stderr))
+                yield name, decrypted.data
+        finally:
+            # Stop workers
+            results.close()
+
+
+    def iter_search(self, pattern, passphrase=None, jobs=1, use_index=True,
+                    scanner=None):
+        """
+        Search pattern like search, yield Hit as they are found
+
+        Ini files are read, or decrypted in memory, and parsed one at a
+        time, so memory does not grow with the number of files. Nothing
+        is kept for next searches. DecryptionError is raised by the
+        iteration if an encrypted file can't be decrypted.
+
+        :Example:
+
+        >>> for hit in pk.iter_search('foo.com', passphrase='secret'):
+        ...     print(hit.file, hit.section)
+        default.ini foo
+        """
+        LOG.info('Search in files :')
+        return search_files(self._iter_ini_files(pattern,
+                                                 passphrase=passphrase,
+                                                 jobs=jobs,
+                                                 use_index=use_index,
+                                                 scanner=scanner),
+                            pattern)
+
+
+    def iter_get(self, section, passphrase=None, jobs=1, use_index=True,
+                 scanner=None):
+        "Get sections by name like get, yield Hit, see iter_search"
+        LOG.info('Get section %s :' % section)
+        return get_files(self._iter_ini_files(section, passphrase=passphrase,
+                                              jobs=jobs, use_index=use_index,
+                                              scanner=scanner),
+                         section)
+
+
+    def print_sections(self, hits, pattern):
+        """
+        Print hits, pattern highlighted. Hits can be a generator (see
+        iter_search), each hit is printed as soon as it is found.
+        """
         # Color matching pattern
         sed = re.compile('(.*)(%s)(.*)' % re.escape(pattern), re.IGNORECASE)
-        for section in matching_sections:
-            print('[%s]' % pink(sed.sub('%s%s%s' % (pink('\g<1>'),
-                                                    red('\g<2>'),
-                                                    pink('\g<3>')),
-                                section)))
-            for option, value in config.items(section):
+        for hit in hits:
+            print('[%s] %s' % (pink(sed.sub('%s%s%s' % (pink('\g<1>'),
+                                                        red('\g<2>'),
+                                                        pink('\g<3>')),
+                                            hit.section)),
+                               grey('(%s)' % hit.file)))
+            for option, value in hit.options:
                 print('%s = %s' % (green(option),
                                    white(sed.sub('%s%s%s' % (white('\g<1>'),
                                                              red('\g<2>'),
                                                              white('\g<3>')),
                                          value))))
             print('')
+            sys.stdout.flush()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import stat
+import time
+import json
+import errno
+import socket
+import hashlib
+import logging
+import tempfile
+from passkeeper.search import SearchEngine, Hit
+from os.path import join as os_join
+
+LOG = logging.getLogger(__name__)
+
+# Default time in seconds the vault stays unlocked
+DEFAULT_TTL = 900
+
+
+class AgentError(Exception):
+    pass
+
+
+def socket_path(directory):
+    """
+    Return the agent socket path of a passkeeper directory
+
+    The socket is in a directory readable by the owner only, in
+    XDG_RUNTIME_DIR or the temporary directory. Clients check it with
+    check_socket before sending anything.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    name = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()
+    return os_join(runtime_dir, 'passkeeper-%d' % os.getuid(),
+                   '%s.sock' % name[:16])
+
+
+def check_socket(path):
+    """
+    Raise AgentError unless the socket and its directory belong to the
+    user and the directory is readable by the owner only, so another user
+    can't impersonate the agent
+    """
+    uid = os.getuid()
+    try:
+        dir_stat = os.lstat(os.path.dirname(path))
+        socket_stat = os.lstat(path)
+    except OSError as e:
+        raise AgentError('Agent %s - %s' % (path, e))
+    if (not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != uid
+    or stat.S_IMODE(dir_stat.st_mode) != 0o700):
+        raise AgentError('Unsafe agent directory %s'
+                         % os.path.dirname(path))
+    if not stat.S_ISSOCK(socket_stat.st_mode) or socket_stat.st_uid != uid:
+        raise AgentError('Unsafe agent socket %s' % path)
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _receive(conn):
+    "Read one json line"
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise AgentError('Connection closed')
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+class Agent(object):
+    """
+    Long-lived process holding the unlocked vault in memory.
+
+    Encrypted ini files are decrypted once in a SearchEngine and search
+    and get requests are served on a Unix socket readable by the owner
+    only, during ttl seconds. Encrypted files changed since are decrypted
+    again before answering.
+
+    Protocol is one json request per connection, answered by one json
+    line : ``{"command": "search", "pattern": "foo"}`` gives
+    ``{"ok": true, "hits": [[file, section, [[option, value]]]]}``.
+    Commands are search (pattern), get (section), status and stop.
+
+    :Example:
+
+    >>> agent = Agent(Passkeeper('/opt/mypasskeeper'), ttl=600)
+    >>> agent.unlock(passphrase='secret')
+    True
+    >>> agent.serve()
+    """
+
+    # Seconds a client has to send its request
+    client_timeout = 5
+
+    def __init__(self, passkeeper, ttl=DEFAULT_TTL, path=None, jobs=1):
+        self.passkeeper = passkeeper
+        self.ttl = ttl
+        self.path = path or socket_path(passkeeper.directory)
+        self.jobs = jobs
+        self.engine = None
+        self.passphrase = None
+        self.expire = None
+        self.running = False
+
+    def unlock(self, passphrase):
+        "Decrypt ini files in memory. Return False on wrong passphrase"
+        engine = SearchEngine()
+        if not self.passkeeper.load_encrypted(engine, passphrase,
+                                              jobs=self.jobs):
+            return False
+        self.engine = engine
+        self.passphrase = passphrase
+        return True
+
+    def lock(self):
+        "Forget decrypted files"
+        self.engine = None
+        self.passphrase = None
+
+    def _listen(self):
+        socket_dir = os.path.dirname(self.path)
+        try:
+            os.makedirs(socket_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.chmod(socket_dir, 0o700)
+        if os.stat(socket_dir).st_uid != os.getuid():
+            raise AgentError('Unsafe agent directory %s' % socket_dir)
+        if os.path.exists(self.path):
+            if AgentClient(self.path).running():
+                raise AgentError('Agent already running on %s' % self.path)
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+        server.listen(16)
+        return server
+
+    def serve(self):
+        "Serve requests until ttl expires or a stop request"
+        if not hasattr(socket, 'AF_UNIX'):
+            raise AgentError('Unix sockets are not supported')
+        if self.engine is None:
+            raise AgentError('Agent is locked')
+        server = self._listen()
+        LOG.info('Agent listening on %s for %ds' % (self.path, self.ttl))
+        self.expire = time.time() + self.ttl
+        self.running = True
+        try:
+            while self.running:
+                remaining = self.expire - time.time()
+                if remaining <= 0:
+                    break
+                server.settimeout(remaining)
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                try:
+                    conn.settimeout(self.client_timeout)
+                    self._handle(conn)
+                except Exception as e:
+                    # One bad request doesn't stop the agent
+                    LOG.warning('Bad request - %s' % e)
+                finally:
+                    conn.close()
+        finally:
+            self.running = False
+            server.close()
+            os.remove(self.path)
+            self.lock()
+            LOG.info('Agent stopped')
+
+    def serve_background(self):
+        "Fork and serve in the child process. Return the child pid"
+        pid = os.fork()
+        if pid:
+            return pid
+        # Child, detached from the terminal
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        try:
+            self.serve()
+        finally:
+            os._exit(0)
+
+    def _handle(self, conn):
+        request = _receive(conn)
+        command = request.get('command')
+        if command == 'status':
+            _send(conn, {'ok': True,
+                         'ttl': int(self.expire - time.time())})
+        elif command == 'stop':
+            self.running = False
+            _send(conn, {'ok': True})
+        elif command in ('search', 'get'):
+            try:
+                answer = self._search(command, request)
+            except re.error as e:
+                answer = {'ok': False, 'error': 'Invalid pattern - %s' % e}
+            except Exception as e:
+                # An unreadable ini file must not stop the agent
+                LOG.exception('Unable to answer %s request' % command)
+                answer = {'ok': False, 'error': '%s - %s' % (
+                          e.__class__.__name__, e)}
+            _send(conn, answer)
+        else:
+            _send(conn, {'ok': False,
+                         'error': 'Unknown command %s' % command})
+
+
+    def _search(self, command, request):
+        "Answer a search or get request"
+        # Decrypt files changed since unlock
+        if not self.passkeeper.load_encrypted(self.engine, self.passphrase,
+                                              jobs=self.jobs):
+            return {'ok': False, 'error': 'Unable to decrypt changed files'}
+        if command == 'search':
+            hits = self.engine.search(request['pattern'])
+        else:
+            hits = self.engine.get(request['section'])
+        return {'ok': True, 'hits': hits}
+
+
+class AgentClient(object):
+    """
+    Client of a running Agent
+
+    :Example:
+
+    >>> client = AgentClient(socket_path('/opt/mypasskeeper'))
+    >>> if client.running():
+    ...     hits = client.search('foo')
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, command, **kwargs):
+        """
+        Send a request. Return the answer, raise AgentError on error or
+        if the socket is not safe (see check_socket)
+        """
+        check_socket(self.path)
+        kwargs['command'] = command
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        try:
+            conn.connect(self.path)
+            _send(conn, kwargs)
+            answer = _receive(conn)
+        except (socket.error, ValueError) as e:
+            raise AgentError('Agent %s - %s' % (self.path, e))
+        finally:
+            conn.close()
+        if not answer.get('ok'):
+            raise AgentError(answer.get('error', 'Unknown error'))
+        return answer
+
+    def running(self):
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.path):
+            return False
+        try:
+            check_socket(self.path)
+        except AgentError as e:
+            LOG.warning('%s, agent not used' % e)
+            return False
+        try:
+            self.request('status')
+        except AgentError:
+            return False
+        return True
+
+    def _hits(self, answer):
+        return [Hit(name, section, [tuple(option) for option in options])
+                for name, section, options in answer['hits']]
+
+    def search(self, pattern):
+        return self._hits(self.request('search', pattern=pattern))
+
+    def get(self, section):
+        return self._hits(self.request('get', section=section))
+
+    def stop(self):
+        self.request('stop')
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio engine of passkeeper, python >= 3.5 only
+
+Encryption, staging in git and shredding overlap : while a file is
+encrypted, the previous one is staged and the one before is shredded.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from os.path import join as os_join
+from passkeeper.shred import ShredError
+from passkeeper.stats import STATS
+
+LOG = logging.getLogger(__name__)
+
+
+class CommandError(Exception):
+    pass
+
+
+def run(coroutine):
+    """
+    Run a coroutine in a new event loop, return its result
+
+    :Example:
+
+    >>> run(AsyncPasskeeper(pk, jobs=4).cleanup())
+    []
+    """
+    loop = asyncio.new_event_loop()
+    # Before python 3.8, subprocesses are watched by the current loop
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class CommandRunner(object):
+    """
+    Run commands in asyncio subprocesses and blocking functions in
+    threads, at most jobs at once.
+
+    :Example:
+
+    >>> runner = CommandRunner(jobs=4)
+    >>> returncode, stdout, stderr = await runner.run(['git', 'status'])
+    >>> report = await runner.call(shredder.shred, ['/opt/mypasskeeper/foo.ini'])
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self._loop = None
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        "Limit of concurrent commands, one per event loop"
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.jobs)
+        return self._semaphore
+
+    async def run(self, args, input=None, cwd=None, check=True):
+        """
+        Run a command
+
+        :param args: Command and its arguments
+        :type args: list
+        :param input: Data written on the command stdin
+        :type input: bytes
+        :param cwd: Directory of the command
+        :type cwd: str
+        :param check: Raise CommandError if the command failed
+        :type check: bool
+        :return: (return code, stdout, stderr)
+        """
+        async with self.semaphore:
+            LOG.debug('Launch : %s' % ' '.join(args))
+            start = time.time()
+            process = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd,
+                stdin=asyncio.subprocess.PIPE if input is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate(input)
+            STATS.count('cmd.async', seconds=time.time() - start, processes=1)
+        if check and process.returncode != 0:
+            LOG.critical('Command ERROR %s return code : %d' % (
+                         ' '.join(args), process.returncode))
+            raise CommandError('Unable to execute command %s' % args[0])
+        return process.returncode, stdout, stderr
+
+    async def call(self, func, *args):
+        "Run a blocking function in a thread, return its result"
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, func, *args)
+
+
+class IndexStream(object):
+    """
+    Update the git index of files as they come, with one
+    ``git update-index --stdin`` process.
+
+    :Example:
+
+    >>> stream = IndexStream(pk.git, ['--add'])
+    >>> await stream.start()
+    >>> await stream.write('encrypted/foo.ini.passkeeper')
+    >>> await stream.close()
+    """
+
+    def __init__(self, git, options):
+        self.git = git
+        self.options = options
+        self.files = []
+        self._process = None
+
+    async def start(self):
+        args = self.git.command(['update-index'] + self.options
+                                + ['-z', '--stdin'])
+        LOG.debug('Launch : %s' % ' '.join(args))
+        self._process = await asyncio.create_subprocess_exec(
+            *args, cwd=self.git.directory, stdin=asyncio.subprocess.PIPE)
+
+    async def write(self, path):
+        self._process.stdin.write(('%s\0' % path).encode('utf-8'))
+        await self._process.stdin.drain()
+        self.files.append(path)
+
+    async def close(self):
+        "Wait the end of the update, raise CommandError if it failed"
+        self._process.stdin.close()
+        returncode = await self._process.wait()
+        STATS.count('git.update-index', files=len(self.files), processes=1)
+        if returncode != 0:
+            LOG.critical('Unable to update git index of %d file(s)'
+                         % len(self.files))
+            raise CommandError('Unable to execute command update-index')
+
+
+class ShredStage(object):
+    """
+    Shred files as they come. Files queued while a batch is shredded are
+    shredded together in the next batch.
+    """
+
+    def __init__(self, shredder, runner, remove=True, force=False):
+        self.shredder = shredder
+        self.runner = runner
+        self.remove = remove
+        self.force = force
+        self.errors = []
+        self._queue = asyncio.Queue()
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.ensure_future(self._work())
+                         for _ in range(self.runner.jobs)]
+
+    def put(self, path):
+        self._queue.put_nowait(path)
+
+    async def _work(self):
+        while True:
+            batch = [await self._queue.get()]
+            while (not self._queue.empty()
+                   and len(batch) < self.shredder.batch_size):
+                batch.append(self._queue.get_nowait())
+            done = None in batch
+            batch = [path for path in batch if path is not None]
+            if batch:
+                report = await self.runner.call(self.shredder.shred, batch,
+                                                self.remove, self.force)
+                self.errors.extend(report.errors)
+            if done:
+                # Let other workers stop
+                self._queue.put_nowait(None)
+                return
+
+    async def close(self):
+        "Wait the end of queued shreds, return paths not shredded"
+        self._queue.put_nowait(None)
+        await asyncio.gather(*self._workers)
+        return self.errors
+
+
+class AsyncPasskeeper(object):
+    """
+    Async API of a Passkeeper, to embed in asyncio applications.
+
+    Subprocesses and blocking steps run through a CommandRunner limited to
+    jobs at once, the loop is never blocked.
+
+    :Example:
+
+    >>> pk = AsyncPasskeeper(Passkeeper('/opt/mypasskeeper'), jobs=4)
+    >>> scanner = pk.passkeeper.scan()
+    >>> await pk.encrypt(passphrase='secret', clean=True, scanner=scanner)
+    >>> await pk.remove_old_encrypted_files(scanner=scanner)
+    """
+
+    def __init__(self, passkeeper, jobs=1):
+        self.passkeeper = passkeeper
+        self.jobs = jobs
+        self.runner = CommandRunner(jobs=jobs)
+
+    async def _blocking(self, func, *args):
+        "Run a blocking step without using a job"
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def encrypt(self, passphrase, commit_message='Update encrypted files',
+                      incremental=True, binary_raw=False, index=False,
+                      chunk_threshold=None, clean=False, scanner=None):
+        """
+        Encrypt files like Passkeeper.encrypt, as a pipeline
+
+        Each encrypted file is staged in git as soon as it is written, and
+        with clean its source raw file is then shredded (see
+        Passkeeper.cleanup). Ini files, read again for the index and the
+        bundle, unchanged files and raw directories are shredded once all
+        files are encrypted. Nothing else is shredded if a file failed.
+        Source files are then missing : give the same scanner to
+        remove_old_encrypted_files.
+
+        :param clean: Shred source files once encrypted
+        :type clean: bool
+        :return: False if at least one file has not been encrypted
+        """
+        pk = self.passkeeper
+        scanner = pk._scanner(scanner)
+        plan = await self._blocking(
+            lambda: pk._plan_encrypt(passphrase, jobs=self.jobs,
+                                     incremental=incremental,
+                                     binary_raw=binary_raw,
+                                     chunk_threshold=chunk_threshold,
+                                     scanner=scanner))
+        stream = IndexStream(pk.git, ['--add'])
+        await stream.start()
+        shred_stage = ShredStage(pk.shredder, self.runner, force=True)
+        shredded = set()
+
+        async def _encrypt(task, git_file):
+            encrypted = await self.runner.call(pk._encrypt_file, task,
+                                               passphrase, plan.store_for(task))
+            if not encrypted.ok:
+                return encrypted
+            for name in getattr(encrypted, 'new_chunks', []):
+                await stream.write(os_join(pk.chunks_dir, '%s.passkeeper' % name))
+            await stream.write(git_file)
+            if clean and task[0] not in scanner.ini_files:
+                shred_stage.put(task[1])
+                shredded.add(task[1])
+            return encrypted
+
+        errors = []
+        dirs = []
+        if clean:
+            shred_stage.start()
+        try:
+            try:
+                results = await asyncio.gather(*[
+                    _encrypt(task, git_file)
+                    for task, git_file in zip(plan.tasks, plan.git_files)])
+            finally:
+                await stream.close()
+            status = await self._blocking(
+                lambda: pk._finish_encrypt(plan, results, passphrase,
+                                           commit_message=commit_message,
+                                           index=index,
+                                           staged=set(stream.files)))
+            # Files not shredded by the pipeline
+            if clean and status:
+                files, dirs = pk.shredder.list_tree(
+                    [os_join(pk.directory, name) for name in scanner.raw_dirs])
+                for path in [info.path for name, info
+                             in sorted(scanner.ini_files.items())] + files:
+                    if path not in shredded:
+                        shred_stage.put(path)
+                if scanner.selection is not None:
+                    shred_stage.put(scanner.selection_path)
+        finally:
+            if clean:
+                errors = await shred_stage.close()
+        if errors:
+            LOG.error('Unable to shred %d file(s)' % len(errors))
+            return False
+        for dpath in dirs:
+            os.rmdir(dpath)
+        return status
+
+    async def cleanup(self, scanner=None):
+        """
+        Shred all ini and raw files like Passkeeper.cleanup, batches of
+        files are shredded by jobs workers
+
+        :return: list of paths not shredded
+        """
+        pk = self.passkeeper
+        scanner = pk._scanner(scanner)
+        files, dirs = pk.shredder.list_tree(
+            [os_join(pk.directory, name) for name in scanner.raw_dirs])
+        shred_stage = ShredStage(pk.shredder, self.runner, force=True)
+        shred_stage.start()
+        for path in [info.path for name, info
+                     in sorted(scanner.ini_files.items())] + files:
+            shred_stage.put(path)
+        if (scanner.selection is not None
+                and os.path.isfile(scanner.selection_path)):
+            shred_stage.put(scanner.selection_path)
+        errors = await shred_stage.close()
+        if not errors:
+            for dpath in dirs:
+                os.rmdir(dpath)
+        return errors
+
+    async def remove_old_encrypted_files(self, scanner=None):
+        """
+        Remove encrypted files without original file, without
+        confirmation. Files are removed from the git index while next
+        ones are shredded, then committed once.
+
+        :return: list of removed files, relative to the directory
+        :raises ShredError: if a file can't be shredded, once other
+                            files are removed
+        """
+        pk = self.passkeeper
+        scanner = pk._scanner(scanner)
+        old_files = scanner.old_encrypted_files()
+        if not old_files:
+            return []
+        git_files = [os_join(pk.encrypted_dir, '%s.passkeeper' % name)
+                     for name in old_files]
+        LOG.info('%d file(s) will be deleted because origin files haven t '
+                 'been found.' % len(git_files))
+        stream = IndexStream(pk.git, ['--force-remove'])
+        await stream.start()
+
+        async def _remove(name, git_file):
+            path = scanner.encrypted_files[name].path
+            report = await self.runner.call(pk.shredder.shred, [path])
+            if not report.errors:
+                await stream.write(git_file)
+
+        try:
+            await asyncio.gather(*[_remove(name, git_file) for name, git_file
+                                   in zip(old_files, git_files)])
+        finally:
+            await stream.close()
+        # Empty directories
+        await self._blocking(pk.git._remove_files, stream.files)
+        if len(stream.files) == 1:
+            await self._blocking(pk.git.commit,
+                                 'Remove file %s' % stream.files[0])
+        elif stream.files:
+            await self._blocking(pk.git.commit,
+                                 'Remove %d files' % len(stream.files))
+        if len(stream.files) != len(git_files):
+            raise ShredError('Unable to shred %d file(s)'
+                             % (len(git_files) - len(stream.files)))
+        return sorted(stream.files)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import random
+import string
+import logging
+import platform
+import threading
+import subprocess
+from os.path import join as os_join
+from passkeeper import Passkeeper
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOG = logging.getLogger(__name__)
+
+# Operations timed by run_benchmark, in this order
+OPERATIONS = ('init_dir', 'encrypt', 'search', 'cleanup', 'decrypt',
+              'remove_old_encrypted_files', 'flush_history')
+
+# Budget in seconds of the median cold start time of passkeeper-cli --help
+# and of a plaintext search
+STARTUP_BUDGET = 0.2
+
+# Modules passkeeper-cli must not import for --help or a plaintext search
+HEAVY_MODULES = ('gnupg', 'cryptography', 'multiprocessing', 'tarfile')
+
+
+def generate_vault(directory, ini_files=10, sections=10, raw_files=10,
+                   raw_sizes=(1024,), raw_per_dir=10, seed=None):
+    """
+    Write a synthetic vault in directory.
+
+    Write ini_files ini files of sections sections, and raw_files random
+    files in raw directories of raw_per_dir files. The size of each raw
+    file is picked in raw_sizes (repeat a size to make it more frequent).
+
+    :param seed: Seed of names and passwords, raw content is always random
+    :return: (ini files, raw files) relative paths
+
+    :Example:
+
+    >>> generate_vault('/tmp/vault', ini_files=2, raw_files=1)
+    (['bench-0.ini', 'bench-1.ini'], ['bench-0.raw/file-0'])
+    """
+    rand = random.Random(seed)
+    chars = string.ascii_letters + string.digits
+    ini_names = []
+    for i in range(ini_files):
+        name = 'bench-%d.ini' % i
+        lines = []
+        for j in range(sections):
+            lines.extend(['[site-%d-%d]' % (i, j),
+                          'name = site %d %d access' % (i, j),
+                          'url = http://site-%d-%d.example.com' % (i, j),
+                          'login = user%d' % rand.randint(0, 9999),
+                          'password = %s' % ''.join(rand.choice(chars)
+                                                    for _ in range(16)),
+                          ''])
+        with open(os_join(directory, name), 'w') as f:
+            f.write('\n'.join(lines))
+        ini_names.append(name)
+
+    raw_names = []
+    for i in range(raw_files):
+        raw_dir = 'bench-%d.raw' % (i // raw_per_dir)
+        if not os.path.isdir(os_join(directory, raw_dir)):
+            os.mkdir(os_join(directory, raw_dir))
+        name = '%s/file-%d' % (raw_dir, i)
+        with open(os_join(directory, name), 'wb') as f:
+            f.write(os.urandom(rand.choice(raw_sizes)))
+        raw_names.append(name)
+    LOG.info('Generated %d ini and %d raw files in %s' % (
+             len(ini_names), len(raw_names), directory))
+    return ini_names, raw_names
+
+
+class SpawnCounter(object):
+    """
+    Count processes launched with subprocess (git, gpg, shred, ...)
+    while used as context manager.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._execute_child = None
+
+    def __enter__(self):
+        self._execute_child = subprocess.Popen.__dict__['_execute_child']
+        execute_child = self._execute_child
+
+        def _counted_execute_child(popen, *args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return execute_child(popen, *args, **kwargs)
+
+        subprocess.Popen._execute_child = _counted_execute_child
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.Popen._execute_child = self._execute_child
+        return False
+
+
+def peak_rss():
+    "Return peak RSS in KB of this process and of its waited children"
+    if resource is None:
+        return None, None
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def measure(name, func, *args, **kwargs):
+    """
+    Call func and return its result with the measures of the call.
+
+    CPU time includes the time of waited child processes. Peak RSS are
+    the maximum since the start of the benchmark, not of this call.
+
+    :Example:
+
+    >>> measure('sleep', time.sleep, 1)
+    (None, {'operation': 'sleep', 'wall': 1.001, 'cpu': 0.0, ...})
+    """
+    times = os.times()
+    start = time.time()
+    with SpawnCounter() as spawns:
+        result = func(*args, **kwargs)
+    wall = time.time() - start
+    cpu = [end - begin for begin, end in zip(times, os.times())]
+    rss, rss_children = peak_rss()
+    measures = {'operation': name,
+                'wall': round(wall, 6),
+                'cpu': round(sum(cpu[:4]), 6),
+                'cpu_children': round(cpu[2] + cpu[3], 6),
+                'spawns': spawns.count,
+                'peak_rss_kb': rss,
+                'peak_rss_children_kb': rss_children}
+    LOG.info('%s : %.3fs wall, %.3fs cpu, %d process(es)' % (
+             name, wall, measures['cpu'], spawns.count))
+    return result, measures
+
+
+def run_benchmark(directory, passphrase='benchmark', ini_files=10,
+                  sections=10, raw_files=10, raw_sizes=(1024,), jobs=1,
+                  backend=None, shredder=None, pattern='site-1-1',
+                  remove_ratio=0.1, pack=False, seed=None):
+    """
+    Time passkeeper operations on a synthetic vault created in directory.
+
+    The vault is initialized, generated with generate_vault(), encrypted,
+    searched and cleaned. It is decrypted again, remove_ratio of the
+    files are deleted and their encrypted files removed. The git history
+    is flushed last.
+
+    :return: dict of parameters, environment and results of OPERATIONS
+    """
+    pk = Passkeeper(directory=directory, backend=backend, shredder=shredder)
+    results = []
+
+    def _run(name, *args, **kwargs):
+        result, measures = measure(name, getattr(pk, name), *args, **kwargs)
+        results.append(measures)
+        return result
+
+    _run('init_dir', passphrase=passphrase)
+    ini_names, raw_names = generate_vault(directory, ini_files=ini_files,
+                                          sections=sections,
+                                          raw_files=raw_files,
+                                          raw_sizes=raw_sizes, seed=seed)
+    _run('encrypt', passphrase=passphrase, jobs=jobs)
+    _run('search', pattern, jobs=jobs)
+    _run('cleanup')
+    _run('decrypt', passphrase=passphrase, jobs=jobs)
+    rand = random.Random(seed)
+    names = ini_names + raw_names
+    for name in rand.sample(names, int(len(names) * remove_ratio)):
+        os.remove(os_join(directory, name))
+    _run('remove_old_encrypted_files', force_remove=True)
+    _run('flush_history', pack=pack)
+
+    return {'parameters': {'ini_files': ini_files,
+                           'sections': sections,
+                           'raw_files': raw_files,
+                           'raw_sizes': list(raw_sizes),
+                           'jobs': jobs,
+                           'remove_ratio': remove_ratio,
+                           'pack': pack,
+                           'seed': seed},
+            'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'backend': pk.crypt.__class__.__name__,
+                            'shred_method': pk.shredder.method},
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def startup_benchmark(cli, directory, runs=5, budget=STARTUP_BUDGET,
+                      python=None):
+    """
+    Time cold starts of passkeeper-cli --help and of a plaintext search.
+
+    Each command is launched runs times in a new python interpreter. An
+    ini file is written in directory for the search.
+
+    :param cli: Path of the passkeeper-cli script
+    :type cli: str
+    :return: list of results, ok is False if the median time of the
+             command exceeds budget seconds
+
+    :Example:
+
+    >>> startup_benchmark('/usr/local/bin/passkeeper-cli', '/tmp/vault')
+    [{'command': '--help', 'median': 0.031, 'ok': True, ...}, ...]
+    """
+    python = python or sys.executable
+    generate_vault(directory, ini_files=1, sections=10, raw_files=0)
+    commands = [['--help'],
+                ['--directory', directory, '--search', 'site-0-1']]
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for command in commands:
+            times = []
+            for _ in range(runs):
+                start = time.time()
+                subprocess.call([python, cli] + command, stdout=devnull,
+                                stderr=devnull)
+                times.append(time.time() - start)
+            times.sort()
+            median = times[len(times) // 2]
+            results.append({'command': ' '.join(command),
+                            'runs': runs,
+                            'min': round(times[0], 6),
+                            'median': round(median, 6),
+                            'max': round(times[-1], 6),
+                            'budget': budget,
+                            'ok': median <= budget})
+            LOG.info('%s : %.3fs median' % (' '.join(command), median))
+    return results
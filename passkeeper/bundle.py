@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+from io import BytesIO
+from passkeeper.stats import STATS
+
+LOG = logging.getLogger(__name__)
+
+# Layouts of encrypted ini files : one encrypted file per ini file, or
+# all ini files in one bundle
+LAYOUTS = ('files', 'bundle')
+
+
+def pack(files):
+    """
+    Return a tar archive (bytes) of files, list of (name, content)
+
+    Members are sorted by name, without owner nor modification time.
+    """
+    # tarfile is only imported by the bundle layout
+    import tarfile
+    out = BytesIO()
+    archive = tarfile.open(fileobj=out, mode='w')
+    try:
+        for name, content in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o600
+            archive.addfile(info, BytesIO(content))
+    finally:
+        archive.close()
+    return out.getvalue()
+
+
+def unpack(data):
+    "Return files, list of (name, content), of a tar archive made by pack"
+    import tarfile
+    archive = tarfile.open(fileobj=BytesIO(data), mode='r')
+    try:
+        return [(info.name, archive.extractfile(info).read())
+                for info in archive.getmembers() if info.isfile()]
+    finally:
+        archive.close()
+
+
+class Bundle(object):
+    """
+    All ini files in one encrypted message.
+
+    Ini files are packed in a tar archive encrypted at once, so they are
+    encrypted and decrypted with one gpg run (one key derivation) instead
+    of one per file.
+
+    :Example:
+
+    >>> bundle = Bundle('/opt/mypasskeeper/bundle.passkeeper',
+    ...                 GnupgBackend())
+    >>> bundle.files = [('default.ini', b'[foo]\\nurl = http://foo.com\\n')]
+    >>> bundle.save(passphrase='secret')
+    >>> bundle.load(passphrase='secret')
+    >>> bundle.names()
+    ['default.ini']
+    """
+
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        # list of (ini file name, content)
+        self.files = []
+
+    def names(self):
+        return [name for name, content in self.files]
+
+    @STATS.timed('bundle.load')
+    def load(self, passphrase):
+        self.files = []
+        if not os.path.isfile(self.path):
+            LOG.debug('No bundle %s' % self.path)
+            return False
+        with open(self.path, 'rb') as f:
+            decrypted = self.backend.decrypt_data(f.read(), passphrase)
+        if not decrypted.ok:
+            LOG.error('Unable to decrypt bundle %s - %s' % (self.path,
+                                                           decrypted.stderr))
+            return False
+        import tarfile
+        try:
+            self.files = unpack(decrypted.data)
+        except tarfile.TarError as e:
+            LOG.error('Invalid bundle %s - %s' % (self.path, e))
+            return False
+        return True
+
+    @STATS.timed('bundle.save')
+    def save(self, passphrase):
+        encrypted = self.backend.encrypt_data(pack(self.files), passphrase)
+        if not encrypted.ok:
+            LOG.error('Unable to write bundle %s - %s' % (self.path,
+                                                         encrypted.stderr))
+            return False
+        # Never leave a partial bundle, it holds all ini files
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'wb') as f:
+            f.write(encrypted.data)
+        os.rename(tmp_path, self.path)
+        return True
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hmac
+import json
+import hashlib
+import logging
+from os.path import join as os_join
+from passkeeper.crypt import Result
+from passkeeper.stats import STATS
+
+LOG = logging.getLogger(__name__)
+
+# Header of a decrypted chunk list
+MAGIC = b'passkeeper-chunks\n'
+
+# Gear hash table of the content-defined chunking, same on all versions
+GEAR = [int(hashlib.sha256(('passkeeper-gear-%d' % i).encode('ascii'))
+            .hexdigest()[:8], 16) for i in range(256)]
+
+# Chunk boundaries are only searched on this byte (1/256 of random bytes)
+ANCHOR = b'\x9d'
+
+
+def _mask(bits):
+    "Return a mask of the bits high bits of a gear hash"
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def cut_point(data, min_size, avg_size, max_size):
+    """
+    Return the length of the first chunk of data (bytearray).
+
+    The chunk ends after min_size bytes on an ANCHOR byte where the gear
+    rolling hash of the content has no bit of a mask set, or at max_size
+    bytes. The mask is larger before avg_size bytes and smaller after, so
+    most chunks are close to avg_size. Boundaries depend on the content
+    only, so an insertion changes only its chunk.
+
+    Anchors are found by bytes.find and the hash only depends on the
+    last 32 bytes, so only the 32 bytes before an anchor are hashed
+    instead of every byte.
+    """
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    bits = max(avg_size.bit_length() - 9, 1)
+    small_mask = _mask(bits + 1)
+    large_mask = _mask(bits - 1)
+    gear = GEAR
+    digest = 0
+    # Bytes before hashed are in digest
+    hashed = min_size
+    i = data.find(ANCHOR, min_size, end)
+    while i != -1:
+        if i - 31 > hashed:
+            # Older bytes are shifted out of the hash
+            hashed = i - 31
+            digest = 0
+        for byte in data[hashed:i + 1]:
+            digest = ((digest << 1) + gear[byte]) & 0xFFFFFFFF
+        hashed = i + 1
+        if not digest & (small_mask if i < avg_size else large_mask):
+            return i + 1
+        i = data.find(ANCHOR, hashed, end)
+    return end
+
+
+def chunk_stream(stream, min_size=262144, avg_size=1048576, max_size=4194304):
+    """
+    Yield content-defined chunks (bytes) of stream, see cut_point
+
+    :Example:
+
+    >>> with open('/opt/mypasskeeper/foo.raw/disk.img', 'rb') as f:
+    ...     sizes = [len(chunk) for chunk in chunk_stream(f)]
+    [1470384, 862199, 1230001, ...]
+    """
+    buffer = bytearray()
+    while True:
+        if len(buffer) < max_size:
+            buffer.extend(stream.read(max_size - len(buffer)))
+        if not buffer:
+            return
+        cut = cut_point(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def dump_list(names, size):
+    "Return the content of a chunk list"
+    return MAGIC + json.dumps({'version': 1,
+                               'size': size,
+                               'chunks': names}).encode('utf-8')
+
+
+def load_list(content):
+    "Return chunk names of a chunk list, None if content is not a list"
+    if not content.startswith(MAGIC):
+        return None
+    return json.loads(content[len(MAGIC):].decode('utf-8'))['chunks']
+
+
+class ChunkStore(object):
+    """
+    Encrypted chunks of big files.
+
+    A file is split in content-defined chunks. Each chunk is encrypted
+    in its own file named by a keyed hash (hmac sha256) of its content,
+    so a chunk shared by several files or versions is stored once and
+    names don't reveal the content. The encrypted file of the source
+    only contains the list of its chunks (see dump_list).
+
+    Chunks are between min_size and max_size bytes, avg_size on average :
+    a change, an insertion or a removal only changes the chunks it
+    touches. Each new chunk is encrypted on its own : the gnupg backend
+    runs gpg and derives the key once per chunk, the openpgp backend
+    derives the key once for all chunks.
+
+    :Example:
+
+    >>> store = ChunkStore('/opt/mypasskeeper/chunks', OpenPGPBackend(),
+    ...                    key=manifest.key)
+    >>> names, new_names = store.store('/opt/mypasskeeper/foo.raw/disk.img',
+    ...                                passphrase='secret')
+    >>> store.restore(names, '/tmp/disk.img', passphrase='secret')
+    """
+
+    min_size = 262144
+    avg_size = 1048576
+    max_size = 4194304
+
+    def __init__(self, directory, backend, key):
+        self.directory = directory
+        self.backend = backend
+        self.key = key
+        # Names of stored chunks
+        self._names = None
+
+    def path(self, name):
+        return os_join(self.directory, '%s.passkeeper' % name)
+
+    def names(self):
+        "Return the set of stored chunk names"
+        if self._names is None:
+            self._names = set()
+            if os.path.isdir(self.directory):
+                self._names = set(fname[:-len('.passkeeper')]
+                                  for fname in os.listdir(self.directory)
+                                  if fname.endswith('.passkeeper'))
+        return self._names
+
+    def chunk_name(self, chunk):
+        return hmac.new(self.key, chunk, hashlib.sha256).hexdigest()
+
+    def store(self, source, passphrase):
+        """
+        Encrypt chunks of source not already stored
+
+        :return: (chunk names of source, names of chunks written), None
+                 if a chunk can't be encrypted
+        """
+        stored = self.names()
+        names = []
+        new_names = []
+        with open(source, 'rb') as f:
+            for chunk in chunk_stream(f, self.min_size, self.avg_size,
+                                      self.max_size):
+                name = self.chunk_name(chunk)
+                names.append(name)
+                if name in stored or name in new_names:
+                    continue
+                encrypted = self.backend.encrypt_data(chunk, passphrase,
+                                                      armor=False)
+                if not encrypted.ok:
+                    LOG.error('Unable to encrypt chunk of %s - %s' % (
+                              source, encrypted.stderr))
+                    return None
+                self._write(self.path(name), encrypted.data)
+                new_names.append(name)
+        stored.update(new_names)
+        STATS.count('chunks', files=len(names), bytes=0)
+        LOG.debug('%s : %d chunk(s), %d new' % (source, len(names),
+                                                 len(new_names)))
+        return names, new_names
+
+    def _write(self, path, data):
+        "Write data in path, renamed once complete"
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created by another worker
+                pass
+        tmp_path = '%s.%d.tmp' % (path, id(data))
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def restore(self, names, output, passphrase):
+        """
+        Decrypt chunks names in output
+
+        :return: Result, output is unchanged if a chunk can't be decrypted
+        """
+        tmp_path = '%s.tmp' % output
+        try:
+            with open(tmp_path, 'wb') as out:
+                for name in names:
+                    try:
+                        with open(self.path(name), 'rb') as f:
+                            decrypted = self.backend.decrypt_data(f.read(),
+                                                                  passphrase)
+                    except IOError as e:
+                        return Result(ok=False, status='missing chunk',
+                                      stderr=str(e))
+                    if not decrypted.ok:
+                        return Result(ok=False, status=decrypted.status,
+                                      stderr=decrypted.stderr)
+                    out.write(decrypted.data)
+            os.rename(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return Result(ok=True, status='decryption ok')
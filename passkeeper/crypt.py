@@ -16,31 +16,397 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gnupg
+import os
+import shutil
 import logging
+import tempfile
+import functools
+import threading
+from io import BytesIO
+from os.path import basename, dirname
 from os.path import join as os_join
-from passkeeper.tools import *
+from passkeeper import openpgp
+from passkeeper.stats import STATS
 
 LOG = logging.getLogger(__name__)
 
-def encrypt(source, output, passphrase):
-    gpg = gnupg.GPG()
-    with open(source, 'rb') as f:
-        encrypted = gpg.encrypt_file(
-            f,
+
+def _measured(operation, data=False):
+    """
+    Decorator recording a backend method in phase crypt.<operation>
+    with the size of its source file (or data)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, source, *args, **kwargs):
+            if data:
+                size = len(source)
+            else:
+                try:
+                    size = os.path.getsize(source)
+                except OSError:
+                    size = 0
+            with STATS.phase('crypt.%s' % operation, files=1, bytes=size,
+                             processes=self.processes):
+                return method(self, source, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _close_on_exec(*fds):
+    """
+    Don't let gpg subprocesses inherit fds : python 2 Popen keeps them open,
+    a child holding the write end of a pipe would never let it reach the end
+    """
+    import fcntl
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+class NullSink(object):
+    "Output stream discarding written data, only counted"
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+
+class DecryptionError(Exception):
+    "Raised when an encrypted file read as a stream can't be decrypted"
+    pass
+
+
+class Result(object):
+    "Result of a backend operation, with the attributes of python-gnupg results"
+
+    def __init__(self, ok, status, data=b'', stderr=''):
+        self.ok = ok
+        self.status = status
+        self.data = data
+        self.stderr = stderr
+
+    def __nonzero__(self):
+        return self.ok
+    __bool__ = __nonzero__
+
+
+class Backend(object):
+    """
+    Crypto backend interface
+
+    Backends encrypt with a passphrase (AES256 symmetric OpenPGP) and
+    decrypt files, streams and bytes. Methods return results with ok,
+    status, stderr and data attributes like python-gnupg results.
+    Backends have to implement encrypt_stream and decrypt_stream.
+
+    Encrypted messages are ASCII armored unless armor is False. Decryption
+    handles both.
+    """
+
+    # Processes launched by each operation
+    processes = 0
+
+    def __init__(self, buffer_size=openpgp.BUFFER_SIZE):
+        self.buffer_size = buffer_size
+
+    def encrypt_stream(self, instream, outstream, passphrase, armor=True):
+        raise NotImplementedError()
+
+    def decrypt_stream(self, instream, outstream, passphrase):
+        raise NotImplementedError()
+
+    @_measured('encrypt_data', data=True)
+    def encrypt_data(self, data, passphrase, armor=True):
+        out = BytesIO()
+        encrypted = self.encrypt_stream(BytesIO(data), out, passphrase,
+                                        armor=armor)
+        encrypted.data = out.getvalue()
+        return encrypted
+
+    @_measured('decrypt_data', data=True)
+    def decrypt_data(self, data, passphrase):
+        out = BytesIO()
+        decrypted = self.decrypt_stream(BytesIO(data), out, passphrase)
+        decrypted.data = out.getvalue()
+        return decrypted
+
+    def _to_file(self, stream_method, source, output, *args, **kwargs):
+        """
+        Call stream_method from source file to a temporary file renamed
+        in output on success. Nothing is written in output on failure.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(output) or '.',
+                                        prefix='.%s.' % basename(output))
+        try:
+            with open(source, 'rb') as f:
+                with os.fdopen(fd, 'wb') as out:
+                    result = stream_method(f, out, *args, **kwargs)
+            if result.ok:
+                os.rename(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return result
+
+    @_measured('encrypt')
+    def encrypt(self, source, output, passphrase, armor=True):
+        return self._to_file(self.encrypt_stream, source, output, passphrase,
+                             armor=armor)
+
+    @_measured('decrypt')
+    def decrypt(self, source, output, passphrase):
+        return self._to_file(self.decrypt_stream, source, output, passphrase)
+
+    def _reencrypt_stream(self, instream, outstream, passphrase,
+                          new_passphrase, armor=True):
+        """
+        Decrypt instream in a pipe read by encrypt_stream in outstream : the
+        plaintext only goes through the buffers of the pipe
+        """
+        read_fd, write_fd = os.pipe()
+        _close_on_exec(read_fd, write_fd)
+        results = {}
+
+        def _decrypt():
+            try:
+                with os.fdopen(write_fd, 'wb') as pipe:
+                    results['decrypted'] = self.decrypt_stream(instream, pipe,
+                                                               passphrase)
+            except (IOError, OSError) as e:
+                # The reader closed the pipe on an encryption failure
+                results['decrypted'] = Result(ok=False,
+                                              status='decryption failed',
+                                              stderr=str(e))
+
+        thread = threading.Thread(target=_decrypt)
+        thread.start()
+        try:
+            with os.fdopen(read_fd, 'rb') as pipe:
+                encrypted = self.encrypt_stream(pipe, outstream,
+                                                new_passphrase, armor=armor)
+        finally:
+            thread.join()
+        decrypted = results['decrypted']
+        if not decrypted.ok:
+            return Result(ok=False, status='decryption failed',
+                          stderr=decrypted.stderr)
+        return encrypted
+
+    @_measured('reencrypt')
+    def reencrypt(self, source, output, passphrase, new_passphrase,
+                  armor=True):
+        """
+        Encrypt the content of the encrypted file source with new_passphrase
+        in output, without the whole plaintext in memory or on disk
+        """
+        return self._to_file(self._reencrypt_stream, source, output,
+                             passphrase, new_passphrase, armor=armor)
+
+    @_measured('verify')
+    def verify(self, source, passphrase):
+        """
+        Decrypt source in a NullSink : check the passphrase and the
+        integrity (MDC) of the message without keeping the plaintext
+        """
+        with open(source, 'rb') as f:
+            return self.decrypt_stream(f, NullSink(), passphrase)
+
+
+class GnupgBackend(Backend):
+    """
+    Run gpg with python-gnupg. The GPG instance is shared by all calls.
+
+    encrypt and decrypt stream files through gpg, streams methods return
+    the output in memory.
+    """
+
+    processes = 1
+
+    def __init__(self, buffer_size=openpgp.BUFFER_SIZE):
+        Backend.__init__(self, buffer_size)
+        self._gpg = None
+        self._lock = threading.Lock()
+
+    @property
+    def gpg(self):
+        with self._lock:
+            if self._gpg is None:
+                import gnupg
+                self._gpg = gnupg.GPG()
+                self._gpg.buffer_size = self.buffer_size
+        return self._gpg
+
+    @_measured('encrypt_data', data=True)
+    def encrypt_data(self, data, passphrase, armor=True):
+        return self.gpg.encrypt(data,
             recipients=None,
             symmetric='AES256',
-            armor=True,
+            armor=armor,
+            passphrase=passphrase)
+
+    @_measured('decrypt_data', data=True)
+    def decrypt_data(self, data, passphrase):
+        return self.gpg.decrypt(data,
             passphrase=passphrase,
-            output=output)
-    return encrypted
+            always_trust=True)
 
+    def encrypt_stream(self, instream, outstream, passphrase, armor=True):
+        encrypted = self.gpg.encrypt_file(
+            instream,
+            recipients=None,
+            symmetric='AES256',
+            armor=armor,
+            passphrase=passphrase)
+        if encrypted.ok:
+            outstream.write(encrypted.data)
+        return encrypted
 
-def decrypt(source, output, passphrase):
-    gpg = gnupg.GPG()
-    with open(source, 'rb') as f:
-        decrypted = gpg.decrypt_file(f,
+    def decrypt_stream(self, instream, outstream, passphrase):
+        decrypted = self.gpg.decrypt_file(instream,
             passphrase=passphrase,
-            always_trust=True,
-            output=output)
-    return decrypted
+            always_trust=True)
+        if decrypted.ok:
+            outstream.write(decrypted.data)
+        return decrypted
+
+    @_measured('encrypt')
+    def encrypt(self, source, output, passphrase, armor=True):
+        with open(source, 'rb') as f:
+            encrypted = self.gpg.encrypt_file(
+                f,
+                recipients=None,
+                symmetric='AES256',
+                armor=armor,
+                passphrase=passphrase,
+                output=output)
+        return encrypted
+
+    @_measured('decrypt')
+    def decrypt(self, source, output, passphrase):
+        with open(source, 'rb') as f:
+            decrypted = self.gpg.decrypt_file(f,
+                passphrase=passphrase,
+                always_trust=True,
+                output=output)
+        return decrypted
+
+    @_measured('reencrypt')
+    def reencrypt(self, source, output, passphrase, new_passphrase,
+                  armor=True):
+        """
+        Run gpg decrypt and gpg encrypt connected by a named pipe in a
+        private temporary directory : python-gnupg keeps the output of
+        streams in memory, not the one of files
+        """
+        import fcntl
+        tmp_dir = tempfile.mkdtemp()
+        fifo = os_join(tmp_dir, 'plaintext')
+        try:
+            os.mkfifo(fifo, 0o600)
+            # Keep a writer until gpg decrypt exits : the reader neither
+            # blocks in open nor gets end of file before gpg opens the pipe
+            read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(fifo, os.O_WRONLY)
+            _close_on_exec(read_fd, write_fd)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            results = {}
+
+            def _decrypt():
+                try:
+                    with open(source, 'rb') as f:
+                        results['decrypted'] = self.gpg.decrypt_file(f,
+                            passphrase=passphrase,
+                            always_trust=True,
+                            output=fifo)
+                finally:
+                    os.close(write_fd)
+
+            thread = threading.Thread(target=_decrypt)
+            thread.start()
+            try:
+                with os.fdopen(read_fd, 'rb') as pipe:
+                    encrypted = self.gpg.encrypt_file(
+                        pipe,
+                        recipients=None,
+                        symmetric='AES256',
+                        armor=armor,
+                        passphrase=new_passphrase,
+                        output=output)
+            finally:
+                thread.join()
+        finally:
+            shutil.rmtree(tmp_dir)
+        decrypted = results.get('decrypted')
+        if decrypted is None or not decrypted.ok:
+            return Result(ok=False, status='decryption failed',
+                          stderr=getattr(decrypted, 'stderr', ''))
+        return encrypted
+
+    @_measured('verify')
+    def verify(self, source, passphrase):
+        # gpg writes the plaintext in /dev/null, nothing is read back
+        return self.decrypt(source, os.devnull, passphrase)
+
+
+class OpenPGPBackend(Backend):
+    """
+    Encrypt and decrypt in process, without gpg subprocess (see openpgp).
+
+    Messages are the same as the gpg ones. Streams are processed with
+    buffers of buffer_size bytes. The derived key of the passphrase is
+    computed once and reused for all encrypted files.
+
+    The cache lives as long as the backend and keeps the passphrase (as
+    a dict key) and its derived keys in memory. Files encrypted by one
+    backend share the same S2K salt : they can be recognized as encrypted
+    with the same passphrase, gpg uses a new salt per file. Each message
+    still has its own random prefix, so the same content gives different
+    messages. Use a new backend to get a new salt.
+    """
+
+    def __init__(self, buffer_size=openpgp.BUFFER_SIZE):
+        if not openpgp.available():
+            raise openpgp.OpenPGPError('The cryptography module is required '
+                                       'by the openpgp backend')
+        Backend.__init__(self, buffer_size)
+        self._keys = {}
+
+    def encrypt_stream(self, instream, outstream, passphrase, armor=True):
+        try:
+            openpgp.encrypt_stream(instream, outstream, passphrase,
+                                   armored=armor,
+                                   key_cache=self._keys,
+                                   buffer_size=self.buffer_size)
+        except openpgp.OpenPGPError as e:
+            return Result(ok=False, status='encryption failed', stderr=str(e))
+        return Result(ok=True, status='encryption ok')
+
+    def decrypt_stream(self, instream, outstream, passphrase):
+        try:
+            openpgp.decrypt_stream(instream, outstream, passphrase,
+                                   key_cache=self._keys,
+                                   buffer_size=self.buffer_size)
+        except openpgp.OpenPGPError as e:
+            return Result(ok=False, status='decryption failed', stderr=str(e))
+        return Result(ok=True, status='decryption ok')
+
+
+BACKENDS = {'gnupg': GnupgBackend,
+            'openpgp': OpenPGPBackend}
+
+
+def get_backend(name='gnupg', **kwargs):
+    "Return a new backend instance of backend name"
+    return BACKENDS[name](**kwargs)
+
+
+def encrypt(source, output, passphrase):
+    return GnupgBackend().encrypt(source, output, passphrase)
+
+
+def decrypt(source, output, passphrase):
+    return GnupgBackend().decrypt(source, output, passphrase)
@@ -16,48 +16,188 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import logging
+import subprocess
+from collections import Counter
 from os.path import join as os_join
-from passkeeper.tools import *
+from passkeeper.stats import STATS
 
 LOG = logging.getLogger(__name__)
 
 class Git(object):
+    """
+    Git repository of a passkeeper directory.
+
+    Git is launched without shell from the passkeeper directory. Files are
+    added and removed with one ``update-index --stdin`` command reading
+    all paths, so the number of launched commands does not depend on the
+    number of files.
+    """
+
+    # git config written by init
+    config = (('user', 'name', 'passkeeper'),
+              ('user', 'email', 'you@example.com'))
 
     def __init__(self, directory):
         self.directory = directory
+        # Number of launched git commands by operation (add, rm, ...)
+        self.command_count = Counter()
+
+    def command(self, args):
+        "Return the git command line of args, run in the directory"
+        return ['git', '--work-tree=.', '--git-dir=.git'] + list(args)
+
+    def _run_git_cmd(self, args, input=None, check=True, output=False):
+        """
+        Run a git command in the passkeeper directory.
+
+        :param args: git command and its arguments
+        :type args: list
+        :param input: Data written on the command stdin
+        :type input: bytes
+        :param check: Raise an exception if the command failed
+        :type check: bool
+        :param output: Return the command stdout instead of its return code
+        :type output: bool
+        :return: return code of the command, or its stdout (bytes)
+        """
+        git_cmd = self.command(args)
+        LOG.debug('Launch : %s' % ' '.join(git_cmd))
+        self.command_count[args[0]] += 1
+        with STATS.phase('git.%s' % args[0], processes=1):
+            process = subprocess.Popen(git_cmd, cwd=self.directory,
+                                       stdin=subprocess.PIPE
+                                       if input is not None else None,
+                                       stdout=subprocess.PIPE
+                                       if output else None)
+            stdout, _ = process.communicate(input)
+        if check and process.returncode != 0:
+            LOG.critical('Command ERROR %s return code : %d' % (
+                         ' '.join(git_cmd), process.returncode))
+            raise Exception('Unable to execute command')
+        if output:
+            return stdout
+        return process.returncode
+
+    def _update_index(self, options, files):
+        """
+        Update the git index of files with one command.
+
+        Paths are given on stdin, separated by NUL characters.
+
+        :Example:
 
-    def _run_git_cmd(self, command):
-        work_tree = self.directory
-        git_dir = os_join(self.directory, '.git')
-        git_cmd = 'git --work-tree=%s  --git-dir=%s %s' % (work_tree,
-                                                           git_dir, command)
-        LOG.debug('Launch : %s' % git_cmd)
-        run_cmd(git_cmd)
+        >>> git._update_index(['--add'], ['foo', 'bar'])
+        Launch : git --work-tree=. --git-dir=.git update-index --add -z --stdin
+        """
+        if not files:
+            return
+        paths = ''.join('%s\0' % path for path in files)
+        STATS.count('git.update-index', files=len(files))
+        self._run_git_cmd(['update-index'] + options + ['-z', '--stdin'],
+                          input=paths.encode('utf-8'))
+
+    def _expand_dirs(self, files):
+        """
+        Replace directories by their encrypted files (*.passkeeper).
+
+        Unlike git add, .gitignore is not read : temporary files left in
+        directories (.name.XXXXXX, *.rekey.tmp, *.tmp) are not added.
+        """
+        for path in files:
+            full_path = os_join(self.directory, path)
+            if not os.path.isdir(full_path):
+                yield path
+                continue
+            for root, dirs, names in os.walk(full_path):
+                dirs.sort()
+                relative = os.path.relpath(root, self.directory)
+                for name in sorted(names):
+                    if name.endswith('.passkeeper'):
+                        yield os_join(relative, name)
+
+    def _remove_files(self, files):
+        "Remove files from the work tree and their empty directories"
+        top = os.path.normpath(self.directory)
+        for path in files:
+            path = os_join(top, path)
+            if os.path.lexists(path):
+                os.remove(path)
+            parent = os.path.dirname(path)
+            while parent != top:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+    def _write_config(self):
+        "Append passkeeper git config, return False if already configured"
+        config_path = os_join(self.directory, '.git', 'config')
+        with open(config_path) as f:
+            config = f.read()
+        sections = set(section for section, _, _ in self.config)
+        if any('[%s]' % section in config for section in sections):
+            return False
+        LOG.debug('Write git config')
+        with open(config_path, 'a') as f:
+            for section in sorted(sections):
+                f.write('[%s]\n' % section)
+                for name, key, value in self.config:
+                    if name == section:
+                        f.write('\t%s = %s\n' % (key, value))
+        return True
 
     def init(self):
-        self._run_git_cmd('init')
-        self._run_git_cmd('config user.name passkeeper')
-        self._run_git_cmd('config user.email you@example.com')
+        self._run_git_cmd(['init'])
+        if not self._write_config():
+            for section, key, value in self.config:
+                self._run_git_cmd(['config', '%s.%s' % (section, key), value])
 
     def add(self, files):
-        for file in files:
-            self._run_git_cmd('add %s' % file)
+        self._update_index(['--add'], list(self._expand_dirs(files)))
 
     def soft_remove(self, files):
-        for file in files:
-            self._run_git_cmd('rm --cached %s' % file)
+        self._update_index(['--force-remove'], files)
 
     def force_remove(self, files):
-        for file in files:
-            self._run_git_cmd('rm --force %s' % file)
+        self._remove_files(files)
+        self._update_index(['--force-remove'], files)
+
+    def _modified_files(self, files):
+        "Return files of files changed in the work tree or index since HEAD"
+        stdout = self._run_git_cmd(['diff-index', '--name-only', '-z', 'HEAD'],
+                                   output=True)
+        changed = set(stdout.decode('utf-8').split('\0'))
+        return [path for path in files if path in changed]
 
     def remove(self, files):
-        for file in files:
-            self._run_git_cmd('rm %s' % file)
+        """
+        Remove files from the work tree and the index. Like git rm, nothing
+        is removed if a file has local modifications (see force_remove)
+        """
+        modified = self._modified_files(files)
+        if modified:
+            LOG.critical('Files with local modifications : %s'
+                         % ' '.join(modified))
+            raise Exception('Unable to remove modified files')
+        self._remove_files(files)
+        self._update_index(['--remove'], files)
+
+    def ls_files(self):
+        "Return files of the git index, relative to the directory"
+        stdout = self._run_git_cmd(['ls-files', '-z'], output=True)
+        return [path for path in stdout.decode('utf-8').split('\0') if path]
 
     def commit(self, message):
-        self._run_git_cmd('commit -m "%s" || true' % message)
+        # Nothing to commit is not an error
+        self._run_git_cmd(['commit', '-m', message], check=False)
+
+    def gc(self):
+        "Pack objects and refs in a few files, drop reflogs and loose objects"
+        self._run_git_cmd(['reflog', 'expire', '--expire=now', '--all'])
+        self._run_git_cmd(['gc', '--prune=now', '--quiet'])
 
     def add_gitignore(self, lines):
         LOG.debug('Write .gitignore')
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import logging
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+from passkeeper.search import is_literal, parse_ini
+
+LOG = logging.getLogger(__name__)
+
+
+def ngrams(text, size):
+    "Return the set of substrings of text of length size"
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+class SearchIndex(object):
+    """
+    Encrypted index of ini files for search.
+
+    The index maps n-grams of lowercased section names and option values
+    to the locations (ini file, section) where they are found. A literal
+    pattern can only match in locations having all n-grams of the
+    pattern, so search decrypts only the ini files of these locations.
+
+    :Example:
+
+    >>> index = SearchIndex('/opt/mypasskeeper/index.passkeeper',
+    ...                     GnupgBackend())
+    >>> index.build([('default.ini', b'[foo]\\nurl = http://foo.com\\n')])
+    >>> index.save(passphrase='secret')
+    >>> index.load(passphrase='secret')
+    >>> index.candidates('http')
+    set(['default.ini'])
+    """
+
+    ngram_size = 3
+
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.files = []
+        # List of [file, section]
+        self.locations = []
+        # n-gram : list of location ids
+        self.postings = {}
+
+    def build(self, ini_files):
+        """
+        Build the index of ini files
+
+        :param ini_files: list of (ini file name, content)
+        """
+        self.files = sorted(name for name, content in ini_files)
+        self.locations = []
+        postings = {}
+        for name, content in sorted(ini_files):
+            try:
+                sections = parse_ini(content, name)
+            except ConfigParser.Error as e:
+                LOG.warning('Unable to index %s - %s' % (name, e))
+                continue
+            for section, section_lower, options in sections:
+                location_id = len(self.locations)
+                self.locations.append([name, section])
+                grams = ngrams(section_lower, self.ngram_size)
+                for _, _, value_lower in options:
+                    grams |= ngrams(value_lower, self.ngram_size)
+                for gram in grams:
+                    postings.setdefault(gram, []).append(location_id)
+        self.postings = postings
+
+    def load(self, passphrase):
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            decrypted = self.backend.decrypt_data(f.read(), passphrase)
+        if not decrypted.ok:
+            LOG.warning('Unable to read index %s' % self.path)
+            return False
+        try:
+            content = json.loads(decrypted.data.decode('utf-8'))
+            self.ngram_size = content['ngram']
+            self.files = content['files']
+            self.locations = content['locations']
+            self.postings = content['postings']
+        except (ValueError, KeyError, TypeError):
+            LOG.warning('Invalid index %s' % self.path)
+            return False
+        return True
+
+    def save(self, passphrase):
+        content = json.dumps({'version': 1,
+                              'ngram': self.ngram_size,
+                              'files': self.files,
+                              'locations': self.locations,
+                              'postings': self.postings},
+                             sort_keys=True)
+        encrypted = self.backend.encrypt_data(content.encode('utf-8'),
+                                              passphrase)
+        if not encrypted.ok:
+            LOG.error('Unable to write index %s - %s' % (self.path,
+                                                         encrypted.stderr))
+            return False
+        with open(self.path, 'wb') as f:
+            f.write(encrypted.data)
+        return True
+
+    def candidates(self, pattern):
+        """
+        Return ini files which can match pattern
+
+        :return: set of ini file names, None if the index can't be used
+                 for this pattern (regex or pattern shorter than n-grams)
+        """
+        pattern = pattern.lower()
+        if len(pattern) < self.ngram_size or not is_literal(pattern):
+            return None
+        location_ids = None
+        for gram in ngrams(pattern, self.ngram_size):
+            ids = set(self.postings.get(gram, []))
+            location_ids = ids if location_ids is None else location_ids & ids
+            if not location_ids:
+                return set()
+        return set(self.locations[i][0] for i in location_ids)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hmac
+import json
+import hashlib
+import binascii
+import logging
+from passkeeper.stats import STATS
+
+LOG = logging.getLogger(__name__)
+
+
+class Manifest(object):
+    """
+    Encrypted manifest of the encrypted source files.
+
+    For each source file (path relative to the passkeeper directory) the
+    manifest record size, mtime and a keyed hash (hmac sha256) of the
+    content. The hmac key is random and only stored in the encrypted
+    manifest.
+
+    :Example:
+
+    >>> manifest = Manifest('/opt/mypasskeeper/manifest.passkeeper',
+    ...                     GnupgBackend())
+    >>> manifest.load(passphrase='secret')
+    >>> changed, entry = manifest.check('default.ini',
+    ...                                 '/opt/mypasskeeper/default.ini')
+    >>> manifest.entries['default.ini'] = entry
+    >>> manifest.save(passphrase='secret')
+    """
+
+    block_size = 65536
+
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.key = None
+        self.entries = {}
+        self._loaded_entries = {}
+
+    @STATS.timed('manifest.load')
+    def load(self, passphrase):
+        self.key = os.urandom(32)
+        self.entries = {}
+        self._loaded_entries = {}
+        if not os.path.isfile(self.path):
+            LOG.debug('No manifest %s' % self.path)
+            return False
+        with open(self.path, 'rb') as f:
+            decrypted = self.backend.decrypt_data(f.read(), passphrase)
+        if not decrypted.ok:
+            LOG.warning('Unable to read manifest %s, all files will be '
+                        'encrypted' % self.path)
+            return False
+        try:
+            content = json.loads(decrypted.data.decode('utf-8'))
+            self.key = binascii.unhexlify(content['key'])
+            self.entries = content['files']
+        except (ValueError, KeyError, TypeError):
+            LOG.warning('Invalid manifest %s, all files will be '
+                        'encrypted' % self.path)
+            self.key = os.urandom(32)
+            self.entries = {}
+        self._loaded_entries = dict(self.entries)
+        return True
+
+    def modified(self):
+        "Return True if entries changed since load"
+        return self.entries != self._loaded_entries
+
+    @STATS.timed('manifest.save')
+    def save(self, passphrase):
+        content = json.dumps({'version': 1,
+                              'key': binascii.hexlify(self.key).decode('ascii'),
+                              'files': self.entries},
+                             sort_keys=True)
+        encrypted = self.backend.encrypt_data(content.encode('utf-8'),
+                                              passphrase)
+        if not encrypted.ok:
+            LOG.error('Unable to write manifest %s - %s' % (self.path,
+                                                            encrypted.stderr))
+            return False
+        with open(self.path, 'wb') as f:
+            f.write(encrypted.data)
+        self._loaded_entries = dict(self.entries)
+        return True
+
+    def hash_file(self, path):
+        digest = hmac.new(self.key, digestmod=hashlib.sha256)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def check(self, name, path, stat=None):
+        """
+        Check if a source file changed since the last encryption.
+
+        File content is hashed only if size or mtime changed.
+
+        :param name: Source file path relative to passkeeper directory
+        :type name: str
+        :param path: Source file path
+        :type path: str
+        :param stat: os.stat result of the file, read if None
+        :return: (changed, entry) entry is the new manifest entry of the file
+        """
+        if stat is None:
+            stat = os.stat(path)
+        entry = self.entries.get(name)
+        if (entry is not None
+        and entry['size'] == stat.st_size
+        and entry['mtime'] == stat.st_mtime):
+            return False, entry
+        with STATS.phase('manifest.hash', files=1, bytes=stat.st_size):
+            new_entry = {'size': stat.st_size,
+                         'mtime': stat.st_mtime,
+                         'hash': self.hash_file(path)}
+        return entry is None or entry['hash'] != new_entry['hash'], new_entry
@@ -0,0 +1,765 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal in-process OpenPGP (RFC 4880) symmetric encryption.
+
+Only what passkeeper needs is implemented : messages encrypted with a
+passphrase (symmetric-key encrypted session key packet) and an integrity
+protected data packet (MDC), as written by ``gpg --symmetric``.
+The AES cipher comes from the optional ``cryptography`` module.
+
+Messages are encrypted and decrypted as streams, with buffers of
+buffer_size bytes, so memory usage doesn't depend on the message size.
+"""
+
+import os
+import bz2
+import zlib
+import time
+import base64
+import struct
+import hashlib
+import logging
+from io import BytesIO
+
+# cryptography classes, imported on first use (see available)
+Cipher = algorithms = CFB = default_backend = None
+
+LOG = logging.getLogger(__name__)
+
+# Packet tags
+TAG_SKESK = 3
+TAG_COMPRESSED = 8
+TAG_SED = 9
+TAG_MARKER = 10
+TAG_LITERAL = 11
+TAG_SEIPD = 18
+TAG_MDC = 19
+
+# Symmetric algorithms : key size
+CIPHER_KEY_SIZES = {7: 16,   # AES128
+                    8: 24,   # AES192
+                    9: 32}   # AES256
+CIPHER_AES256 = 9
+
+# S2K hash algorithms
+HASH_ALGOS = {1: 'md5',
+              2: 'sha1',
+              8: 'sha256',
+              9: 'sha384',
+              10: 'sha512',
+              11: 'sha224'}
+HASH_SHA256 = 8
+
+# Compression algorithms
+COMPRESS_NONE = 0
+COMPRESS_ZIP = 1
+COMPRESS_ZLIB = 2
+COMPRESS_BZIP2 = 3
+
+# Default coded S2K iteration count (65011712 bytes hashed, as gpg)
+S2K_COUNT = 255
+
+BLOCK_SIZE = 16
+
+# Default size of read buffers and partial body lengths
+BUFFER_SIZE = 65536
+
+# Modification detection code packet header (tag 19, length 20)
+MDC_HEADER = b'\xd3\x14'
+MDC_PACKET_SIZE = 22
+
+
+class OpenPGPError(Exception):
+    pass
+
+
+class BadPassphraseError(OpenPGPError):
+    pass
+
+
+def _byte(data):
+    if not data:
+        raise OpenPGPError('Truncated message')
+    return bytearray(data)[0]
+
+
+def _read_exact(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise OpenPGPError('Truncated message')
+    return data
+
+
+def _to_bytes(passphrase):
+    if isinstance(passphrase, bytes):
+        return passphrase
+    return passphrase.encode('utf-8')
+
+
+def available():
+    "Import the optional cryptography module, return False if missing"
+    global Cipher, algorithms, CFB, default_backend
+    if Cipher is None:
+        try:
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives.ciphers import algorithms
+        except ImportError:
+            return False
+        try:
+            # CFB is deprecated in modes since cryptography 43
+            from cryptography.hazmat.decrepit.ciphers.modes import CFB
+        except ImportError:
+            from cryptography.hazmat.primitives.ciphers.modes import CFB
+        from cryptography.hazmat.primitives.ciphers import Cipher
+    return True
+
+
+def _cipher(key, encrypt):
+    if not available():
+        raise OpenPGPError('The cryptography module is required by the '
+                           'openpgp backend')
+    cipher = Cipher(algorithms.AES(key), CFB(b'\0' * BLOCK_SIZE),
+                    backend=default_backend())
+    if encrypt:
+        return cipher.encryptor()
+    return cipher.decryptor()
+
+
+
+
+#
+# Readers
+#
+
+class _Reader(object):
+    """
+    Base of the stream readers.
+
+    read(size) return size bytes, less only at the end of the stream.
+    Subclasses implement _read_chunk, returning b'' at the end.
+    """
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._buffer = b''
+        self._eof = False
+
+    def _read_chunk(self, size):
+        raise NotImplementedError()
+
+    def read(self, size):
+        while len(self._buffer) < size and not self._eof:
+            chunk = self._read_chunk(size - len(self._buffer))
+            if chunk:
+                self._buffer += chunk
+            else:
+                self._eof = True
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def drain(self):
+        "Read up to the end of the stream"
+        while self.read(self.buffer_size):
+            pass
+
+
+class _StreamReader(_Reader):
+    "Read a file object, head are bytes already read from it"
+
+    def __init__(self, stream, head=b'', buffer_size=BUFFER_SIZE):
+        _Reader.__init__(self, buffer_size)
+        self._stream = stream
+        self._buffer = head
+
+    def _read_chunk(self, size):
+        return self._stream.read(max(size, self.buffer_size))
+
+
+class _ArmorReader(_Reader):
+    """
+    Decode an ASCII armored message.
+
+    The CRC24 checksum is ignored (RFC 9580), the integrity of the message
+    is checked by the modification detection code.
+    """
+
+    def __init__(self, stream, head=b'', buffer_size=BUFFER_SIZE):
+        _Reader.__init__(self, buffer_size)
+        self._stream = stream
+        self._text = head
+        self._base64 = b''
+        self._done = False
+        line = self._readline()
+        while line is not None and not line.startswith(b'-----BEGIN PGP '):
+            line = self._readline()
+        if line is None:
+            raise OpenPGPError('Invalid armor header')
+        # Skip armor headers
+        line = self._readline()
+        while line is not None and b': ' in line:
+            line = self._readline()
+        if line is None:
+            raise OpenPGPError('Invalid armor footer')
+        self._pending = line
+
+    def _readline(self):
+        "Return next stripped line, None at the end of the stream"
+        while b'\n' not in self._text:
+            chunk = self._stream.read(self.buffer_size)
+            if not chunk:
+                if not self._text:
+                    return None
+                line, self._text = self._text, b''
+                return line.strip()
+            self._text += chunk
+        line, self._text = self._text.split(b'\n', 1)
+        return line.strip()
+
+    def _read_chunk(self, size):
+        data = b''
+        while not self._done and len(data) < size:
+            if self._pending is not None:
+                line, self._pending = self._pending, None
+            else:
+                line = self._readline()
+            if line is None:
+                raise OpenPGPError('Invalid armor footer')
+            if (line.startswith(b'-----END')
+            or (line.startswith(b'=') and len(line) == 5)):
+                self._done = True
+                break
+            self._base64 += line
+            size_decoded = len(self._base64) - len(self._base64) % 4
+            data += base64.b64decode(self._base64[:size_decoded])
+            self._base64 = self._base64[size_decoded:]
+        return data
+
+
+def _read_new_length(reader):
+    "Return (length, partial) of a new format packet length"
+    first = _byte(reader.read(1))
+    if first < 192:
+        return first, False
+    if first < 224:
+        return ((first - 192) << 8) + _byte(reader.read(1)) + 192, False
+    if first == 255:
+        return struct.unpack('>I', _read_exact(reader, 4))[0], False
+    return 1 << (first & 0x1F), True
+
+
+class _PacketReader(_Reader):
+    "Read a packet body. A None length is an indeterminate length"
+
+    def __init__(self, reader, length, partial=False):
+        _Reader.__init__(self, reader.buffer_size)
+        self._reader = reader
+        self._length = length
+        self._partial = partial
+
+    def _read_chunk(self, size):
+        if self._length is None:
+            return self._reader.read(size)
+        while self._length == 0 and self._partial:
+            self._length, self._partial = _read_new_length(self._reader)
+        if self._length == 0:
+            return b''
+        data = _read_exact(self._reader, min(size, self._length))
+        self._length -= len(data)
+        return data
+
+
+class _DecryptReader(_Reader):
+    """
+    Decrypt the body of an integrity protected data packet.
+
+    The last 22 bytes (modification detection code packet) are kept back
+    and checked at the end of the stream. head is the encrypted prefix.
+    """
+
+    def __init__(self, body, key, head):
+        _Reader.__init__(self, body.buffer_size)
+        self._body = body
+        self._decryptor = _cipher(key, encrypt=False)
+        self._mdc = hashlib.sha1(self._decryptor.update(head))
+        self._tail = b''
+
+    def _read_chunk(self, size):
+        while True:
+            ciphertext = self._body.read(max(size, self.buffer_size))
+            if not ciphertext:
+                self._check_mdc()
+                return b''
+            data = self._tail + self._decryptor.update(ciphertext)
+            self._tail = data[-MDC_PACKET_SIZE:]
+            data = data[:-MDC_PACKET_SIZE]
+            if data:
+                self._mdc.update(data)
+                return data
+
+    def _check_mdc(self):
+        tail = self._tail + self._decryptor.finalize()
+        if len(tail) != MDC_PACKET_SIZE or tail[:2] != MDC_HEADER:
+            raise OpenPGPError('Missing modification detection code')
+        self._mdc.update(MDC_HEADER)
+        if self._mdc.digest() != tail[2:]:
+            raise OpenPGPError('Encrypted message has been manipulated')
+
+
+class _DecompressReader(_Reader):
+    "Decompress the body of a compressed data packet"
+
+    def __init__(self, body, algo):
+        _Reader.__init__(self, body.buffer_size)
+        self._body = body
+        if algo == COMPRESS_NONE:
+            self._decompressor = None
+        elif algo == COMPRESS_ZIP:
+            self._decompressor = zlib.decompressobj(-15)
+        elif algo == COMPRESS_ZLIB:
+            self._decompressor = zlib.decompressobj()
+        elif algo == COMPRESS_BZIP2:
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            raise OpenPGPError('Unsupported compression algorithm %d' % algo)
+
+    def _read_chunk(self, size):
+        if self._decompressor is None:
+            return self._body.read(size)
+        while True:
+            if isinstance(self._decompressor, bz2.BZ2Decompressor):
+                compressed = self._body.read(self.buffer_size)
+                if not compressed:
+                    return b''
+                data = self._decompressor.decompress(compressed)
+            else:
+                # Bound decompressed size to buffer_size
+                compressed = (self._decompressor.unconsumed_tail
+                              or self._body.read(self.buffer_size))
+                if not compressed:
+                    return self._decompressor.flush()
+                data = self._decompressor.decompress(compressed,
+                                                     self.buffer_size)
+            if data:
+                return data
+
+
+def read_packet(reader):
+    "Return (tag, body reader) of the next packet, (None, None) at the end"
+    ctb = reader.read(1)
+    if not ctb:
+        return None, None
+    ctb = _byte(ctb)
+    if not ctb & 0x80:
+        raise OpenPGPError('Invalid packet header')
+    if ctb & 0x40:
+        # New format
+        length, partial = _read_new_length(reader)
+        return ctb & 0x3F, _PacketReader(reader, length, partial)
+    # Old format
+    tag = (ctb >> 2) & 0x0F
+    length_type = ctb & 0x03
+    if length_type == 3:
+        return tag, _PacketReader(reader, None)
+    size, fmt = {0: (1, '>B'), 1: (2, '>H'), 2: (4, '>I')}[length_type]
+    length = struct.unpack(fmt, _read_exact(reader, size))[0]
+    return tag, _PacketReader(reader, length)
+
+
+def _read_all(reader):
+    data = b''
+    block = reader.read(reader.buffer_size)
+    while block:
+        data += block
+        block = reader.read(reader.buffer_size)
+    return data
+
+
+def read_packets(data):
+    """
+    Parse packets of data
+
+    :return: list of (tag, body)
+    """
+    reader = _StreamReader(BytesIO(data))
+    packets = []
+    tag, body = read_packet(reader)
+    while tag is not None:
+        packets.append((tag, _read_all(body)))
+        tag, body = read_packet(reader)
+    return packets
+
+
+#
+# Writers
+#
+
+class ArmorWriter(object):
+    """
+    Write written data ASCII armored in out.
+
+    The optional CRC24 checksum is not written (RFC 9580), the integrity
+    of the message is checked by the modification detection code.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self._buffer = b''
+        self.out.write(b'-----BEGIN PGP MESSAGE-----\n\n')
+
+    def _write_lines(self, data):
+        encoded = base64.b64encode(data)
+        for i in range(0, len(encoded), 64):
+            self.out.write(encoded[i:i + 64] + b'\n')
+
+    def write(self, data):
+        self._buffer += data
+        # 48 bytes are one line of 64 characters
+        size = len(self._buffer) - len(self._buffer) % 48
+        if size:
+            self._write_lines(self._buffer[:size])
+            self._buffer = self._buffer[size:]
+
+    def close(self):
+        self._write_lines(self._buffer)
+        self._buffer = b''
+        self.out.write(b'-----END PGP MESSAGE-----\n')
+
+
+def _new_length(length):
+    if length < 192:
+        return struct.pack('>B', length)
+    if length < 8384:
+        length -= 192
+        return struct.pack('>BB', (length >> 8) + 192, length & 0xFF)
+    return struct.pack('>BI', 255, length)
+
+
+def write_packet(tag, body):
+    "Return a new format packet"
+    return struct.pack('>B', 0xC0 | tag) + _new_length(len(body)) + body
+
+
+class PacketWriter(object):
+    """
+    Write a new format packet of unknown length in out.
+
+    The body is written in parts of the greatest power of 2 lower than
+    buffer_size (partial body lengths).
+    """
+
+    def __init__(self, out, tag, buffer_size=BUFFER_SIZE):
+        self.out = out
+        # The first partial length must be at least 512 bytes
+        self._power = max(9, min(30, buffer_size.bit_length() - 1))
+        self._buffer = b''
+        self.out.write(struct.pack('>B', 0xC0 | tag))
+
+    def write(self, data):
+        self._buffer += data
+        size = 1 << self._power
+        # Keep data for the last (not partial) length
+        while len(self._buffer) > size:
+            self.out.write(struct.pack('>B', 0xE0 | self._power)
+                           + self._buffer[:size])
+            self._buffer = self._buffer[size:]
+
+    def close(self):
+        self.out.write(_new_length(len(self._buffer)) + self._buffer)
+        self._buffer = b''
+
+
+class _EncryptWriter(object):
+    "Encrypt the body of an integrity protected data packet"
+
+    def __init__(self, out, key):
+        self.out = out
+        self._encryptor = _cipher(key, encrypt=True)
+        self._mdc = hashlib.sha1()
+        self.out.write(b'\x01')
+        # Random prefix, last 2 bytes repeated to check the key
+        prefix = bytearray(os.urandom(BLOCK_SIZE))
+        prefix += prefix[-2:]
+        self.write(bytes(prefix))
+
+    def write(self, data):
+        self._mdc.update(data)
+        self.out.write(self._encryptor.update(data))
+
+    def close(self):
+        self._mdc.update(MDC_HEADER)
+        self.out.write(self._encryptor.update(MDC_HEADER + self._mdc.digest())
+                       + self._encryptor.finalize())
+
+
+class _CompressWriter(object):
+    "Write a zip compressed data packet of indeterminate length, as gpg"
+
+    def __init__(self, out):
+        self.out = out
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -15)
+        self.out.write(b'\xa3' + struct.pack('>B', COMPRESS_ZIP))
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.out.write(compressed)
+
+    def close(self):
+        self.out.write(self._compressor.flush())
+
+
+#
+# String to key
+#
+
+def s2k(passphrase, hash_algo, salt, count, key_size):
+    """
+    Derive a key of key_size from passphrase (iterated and salted S2K)
+
+    :param salt: Salt or None for simple S2K
+    :param count: Coded iteration count or None for salted S2K
+    """
+    try:
+        hash_name = HASH_ALGOS[hash_algo]
+    except KeyError:
+        raise OpenPGPError('Unsupported S2K hash algorithm %s' % hash_algo)
+    data = (salt or b'') + _to_bytes(passphrase)
+    if count is None:
+        total = len(data)
+    else:
+        total = max((16 + (count & 15)) << ((count >> 4) + 6), len(data))
+    key = b''
+    preload = 0
+    while len(key) < key_size:
+        digest = hashlib.new(hash_name)
+        digest.update(b'\0' * preload)
+        # Hash data repeated until total bytes
+        block = data * max(1, 65536 // max(1, len(data)))
+        remaining = total
+        while block and remaining >= len(block):
+            digest.update(block)
+            remaining -= len(block)
+        digest.update(block[:remaining])
+        key += digest.digest()
+        preload += 1
+    return key[:key_size]
+
+
+def _parse_skesk(body):
+    body = bytearray(body)
+    if body[0] != 4:
+        raise OpenPGPError('Unsupported SKESK version %d' % body[0])
+    cipher_algo = body[1]
+    mode = body[2]
+    hash_algo = body[3]
+    if mode == 0:
+        salt, count, pos = None, None, 4
+    elif mode == 1:
+        salt, count, pos = bytes(body[4:12]), None, 12
+    elif mode == 3:
+        salt, count, pos = bytes(body[4:12]), body[12], 13
+    else:
+        raise OpenPGPError('Unsupported S2K mode %d' % mode)
+    return cipher_algo, hash_algo, salt, count, bytes(body[pos:])
+
+
+def _skesk(salt, count):
+    return write_packet(TAG_SKESK, struct.pack('>BBBB', 4, CIPHER_AES256, 3,
+                                               HASH_SHA256)
+                                   + salt + struct.pack('>B', count))
+
+
+def _session_key(skesks, passphrase, head, key_cache):
+    "Return the key of the first SKESK matching the encrypted prefix head"
+    for skesk in skesks:
+        cipher_algo, hash_algo, salt, count, esk = _parse_skesk(skesk)
+        if cipher_algo not in CIPHER_KEY_SIZES:
+            raise OpenPGPError('Unsupported cipher algorithm %d' % cipher_algo)
+        cache_key = (passphrase, cipher_algo, hash_algo, salt, count)
+        if key_cache is not None and cache_key in key_cache:
+            key = key_cache[cache_key]
+        else:
+            key = s2k(passphrase, hash_algo, salt, count,
+                      CIPHER_KEY_SIZES[cipher_algo])
+            if key_cache is not None:
+                key_cache[cache_key] = key
+        if esk:
+            # Encrypted session key
+            decryptor = _cipher(key, encrypt=False)
+            session = bytearray(decryptor.update(esk) + decryptor.finalize())
+            if session[0] not in CIPHER_KEY_SIZES:
+                continue
+            key = bytes(session[1:])
+        prefix = bytearray(_cipher(key, encrypt=False).update(head))
+        if prefix[-2:] == prefix[-4:-2]:
+            return key
+    raise BadPassphraseError('Bad passphrase')
+
+
+def _encryption_key(passphrase, key_cache):
+    """
+    Return (salt, key), reuse the cached ones of passphrase : messages
+    encrypted with the same key_cache share the salt of their SKESK
+    """
+    if key_cache is not None and ('encrypt', passphrase) in key_cache:
+        return key_cache[('encrypt', passphrase)]
+    salt = os.urandom(8)
+    key = s2k(passphrase, HASH_SHA256, salt, S2K_COUNT,
+              CIPHER_KEY_SIZES[CIPHER_AES256])
+    if key_cache is not None:
+        key_cache[('encrypt', passphrase)] = (salt, key)
+    return salt, key
+
+
+#
+# Messages
+#
+
+def _open_message(instream, buffer_size):
+    "Return a reader of the binary message, armored or not"
+    head = instream.read(buffer_size)
+    if is_armored(head):
+        return _ArmorReader(instream, head, buffer_size)
+    return _StreamReader(instream, head, buffer_size)
+
+
+def _literal_reader(reader):
+    "Return a reader of the literal data"
+    while True:
+        tag, body = read_packet(reader)
+        if tag is None:
+            raise OpenPGPError('No literal data')
+        if tag == TAG_MARKER:
+            body.drain()
+        elif tag == TAG_COMPRESSED:
+            algo = _byte(body.read(1))
+            return _literal_reader(_DecompressReader(body, algo))
+        elif tag == TAG_LITERAL:
+            # Skip format, file name and date
+            name_length = bytearray(_read_exact(body, 2))[1]
+            _read_exact(body, name_length + 4)
+            return body
+        else:
+            raise OpenPGPError('Unexpected packet %d' % tag)
+
+
+def decrypt_stream(instream, outstream, passphrase, key_cache=None,
+                   buffer_size=BUFFER_SIZE):
+    """
+    Decrypt a symmetric encrypted message from instream to outstream
+
+    Message can be armored or binary. OpenPGPError is raised at the end of
+    the message if the modification detection code doesn't match, so
+    written data must be discarded on error.
+
+    :param key_cache: dict used to cache derived keys
+    """
+    reader = _open_message(instream, buffer_size)
+    skesks = []
+    while True:
+        tag, body = read_packet(reader)
+        if tag is None:
+            raise OpenPGPError('Not a symmetric encrypted message')
+        if tag == TAG_SKESK:
+            skesks.append(_read_all(body))
+        elif tag == TAG_SED:
+            raise OpenPGPError('Message was not integrity protected')
+        elif tag == TAG_SEIPD:
+            break
+        else:
+            body.drain()
+    if not skesks:
+        raise OpenPGPError('Not a symmetric encrypted message')
+    if _byte(body.read(1)) != 1:
+        raise OpenPGPError('Unsupported encrypted data version')
+
+    head = _read_exact(body, BLOCK_SIZE + 2)
+    key = _session_key(skesks, passphrase, head, key_cache)
+    decrypted = _DecryptReader(body, key, head)
+    literal = _literal_reader(decrypted)
+    block = literal.read(buffer_size)
+    while block:
+        outstream.write(block)
+        block = literal.read(buffer_size)
+    # Read up to the modification detection code
+    decrypted.drain()
+
+
+def encrypt_stream(instream, outstream, passphrase, armored=True,
+                   key_cache=None, buffer_size=BUFFER_SIZE):
+    """
+    Encrypt instream with AES256 and passphrase in outstream
+
+    Message format is the one of gpg --symmetric --cipher-algo AES256 :
+    SKESK (iterated and salted sha256 S2K), SEIPD with MDC, zip compressed
+    literal data.
+
+    :param key_cache: dict used to reuse a salt and derived key for
+                      the passphrase (the passphrase is a key of the dict)
+    """
+    salt, key = _encryption_key(passphrase, key_cache)
+    armor = ArmorWriter(outstream) if armored else None
+    out = armor or outstream
+    out.write(_skesk(salt, S2K_COUNT))
+    seipd = PacketWriter(out, TAG_SEIPD, buffer_size)
+    encrypted = _EncryptWriter(seipd, key)
+    compressed = _CompressWriter(encrypted)
+    literal = PacketWriter(compressed, TAG_LITERAL, buffer_size)
+    literal.write(b'b\x00' + struct.pack('>I', int(time.time())))
+    for block in iter(lambda: instream.read(buffer_size), b''):
+        literal.write(block)
+    for writer in [literal, compressed, encrypted, seipd, armor]:
+        if writer is not None:
+            writer.close()
+
+
+def decrypt_message(data, passphrase, key_cache=None):
+    "Return plaintext of an encrypted message (see decrypt_stream)"
+    out = BytesIO()
+    decrypt_stream(BytesIO(data), out, passphrase, key_cache=key_cache)
+    return out.getvalue()
+
+
+def encrypt_message(data, passphrase, armored=True, key_cache=None):
+    "Return encrypted message of data (see encrypt_stream)"
+    out = BytesIO()
+    encrypt_stream(BytesIO(data), out, passphrase, armored=armored,
+                   key_cache=key_cache)
+    return out.getvalue()
+
+
+def armor(data):
+    "Return ASCII armored data"
+    out = BytesIO()
+    writer = ArmorWriter(out)
+    writer.write(data)
+    writer.close()
+    return out.getvalue()
+
+
+def dearmor(text):
+    "Return binary data of an ASCII armored text"
+    return _read_all(_ArmorReader(BytesIO(text)))
+
+
+def is_armored(data):
+    return data.lstrip()[:15] == b'-----BEGIN PGP '
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+import logging
+from collections import namedtuple
+from os.path import join as os_join
+from passkeeper.stats import STATS
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+LOG = logging.getLogger(__name__)
+
+# A scanned file : full path and os.stat result
+FileInfo = namedtuple('FileInfo', ['path', 'stat'])
+
+
+class _Entry(object):
+    "os.DirEntry like object used without scandir"
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os_join(directory, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def _is_mode(self, test, follow_symlinks):
+        try:
+            return test(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_mode(stat.S_ISDIR, follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self._is_mode(stat.S_ISREG, follow_symlinks)
+
+
+def read_selection(path):
+    "Return the set of file names of a selection file, one per line"
+    with open(path, 'r') as f:
+        return set(name for name in f.read().splitlines() if name)
+
+
+def write_selection(path, names):
+    "Write file names in a selection file, one per line"
+    with open(path, 'w') as f:
+        f.write(''.join('%s\n' % name for name in sorted(names)))
+
+
+def scan_dir(directory):
+    "Return entries of directory, with os.scandir if available"
+    if scandir is not None:
+        return list(scandir(directory))
+    return [_Entry(directory, name) for name in os.listdir(directory)]
+
+
+class VaultScanner(object):
+    """
+    Inventory of a passkeeper directory, built with one scan.
+
+    Classify ini files, files of raw directories and encrypted files with
+    their stat result. Paths are relative to the passkeeper directory,
+    encrypted files are indexed by the relative path of their original
+    file (without the encrypted directory and the .passkeeper extension).
+
+    :Example:
+
+    >>> scanner = VaultScanner('/opt/mypasskeeper').scan()
+    >>> sorted(scanner.ini_files)
+    ['default.ini']
+    >>> scanner.old_encrypted_files()
+    ['old.ini']
+
+    After a selective decryption, selection_file lists the decrypted
+    files : other encrypted files are not decrypted, not removed.
+    """
+
+    def __init__(self, directory, encrypted_dir='encrypted',
+                 selection_file='.decrypted'):
+        self.directory = directory
+        self.encrypted_dir = encrypted_dir
+        self.selection_file = selection_file
+        self.selection_path = os_join(directory, selection_file)
+        # relative path : FileInfo
+        self.ini_files = {}
+        self.raw_files = {}
+        self.encrypted_files = {}
+        # relative paths of raw directories
+        self.raw_dirs = []
+        # Files decrypted by selective decryptions, None if all files are
+        self.selection = None
+
+    def _walk(self, directory, relative, files, suffix='', recursive=True):
+        "Add files of directory and sub directories ending with suffix"
+        for entry in scan_dir(directory):
+            name = os_join(relative, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    self._walk(entry.path, name, files, suffix)
+            elif entry.name.endswith(suffix) and entry.is_file():
+                files[name[:len(name) - len(suffix)]] = FileInfo(entry.path,
+                                                                 entry.stat())
+
+    @STATS.timed('scan')
+    def scan(self, raw=True):
+        """
+        Scan the directory. Return self
+
+        :param raw: Scan raw directories and encrypted raw files too
+        :type raw: bool
+        """
+        self.ini_files = {}
+        self.raw_files = {}
+        self.encrypted_files = {}
+        self.raw_dirs = []
+        self.selection = None
+        if not os.path.isdir(self.directory):
+            return self
+        for entry in scan_dir(self.directory):
+            if entry.name == self.selection_file and entry.is_file():
+                self.selection = read_selection(entry.path)
+            if entry.name.endswith('.ini') and entry.is_file():
+                self.ini_files[entry.name] = FileInfo(entry.path, entry.stat())
+            elif entry.name.endswith('.raw') and entry.is_dir():
+                self.raw_dirs.append(entry.name)
+                if raw:
+                    self._walk(entry.path, entry.name, self.raw_files)
+            elif entry.name == self.encrypted_dir and entry.is_dir():
+                self._walk(entry.path, '', self.encrypted_files,
+                           suffix='.passkeeper', recursive=raw)
+        self.raw_dirs.sort()
+        STATS.count('scan', files=len(self.ini_files) + len(self.raw_files)
+                    + len(self.encrypted_files))
+        LOG.debug('Scanned %d ini, %d raw and %d encrypted file(s)' % (
+                  len(self.ini_files), len(self.raw_files),
+                  len(self.encrypted_files)))
+        return self
+
+    def plain_files(self):
+        "Return ini and raw files"
+        files = dict(self.ini_files)
+        files.update(self.raw_files)
+        return files
+
+    def old_encrypted_files(self):
+        """
+        Return sorted encrypted files without original file, which have
+        been decrypted
+        """
+        old_files = (set(self.encrypted_files) - set(self.ini_files)
+                     - set(self.raw_files))
+        if self.selection is not None:
+            old_files &= self.selection
+        return sorted(old_files)
+
+    def not_decrypted(self, names):
+        """
+        Return sorted names without original file not decrypted by the
+        selective decryptions
+        """
+        if self.selection is None:
+            return []
+        return sorted(name for name in names
+                      if name not in self.selection
+                      and name not in self.ini_files
+                      and name not in self.raw_files)
+
+    def encrypted_ini_files(self):
+        "Return sorted encrypted ini files"
+        return sorted(name for name in self.encrypted_files
+                      if name.endswith('.ini') and '/' not in name)
+
+    def encrypted_path(self, name):
+        "Return the encrypted file path of an original file"
+        return os_join(self.directory, self.encrypted_dir,
+                       '%s.passkeeper' % name)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+import logging
+from collections import namedtuple
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+from passkeeper.tools import read_config_string
+
+LOG = logging.getLogger(__name__)
+
+# Characters making a search pattern a regex
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+# A matching section : ini file name, section name and list of
+# (option, value)
+Hit = namedtuple('Hit', ['file', 'section', 'options'])
+
+
+def is_literal(pattern):
+    "Return True if pattern contains no regex metacharacter"
+    return not REGEX_CHARS & set(pattern)
+
+
+def matcher(pattern):
+    """
+    Return a function searching pattern in lowercased text, as a substring
+    if pattern contains no regex metacharacter
+    """
+    pattern = pattern.lower()
+    if is_literal(pattern):
+        return lambda text: pattern in text
+    return re.compile(pattern).search
+
+
+def parse_ini(content, name):
+    """
+    Parse ini content in a list of sections
+
+    Each section is a (section, lowercased section, options) tuple and
+    options is a list of (option, value, lowercased value).
+
+    :param content: Ini file content
+    :type content: bytes
+    :param name: Name of the ini file in errors
+    :type name: str
+    """
+    config = ConfigParser.RawConfigParser()
+    read_config_string(config, content, name)
+    sections = []
+    for section in config.sections():
+        options = [(option, value, value.lower())
+                   for option, value in config.items(section)]
+        sections.append((section, section.lower(), options))
+    return sections
+
+
+def search_sections(name, sections, match):
+    "Yield Hit of sections (see parse_ini) of file name matching"
+    for section, section_lower, options in sections:
+        # Section name or value match ?
+        if (match(section_lower)
+        or any(match(value_lower) for _, _, value_lower in options)):
+            yield Hit(name, section, [(option, value)
+                                      for option, value, _ in options])
+
+
+def get_sections(name, sections, section):
+    "Yield Hit of sections (see parse_ini) of file name named section"
+    section = section.lower()
+    for name_section, section_lower, options in sections:
+        if section_lower == section:
+            yield Hit(name, name_section, [(option, value)
+                                           for option, value, _ in options])
+
+
+def search_files(files, pattern):
+    """
+    Search pattern in ini files parsed one at a time, yield Hit as they
+    are found. Only one file is kept in memory.
+
+    :param files: (name, content) of ini files, like a generator
+    :type files: iterable
+    :param pattern: Regex searched, case insensitive
+    :type pattern: str
+
+    :Example:
+
+    >>> for hit in search_files([('default.ini', b'[foo]\\nurl = foo.com\\n')],
+    ...                         'foo.com'):
+    ...     print(hit)
+    Hit(file='default.ini', section='foo', options=[('url', 'foo.com')])
+    """
+    match = matcher(pattern)
+    for name, content in files:
+        for hit in search_sections(name, parse_ini(content, name), match):
+            yield hit
+
+
+def get_files(files, section):
+    "Yield Hit of sections named section in ini files, see search_files"
+    for name, content in files:
+        for hit in get_sections(name, parse_ini(content, name), section):
+            yield hit
+
+
+class SearchEngine(object):
+    """
+    Parsed ini files for search.
+
+    Each ini file is parsed once in its own list of sections, so sections
+    with the same name in several files are all kept. A file is parsed
+    again only if its signature (for example size and mtime) changed.
+
+    :Example:
+
+    >>> engine = SearchEngine()
+    >>> engine.add_file('default.ini', b'[foo]\\nurl = http://foo.com\\n')
+    >>> engine.search('foo.com')
+    [Hit(file='default.ini', section='foo',
+         options=[('url', 'http://foo.com')])]
+    """
+
+    def __init__(self):
+        # file name : (signature, sections)
+        self.files = {}
+
+    def loaded(self, name, signature):
+        "Return True if file name is parsed with this signature"
+        return (name in self.files
+                and self.files[name][0] == signature)
+
+    def add_file(self, name, content, signature=None):
+        """
+        Parse an ini file, replacing the previous version
+
+        :param name: Ini file name
+        :type name: str
+        :param content: Ini file content
+        :type content: bytes
+        :param signature: Signature of the content, see loaded
+        """
+        LOG.info('Loading file %s' % name)
+        self.files[name] = (signature, parse_ini(content, name))
+
+    def keep_files(self, names):
+        "Forget files not in names"
+        for name in set(self.files) - set(names):
+            del self.files[name]
+
+    def search(self, pattern, names=None):
+        """
+        Search pattern in sections and values of parsed files
+
+        A pattern without regex metacharacter is searched as a substring.
+
+        :param pattern: Regex searched, case insensitive
+        :type pattern: str
+        :param names: Files searched, all if None
+        :type names: list
+        :return: list of Hit, sorted by file
+        """
+        match = matcher(pattern)
+        return [hit for name in sorted(self.files if names is None else names)
+                for hit in search_sections(name, self.files[name][1], match)]
+
+    def get(self, section):
+        """
+        Return sections named section, case insensitive
+
+        :return: list of Hit, sorted by file
+        """
+        return [hit for name in sorted(self.files)
+                for hit in get_sections(name, self.files[name][1], section)]
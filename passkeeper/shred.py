@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+import time
+import logging
+import subprocess
+from passkeeper.tools import run_pool
+from passkeeper.stats import STATS
+from os.path import join as os_join
+
+LOG = logging.getLogger(__name__)
+
+
+def which(command):
+    "Return the path of command in PATH, None if not found"
+    try:
+        from shutil import which as find_executable
+    except ImportError:
+        from distutils.spawn import find_executable
+    return find_executable(command)
+
+METHODS = ('auto', 'shred', 'python')
+
+
+class ShredError(Exception):
+    pass
+
+
+class ShredReport(object):
+    "Files, bytes, errors and time of a shred"
+
+    def __init__(self, method):
+        self.method = method
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.errors = []
+
+    def __str__(self):
+        return ('%d file(s), %d bytes in %.3fs (%s)'
+                % (self.files, self.bytes, self.seconds, self.method))
+
+
+class Shredder(object):
+    """
+    Overwrite and remove files.
+
+    Files are split in batches. With the shred method, each batch is one
+    ``shred`` command. With the python method, files are overwritten in
+    process with random data passes times, synced and unlinked. Batches
+    are run by jobs workers. The auto method use shred if available.
+
+    :Example:
+
+    >>> shredder = Shredder(jobs=4, passes=1)
+    >>> report = shredder.shred(['/opt/mypasskeeper/default.ini'])
+    >>> print(report)
+    1 file(s), 120 bytes in 0.004s (shred)
+    """
+
+    # Max length of paths in one shred command
+    max_args_length = 65536
+    block_size = 65536
+
+    def __init__(self, jobs=1, passes=3, method='auto', batch_size=256):
+        if method not in METHODS:
+            raise ShredError('Unknown shred method %s' % method)
+        self._method = method
+        self.jobs = jobs
+        self.passes = passes
+        self.batch_size = batch_size
+
+    @property
+    def method(self):
+        "Shred method, auto is resolved on first use"
+        if self._method == 'auto':
+            self._method = 'shred' if which('shred') else 'python'
+        return self._method
+
+    def _batches(self, paths):
+        "Split paths in batches, at least one per worker"
+        size = self.batch_size
+        if self.jobs > 1:
+            size = min(size, max(1, -(-len(paths) // self.jobs)))
+        batch = []
+        length = 0
+        for path in paths:
+            if batch and (len(batch) >= size
+                          or length + len(path) + 1 > self.max_args_length):
+                yield batch
+                batch = []
+                length = 0
+            batch.append(path)
+            length += len(path) + 1
+        if batch:
+            yield batch
+
+    def _shred_cmd(self, batch, remove, force):
+        cmd = ['shred', '-n', str(self.passes)]
+        if force:
+            cmd.append('-f')
+        if remove:
+            cmd.append('--remove')
+        LOG.debug('Exec command %s' % ' '.join(cmd + batch))
+        with STATS.phase('shred.cmd', files=len(batch), processes=1):
+            returncode = subprocess.call(cmd + ['--'] + batch)
+        if returncode != 0:
+            LOG.critical('Command ERROR %s' % ' '.join(cmd + batch))
+            # Files still present have not been shredded
+            return [path for path in batch
+                    if not remove or os.path.lexists(path)]
+        return []
+
+    def _overwrite(self, path, force):
+        "Overwrite file content passes times with random data"
+        if force and not os.access(path, os.W_OK):
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            for _ in range(self.passes):
+                f.seek(0)
+                remaining = size
+                while remaining > 0:
+                    block = min(self.block_size, remaining)
+                    f.write(os.urandom(block))
+                    remaining -= block
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _shred_python(self, batch, remove, force):
+        errors = []
+        for path in batch:
+            try:
+                self._overwrite(path, force)
+                if remove:
+                    os.remove(path)
+            except (IOError, OSError) as e:
+                LOG.critical('Unable to shred %s - %s' % (path, e))
+                errors.append(path)
+        return errors
+
+    def shred(self, paths, remove=True, force=False):
+        """
+        Shred files
+
+        Symbolic links are removed, not followed.
+
+        :param paths: Files to shred
+        :type paths: list
+        :param remove: Remove files after overwriting
+        :type remove: bool
+        :param force: Change permissions to allow writing
+        :type force: bool
+        :return: ShredReport
+        """
+        report = ShredReport(self.method)
+        start = time.time()
+        files = []
+        for path in paths:
+            try:
+                if os.path.islink(path):
+                    if remove:
+                        os.remove(path)
+                    continue
+                report.bytes += os.path.getsize(path)
+            except OSError as e:
+                LOG.critical('Unable to shred %s - %s' % (path, e))
+                report.errors.append(path)
+                continue
+            files.append(path)
+        report.files = len(files)
+
+        if self.method == 'shred':
+            func = lambda batch: self._shred_cmd(batch, remove, force)
+        else:
+            func = lambda batch: self._shred_python(batch, remove, force)
+        for errors in run_pool(func, list(self._batches(files)),
+                               jobs=self.jobs):
+            report.errors.extend(errors)
+
+        report.seconds = time.time() - start
+        STATS.count('shred', calls=1, seconds=report.seconds,
+                    files=report.files, bytes=report.bytes)
+        LOG.info('Shred %s' % report)
+        return report
+
+    def list_tree(self, directories):
+        """
+        List files to shred and directories to remove to remove directories
+
+        :return: (files, directories), sub directories first
+        """
+        files = []
+        dirs = []
+        for directory in directories:
+            for root, dnames, fnames in os.walk(directory, topdown=False):
+                for fname in fnames:
+                    LOG.info('Clean file %s' % fname)
+                    files.append(os_join(root, fname))
+                # Symbolic links to directories are listed in dnames
+                for dname in dnames:
+                    dpath = os_join(root, dname)
+                    if os.path.islink(dpath):
+                        files.append(dpath)
+                    else:
+                        dirs.append(dpath)
+            dirs.append(directory)
+        return files, dirs
+
+    def shred_tree(self, directories, files=()):
+        """
+        Shred all files of directories, remove these directories, and
+        shred extra files, all in one run
+
+        :param directories: Directories to remove
+        :type directories: list
+        :param files: Other files to shred
+        :type files: list
+        :return: ShredReport
+        """
+        tree_files, dirs = self.list_tree(directories)
+        files = list(files) + tree_files
+        report = self.shred(files, remove=True, force=True)
+        if report.errors:
+            raise ShredError('Unable to shred %d file(s)' % len(report.errors))
+        for dpath in dirs:
+            os.rmdir(dpath)
+        return report
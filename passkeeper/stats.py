@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import logging
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+# Counters of a phase
+COUNTERS = ('calls', 'seconds', 'files', 'bytes', 'processes')
+
+
+class Stats(object):
+    """
+    Wall time and counters of passkeeper phases.
+
+    A phase is a named step (encrypt, git.commit, crypt.encrypt, ...)
+    which records its calls, seconds, files, bytes and launched processes.
+    Phases nest, and phases run by several workers sum the time of each
+    worker, so seconds of phases overlap.
+
+    :Example:
+
+    >>> with STATS.phase('crypt.encrypt', files=1, bytes=42, processes=1):
+    ...     encrypt()
+    >>> print(STATS.table())
+    Phase            Calls   Seconds   Files   Bytes   Processes
+    crypt.encrypt        1     0.012       1      42           1
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Clear all phases and restart the total time"
+        with self._lock:
+            self.phases = OrderedDict()
+            self.start = time.time()
+
+    def count(self, name, calls=0, seconds=0, files=0, bytes=0, processes=0):
+        "Add counters to phase name"
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = dict.fromkeys(COUNTERS, 0)
+            phase['calls'] += calls
+            phase['seconds'] += seconds
+            phase['files'] += files
+            phase['bytes'] += bytes
+            phase['processes'] += processes
+
+    @contextmanager
+    def phase(self, name, files=0, bytes=0, processes=0):
+        "Record one call of phase name and its time"
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count(name, calls=1, seconds=time.time() - start,
+                       files=files, bytes=bytes, processes=processes)
+
+    def timed(self, name):
+        "Decorator recording each call of the function as phase name"
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        "Return phases and totals as a dict"
+        with self._lock:
+            phases = OrderedDict((name, dict(counters))
+                                 for name, counters in self.phases.items())
+        for counters in phases.values():
+            counters['seconds'] = round(counters['seconds'], 6)
+        return {'seconds': round(time.time() - self.start, 6),
+                'processes': sum(c['processes'] for c in phases.values()),
+                'phases': phases}
+
+    def table(self):
+        "Return the report as a text table"
+        report = self.report()
+        width = max([len('Phase')] + [len(name) for name in report['phases']])
+        line = '%-' + str(width) + 's %7s %10s %7s %12s %10s'
+        lines = [line % ('Phase', 'Calls', 'Seconds', 'Files', 'Bytes',
+                         'Processes')]
+        for name, c in report['phases'].items():
+            lines.append(line % (name, c['calls'], '%.3f' % c['seconds'],
+                                 c['files'], c['bytes'], c['processes']))
+        lines.append(line % ('total', '', '%.3f' % report['seconds'], '', '',
+                             report['processes']))
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        "Write the report in path as JSON"
+        import json
+        LOG.debug('Write stats in %s' % path)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+
+
+# Stats shared by all passkeeper modules
+STATS = Stats()
@@ -17,8 +17,12 @@
 
 import unittest2 as unittest
 
-import mox
-import stubout
+try:
+    import mox
+    import stubout
+except ImportError:
+    # python 3
+    from mox3 import mox, stubout
 
 class TestCase(unittest.TestCase):
     def setUp(self):
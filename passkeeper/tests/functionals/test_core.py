@@ -16,7 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import base as test_base
+from . import base as test_base
 
 
 import passkeeper
@@ -24,6 +24,9 @@ from passkeeper.tools import *
 from passkeeper.git import *
 from passkeeper.crypt import *
 from os.path import isfile, isdir
+import os
+import hashlib
+import sys
 import shutil
 
 
@@ -72,10 +75,26 @@ class CoreTestCase(test_base.TestCase):
         git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
         self.assertEquals(2, len(git_logs))
 
+        #
+        # Search in encrypted files without decrypting on disk
+        #
+        hits = pk.search('good website', passphrase='secret')
+        self.assertEquals(['foo'], [hit.section for hit in hits])
+        self.assertEquals('default.ini', hits[0].file)
+        self.assertTrue(('password', 'bar') in hits[0].options)
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+
+        #
+        # Decrypt files with a wrong passphrase
+        #
+        self.assertFalse(pk.decrypt(passphrase='wrong', jobs=2))
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+        self.assertFalse(isfile('.tox/foo/default.raw/ssh_id.rsa'))
+
         #
         # Decrypt files
         #
-        pk.decrypt(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret', jobs=2))
 
         self.assertTrue(isfile('.tox/foo/default.ini'))
         self.assertStringInFile(filename='.tox/foo/default.ini',
@@ -101,8 +120,16 @@ comments = bar is good website
         #
         # Encrypt files
         #
+        raw_encrypted = self._get_file_lines('.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper')
         pk.encrypt(passphrase='secret', commit_message='Add bar entry')
 
+        # Only changed files are encrypted again
+        self.assertEquals(raw_encrypted,
+                          self._get_file_lines('.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper'))
+        self.assertTrue(isfile('.tox/foo/manifest.passkeeper'))
+        self.assertStringInFile(filename='.tox/foo/manifest.passkeeper',
+                                pattern='BEGIN PGP MESSAGE')
+
         # all file should say
         self.assertTrue(isfile('.tox/foo/default.ini'))
         self.assertTrue(isfile('.tox/foo/default.raw/ssh_id.rsa'))
@@ -159,8 +186,9 @@ comments = bar is good website
         with open('.tox/foo/bar.raw/private', 'w') as f:
             f.write(sample_file)
 
-        # Encrypt files
-        pk.encrypt(passphrase='secret')
+        # Encrypt files with a pool of workers and the search index
+        self.assertTrue(pk.encrypt(passphrase='secret', jobs=4, index=True))
+        self.assertTrue(isfile('.tox/foo/index.passkeeper'))
         # Call cleanup ini files
         pk.remove_old_encrypted_files(force_remove=True)
         pk.cleanup()
@@ -174,6 +202,15 @@ comments = bar is good website
         self.assertStringInFile(filename='.tox/foo/encrypted/bar.raw/private.passkeeper',
                                 pattern='BEGIN PGP MESSAGE')
 
+        # Search with the index decrypts only bar.ini
+        hits = pk.search('bar is good', passphrase='secret')
+        self.assertEquals([('bar.ini', 'bar')],
+                          [(hit.file, hit.section) for hit in hits])
+        # Regex can't use the index, all files are decrypted
+        hits = pk.search('.* is good', passphrase='secret')
+        self.assertEquals([('bar.ini', 'bar'), ('default.ini', 'foo')],
+                          [(hit.file, hit.section) for hit in hits])
+
         # re Decrypt files
         pk.decrypt(passphrase='secret')
         self.assertTrue(isfile('.tox/foo/bar.ini'))
@@ -185,6 +222,37 @@ comments = bar is good website
 
 
 
+    def test_openpgp_backend(self):
+        """ Files encrypted by the openpgp backend are decrypted by gpg
+        and files encrypted by gpg are decrypted by the openpgp backend.
+        Raw files are stored binary"""
+        # init with gpg
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+
+        # Decrypt with openpgp backend
+        pk = passkeeper.Passkeeper(directory='.tox/foo',
+                                   backend=get_backend('openpgp'))
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertStringInFile(filename='.tox/foo/default.ini',
+                                pattern='foo is good website')
+        self.assertFalse(pk.decrypt(passphrase='wrong'))
+
+        # Encrypt with openpgp backend
+        with open('.tox/foo/default.raw/ssh_id.rsa', 'a') as f:
+            f.write('openpgp')
+        self.assertTrue(pk.encrypt(passphrase='secret', binary_raw=True))
+        self.assertFalse(self._string_in_file(filename='.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper',
+                                              pattern='BEGIN PGP MESSAGE'))
+        pk.cleanup()
+
+        # Decrypt with gpg
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertStringInFile(filename='.tox/foo/default.raw/ssh_id.rsa',
+                                pattern='openpgp')
+
+
     # Test flush history
     def test_flush_history(self):
         # init
@@ -219,12 +287,22 @@ comments = bar is good website
         self.assertStringInFile(filename='.tox/foo/.git/logs/HEAD',
                                 pattern='Add bar entry')
 
-        # flush
-        pk.flush_history()
+        # Temporary file left by an interrupted command
+        with open('.tox/foo/encrypted/bar.ini.passkeeper.rekey.tmp', 'w') as f:
+            f.write('foo')
+
+        # flush, packing objects first
+        loose_objects = [f for root, dirs, files in os.walk('.tox/foo/.git')
+                         for f in files]
+        report = pk.flush_history(pack=True)
+        self.assertTrue(report.files < len(loose_objects))
+        self.assertTrue(report.bytes > 0)
 
         # Check files are still there
         self.assertTrue(isfile('.tox/foo/encrypted/default.ini.passkeeper'))
         self.assertTrue(isfile('.tox/foo/encrypted/bar.ini.passkeeper'))
+        self.assertFalse('encrypted/bar.ini.passkeeper.rekey.tmp'
+                         in pk.git.ls_files())
 
         # At this state we should have only one new commit (Clean history)
         git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
@@ -282,26 +360,334 @@ name = bar access
         self.assertTrue('Will remove bar.ini and bar.raw/*' in git_logs[-1])
 
         # Remove old files
-        pk.remove_old_encrypted_files(force_remove=True)
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/bar.raw/private.passkeeper'],
+                          pk.remove_old_encrypted_files(force_remove=True))
 
         # Call cleanup. file bar.passkeeped should be remove
         pk.cleanup()
 
-        # Should have a commit for file deleted
+        # Should have one commit for files deleted
         self.assertFalse(isfile('.tox/foo/encrypted/bar.ini.passkeeper'))
         self.assertTrue(isfile('.tox/foo/encrypted/default.ini.passkeeper'))
         self.assertFalse(isfile('.tox/foo/encrypted/bar.raw/private.passkeeper'))
         self.assertFalse(isdir('.tox/foo/encrypted/bar.raw'))
         git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
-        self.assertTrue('Remove file encrypted/bar.raw/private.passkeeper' in git_logs[-2])
-        self.assertTrue('Remove file encrypted/bar.ini.passkeeper' in git_logs[-1])
+        self.assertTrue('Will remove bar.ini and bar.raw/*' in git_logs[-2])
+        self.assertTrue('Remove 2 files' in git_logs[-1])
+
+
+    def test_bundle(self):
+        """ Ini files migrated in one bundle are decrypted, searched and
+        encrypted from the bundle, then migrated back in files"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        with open('.tox/foo/bar.ini', 'w') as f:
+            f.write('[bar]\nurl = http://bar.com\n')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        pk.cleanup()
+
+        # Migrate in bundle
+        self.assertFalse(pk.migrate(passphrase='wrong', layout='bundle'))
+        self.assertFalse(pk.bundled())
+        self.assertTrue(pk.migrate(passphrase='secret', layout='bundle'))
+        self.assertTrue(pk.bundled())
+        self.assertStringInFile(filename='.tox/foo/bundle.passkeeper',
+                                pattern='BEGIN PGP MESSAGE')
+        self.assertFalse(isfile('.tox/foo/encrypted/default.ini.passkeeper'))
+        self.assertFalse(isfile('.tox/foo/encrypted/bar.ini.passkeeper'))
+        self.assertTrue(isfile('.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper'))
+        git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
+        self.assertTrue('Migrate ini files to bundle layout' in git_logs[-1])
+
+        # Search in the bundle
+        hits = pk.search('bar.com', passphrase='secret')
+        self.assertEquals([('bar.ini', 'bar')],
+                          [(hit.file, hit.section) for hit in hits])
+
+        # Decrypt and encrypt a change in the bundle
+        self.assertFalse(pk.decrypt(passphrase='wrong'))
+        self.assertFalse(isfile('.tox/foo/bar.ini'))
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertStringInFile(filename='.tox/foo/bar.ini',
+                                pattern='bar.com')
+        self.assertTrue(isfile('.tox/foo/default.raw/ssh_id.rsa'))
+        os.remove('.tox/foo/bar.ini')
+        with open('.tox/foo/default.ini', 'a') as f:
+            f.write('[baz]\nurl = http://baz.com\n')
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        # Removed ini files stay in the bundle until confirmed
+        self.assertEquals([], pk.remove_old_encrypted_files(force_remove=True))
+        hits = pk.search('bar.com', passphrase='secret')
+        self.assertEquals(['bar.ini'], [hit.file for hit in hits])
+        self.assertEquals(['bundle.passkeeper:bar.ini'],
+                          pk.remove_old_encrypted_files(force_remove=True,
+                                                        passphrase='secret'))
+        git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
+        self.assertTrue('Remove file bundle.passkeeper:bar.ini' in git_logs[-1])
+        self.assertFalse(isfile('.tox/foo/encrypted/default.ini.passkeeper'))
+        pk.cleanup()
+        hits = pk.search('http', passphrase='secret')
+        self.assertEquals([('default.ini', 'baz'), ('default.ini', 'foo')],
+                          sorted((hit.file, hit.section) for hit in hits))
+
+        # Ini files not decrypted are kept in the bundle
+        create_dir('.tox/foo/new.raw')
+        with open('.tox/foo/new.raw/key', 'w') as f:
+            f.write('new key')
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        pk.cleanup()
+        hits = pk.search('http', passphrase='secret')
+        self.assertEquals([('default.ini', 'baz'), ('default.ini', 'foo')],
+                          sorted((hit.file, hit.section) for hit in hits))
+
+        # Migrate back in files
+        self.assertTrue(pk.migrate(passphrase='secret', layout='files'))
+        self.assertFalse(pk.bundled())
+        self.assertFalse(isfile('.tox/foo/bundle.passkeeper'))
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertStringInFile(filename='.tox/foo/default.ini',
+                                pattern='baz.com')
+        self.assertFalse(isfile('.tox/foo/bar.ini'))
+
+
+    def test_decrypt_selected(self):
+        """ Only files matching globs or ini files with a section matching
+        are decrypted"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        with open('.tox/foo/bar.ini', 'w') as f:
+            f.write('[bar]\nurl = http://bar.com\n')
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        pk.cleanup()
+
+        self.assertTrue(pk.decrypt(passphrase='secret', matching='bar.com'))
+        self.assertStringInFile(filename='.tox/foo/bar.ini', pattern='bar.com')
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+        self.assertFalse(isdir('.tox/foo/default.raw'))
+        pk.cleanup()
+
+        self.assertTrue(pk.decrypt(passphrase='secret',
+                                   patterns=['default.raw', 'd*.ini']))
+        self.assertTrue(isfile('.tox/foo/default.ini'))
+        self.assertTrue(isfile('.tox/foo/default.raw/ssh_id.rsa'))
+        self.assertFalse(isfile('.tox/foo/bar.ini'))
+        pk.cleanup()
+        self.assertFalse(pk.decrypt(passphrase='wrong', matching='bar.com'))
+        self.assertFalse(isfile('.tox/foo/bar.ini'))
+
+
+    def test_encrypt_selected(self):
+        """ Files not decrypted by a selective decryption are kept by
+        encrypt, only removed selected files are removed"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        with open('.tox/foo/other.ini', 'w') as f:
+            f.write('[other]\nurl = http://other.com\n')
+        self.assertTrue(pk.encrypt(passphrase='secret', index=True))
+        pk.cleanup()
+
+        def _edit(section):
+            self.assertTrue(pk.decrypt(passphrase='secret',
+                                       patterns=['default.ini']))
+            self.assertTrue(isfile('.tox/foo/.decrypted'))
+            with open('.tox/foo/default.ini', 'a') as f:
+                f.write('[%s]\nurl = http://%s.com\n' % (section, section))
+            self.assertTrue(pk.encrypt(passphrase='secret'))
+            self.assertEquals([], pk.remove_old_encrypted_files(
+                force_remove=True, passphrase='secret'))
+            pk.cleanup()
+            self.assertFalse(isfile('.tox/foo/.decrypted'))
+            self.assertTrue(isfile('.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper'))
+            hits = [(hit.file, hit.section)
+                    for hit in pk.search('http', passphrase='secret')]
+            self.assertTrue(('default.ini', section) in hits)
+            self.assertTrue(('other.ini', 'other') in hits)
+
+        _edit('baz')
+        self.assertTrue(isfile('.tox/foo/encrypted/other.ini.passkeeper'))
+        self.assertTrue(pk.migrate(passphrase='secret', layout='bundle'))
+        _edit('qux')
+        self.assertTrue(pk.verify(passphrase='secret').ok)
+
+        # Selected file removed
+        self.assertTrue(pk.decrypt(passphrase='secret', patterns=['other.ini']))
+        os.remove('.tox/foo/other.ini')
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        self.assertEquals(['bundle.passkeeper:other.ini'],
+                          pk.remove_old_encrypted_files(force_remove=True,
+                                                        passphrase='secret'))
+
+
+    @test_base.unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine')
+    def test_pipeline(self):
+        """ Encrypted files are staged and their sources shredded by the
+        pipeline, then old encrypted files are removed"""
+        from passkeeper.aio import AsyncPasskeeper, run
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        with open('.tox/foo/bar.ini', 'w') as f:
+            f.write('[bar]\nurl = http://bar.com\n')
+        os.remove('.tox/foo/default.raw/ssh_id.rsa')
+
+        scanner = pk.scan()
+        apk = AsyncPasskeeper(pk, jobs=2)
+        self.assertTrue(run(apk.encrypt(passphrase='secret', clean=True,
+                                        scanner=scanner)))
+        self.assertFalse(isfile('.tox/foo/bar.ini'))
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+        self.assertFalse(isdir('.tox/foo/default.raw'))
+        self.assertEquals(['encrypted/default.raw/ssh_id.rsa.passkeeper'],
+                          pk.remove_old_encrypted_files(force_remove=True,
+                                                        scanner=scanner))
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/default.ini.passkeeper',
+                           'manifest.passkeeper'],
+                          sorted(path for path in pk.git.ls_files()
+                                 if path.endswith('.passkeeper')))
+        self.assertTrue(pk.verify(passphrase='secret').ok)
+
+
+    def test_rekey(self):
+        """ Encrypted files are encrypted again with the new passphrase,
+        nothing is written in clear"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertTrue(pk.encrypt(passphrase='secret', binary_raw=True,
+                                   incremental=False, index=True))
+        pk.cleanup()
+
+        self.assertFalse(pk.rekey(passphrase='wrong', new_passphrase='new'))
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        pk.cleanup()
+
+        self.assertTrue(pk.rekey(passphrase='secret', new_passphrase='new'))
+        git_logs = self._get_file_lines(filename='.tox/foo/.git/logs/HEAD')
+        self.assertTrue('Change passphrase of 4 files' in git_logs[-1])
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+        self.assertStringInFile(filename='.tox/foo/encrypted/default.ini.passkeeper',
+                                pattern='BEGIN PGP MESSAGE')
+        with open('.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper', 'rb') as f:
+            self.assertFalse(b'BEGIN PGP MESSAGE' in f.read())
+        self.assertEquals([], [fname for fname in os.listdir('.tox/foo')
+                               if fname.endswith('.tmp')])
+
+        self.assertFalse(pk.decrypt(passphrase='secret'))
+        self.assertTrue(pk.decrypt(passphrase='new'))
+        self.assertStringInFile(filename='.tox/foo/default.ini',
+                                pattern='foo.com')
+        self.assertEquals(['default.ini'],
+                          [hit.file for hit in pk.search('foo.com',
+                                                         passphrase='new')])
+
+
+    def test_verify(self):
+        """ Encrypted files are decrypted without writing them, corrupted,
+        orphan and untracked files are reported"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+
+        report = pk.verify(passphrase='secret', jobs=2)
+        self.assertTrue(report.ok)
+        self.assertEquals(['encrypted/default.ini.passkeeper',
+                           'encrypted/default.raw/ssh_id.rsa.passkeeper',
+                           'manifest.passkeeper'],
+                          [check.path for check in report.checks])
+        self.assertFalse(isfile('.tox/foo/default.ini'))
+
+        self.assertFalse(pk.verify(passphrase='wrong').ok)
+
+        # File added by a full encryption is in the manifest
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        with open('.tox/foo/bar.ini', 'w') as f:
+            f.write('[bar]\nurl = http://bar.com\n')
+        self.assertTrue(pk.encrypt(passphrase='secret', incremental=False))
+        pk.cleanup()
+        report = pk.verify(passphrase='secret')
+        self.assertTrue(report.ok, report.lines())
+        self.assertEquals([], report.orphans)
+        self.assertTrue('encrypted/bar.ini.passkeeper'
+                        in [check.path for check in report.checks])
+
+        # Corrupted file
+        path = '.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper'
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'w') as f:
+            f.write(data.decode('utf-8').replace('\n\n', '\n\nAAAA', 1))
+        report = pk.verify(passphrase='secret')
+        self.assertFalse(report.ok)
+        self.assertEquals(['encrypted/default.raw/ssh_id.rsa.passkeeper'],
+                          [check.path for check in report.failed])
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        # Orphan and untracked encrypted file
+        shutil.copy('.tox/foo/encrypted/default.ini.passkeeper',
+                    '.tox/foo/encrypted/other.ini.passkeeper')
+        report = pk.verify(passphrase='secret')
+        self.assertFalse(report.ok)
+        self.assertEquals([], report.failed)
+        self.assertEquals(['encrypted/other.ini.passkeeper'], report.orphans)
+        self.assertEquals(['encrypted/other.ini.passkeeper'],
+                          report.untracked)
+
+
+    def test_chunks(self):
+        """ Big raw files are stored in deduplicated chunks, only changed
+        chunks are written and unused chunks are removed"""
+        pk = passkeeper.Passkeeper(directory='.tox/foo')
+        pk.init_dir(passphrase='secret')
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        # Known content, chunk boundaries are the same on each run
+        data = b''.join(hashlib.sha256(str(i).encode('ascii')).digest()
+                        for i in range(9 * 32768))
+        with open('.tox/foo/default.raw/disk.img', 'wb') as f:
+            f.write(data)
+        self.assertTrue(pk.encrypt(passphrase='secret', chunk_threshold=1048576))
+        chunks = set(os.listdir('.tox/foo/chunks'))
+        self.assertTrue(len(chunks) > 1)
+        # Small files are not chunked
+        self.assertStringInFile(
+            filename='.tox/foo/encrypted/default.raw/ssh_id.rsa.passkeeper',
+            pattern='BEGIN PGP MESSAGE')
+        self.assertTrue(os.path.getsize(
+            '.tox/foo/encrypted/default.raw/disk.img.passkeeper') < 4096)
+        pk.cleanup()
+
+        # Rebuilt by decrypt
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        with open('.tox/foo/default.raw/disk.img', 'rb') as f:
+            self.assertEquals(data, f.read())
+
+        # Insert at the start of the file, following chunks are kept
+        with open('.tox/foo/default.raw/disk.img', 'wb') as f:
+            f.write(b'foo' + data)
+        self.assertTrue(pk.encrypt(passphrase='secret', chunk_threshold=1048576))
+        new_chunks = set(os.listdir('.tox/foo/chunks'))
+        self.assertEquals(len(chunks) - 1, len(chunks & new_chunks))
+        self.assertEquals(len(chunks), len(new_chunks))
+
+        # Removed file, chunks are removed by the next encryption
+        os.remove('.tox/foo/default.raw/disk.img')
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        pk.remove_old_encrypted_files(force_remove=True)
+        self.assertTrue(pk.encrypt(passphrase='secret'))
+        self.assertFalse(isdir('.tox/foo/chunks'))
+        pk.cleanup()
+        self.assertTrue(pk.decrypt(passphrase='secret'))
+        self.assertTrue(isfile('.tox/foo/default.raw/ssh_id.rsa'))
 
 
 # Search in a file
 #        # Search in files
 #        elif args.search:
-#            config, matching = pk.search(args.search)
-#            pk.print_sections(config=config,
-#                              pattern=args.search,
-#                              matching_sections=matching)
+#            hits = pk.search(args.search)
+#            pk.print_sections(hits=hits,
+#                              pattern=args.search)
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import base as test_base
+
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from os.path import abspath, dirname, join as os_join
+from passkeeper.benchmark import HEAVY_MODULES
+
+ROOT = dirname(dirname(dirname(dirname(abspath(__file__)))))
+CLI = os_join(ROOT, 'passkeeper-cli')
+
+# Run passkeeper-cli then print loaded heavy modules
+LOADED_MODULES = """
+import sys
+sys.argv = ['passkeeper-cli'] + sys.argv[1:]
+try:
+    exec(compile(open(%r, 'rb').read(), 'passkeeper-cli', 'exec'),
+         {'__name__': '__main__'})
+except SystemExit:
+    pass
+sys.stderr.write('\\nmodules: ' + ' '.join(sorted(
+    name for name in sys.modules
+    if name in %r or name.split('.')[0] in %r)))
+"""
+
+# Heavy modules and modules only imported by the commands using them
+LAZY_MODULES = HEAVY_MODULES + ('passkeeper.agent',)
+
+
+class StartupTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(StartupTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(StartupTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _loaded_modules(self, *args):
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        process = subprocess.Popen([sys.executable, '-c',
+                                    LOADED_MODULES % (CLI, LAZY_MODULES,
+                                                    LAZY_MODULES)]
+                                   + list(args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=env)
+        stdout, stderr = process.communicate()
+        return stderr.decode('utf-8').split('modules:')[-1].split()
+
+    def test_lazy_imports(self):
+        # gpg, cryptography, the pool of workers, tarfile and the agent
+        # are not loaded when not needed
+        with open(os_join(self.tmp_dir, 'foo.ini'), 'w') as f:
+            f.write('[foo]\nurl = http://foo.com\n')
+
+        self.assertEquals([], self._loaded_modules('--help'))
+        # A search checks if an agent is running
+        self.assertEquals(['passkeeper.agent'],
+                          self._loaded_modules('-D', self.tmp_dir,
+                                               '-s', 'foo'))
+        self.assertEquals([], self._loaded_modules('-D', self.tmp_dir,
+                                                   '-s', 'foo', '--no-agent'))
+        self.assertEquals([], self._loaded_modules('-D', self.tmp_dir,
+                                                   '--clean'))
@@ -15,10 +15,34 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import unittest2 as unittest
+from mock import Mock
 
-import mox
-import stubout
+try:
+    import mox
+    import stubout
+except ImportError:
+    # python 3
+    from mox3 import mox, stubout
+
+# open patched by tests
+BUILTIN_OPEN = ('__builtin__.open' if sys.version_info[0] == 2
+                else 'builtins.open')
+
+def fake_backend():
+    """
+    Return a crypto backend mock "encrypting" data as is. Decryption
+    only succeeds with the passphrase 'secret'
+    """
+    backend = Mock()
+    backend.encrypt_data.side_effect = lambda data, passphrase, armor=True: \
+        Mock(ok=True, data=data, status='encryption ok')
+    backend.decrypt_data.side_effect = lambda data, passphrase: \
+        Mock(ok=passphrase == 'secret', data=data,
+             status='decryption ok' if passphrase == 'secret'
+             else 'decryption failed', stderr='bad')
+    return backend
 
 class TestCase(unittest.TestCase):
     def setUp(self):
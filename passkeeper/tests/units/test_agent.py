@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+import shutil
+import tempfile
+import threading
+from . import base as test_base
+from passkeeper.agent import Agent, AgentClient, AgentError, socket_path
+from passkeeper.search import Hit
+from mock import patch, Mock
+
+class AgentTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(AgentTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'agent', 'agent.sock')
+        self.passkeeper = Mock(directory='foo')
+
+        def load_encrypted(engine, passphrase, jobs=1):
+            if passphrase != 'secret':
+                return False
+            if not engine.files:
+                engine.add_file('bar.ini', b'[Foo]\nurl = http://foo.com\n')
+            return True
+        self.passkeeper.load_encrypted.side_effect = load_encrypted
+        self.agent = Agent(self.passkeeper, ttl=60, path=self.path)
+        self.client = AgentClient(self.path)
+
+    def tearDown(self):
+        super(AgentTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _serve(self):
+        thread = threading.Thread(target=self.agent.serve)
+        thread.start()
+        for _ in range(100):
+            if self.client.running():
+                break
+            thread.join(0.01)
+        return thread
+
+    @patch('passkeeper.agent.os.getuid')
+    def test_socket_path(self, mock_getuid):
+        mock_getuid.return_value = 1000
+        with patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1000'}):
+            path = socket_path('/opt/mypasskeeper')
+            self.assertTrue(path.startswith('/run/user/1000/passkeeper-1000/'))
+            self.assertEquals(path, socket_path('/opt/mypasskeeper/'))
+            self.assertNotEquals(path, socket_path('/opt/other'))
+
+    def test_unlock(self):
+        self.assertFalse(self.agent.unlock('wrong'))
+        self.assertRaises(AgentError, self.agent.serve)
+        self.assertTrue(self.agent.unlock('secret'))
+
+    def test_serve(self):
+        self.assertFalse(self.client.running())
+        self.agent.unlock('secret')
+        thread = self._serve()
+
+        # Socket readable by owner only
+        self.assertEquals(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEquals(0o700, stat.S_IMODE(
+            os.stat(os.path.dirname(self.path)).st_mode))
+        # A second agent can't use the socket
+        self.assertRaises(AgentError, Agent(self.passkeeper,
+                                            path=self.path)._listen)
+
+        hit = Hit('bar.ini', 'Foo', [('url', 'http://foo.com')])
+        self.assertEquals([hit], self.client.search('foo.COM'))
+        self.assertEquals([hit], self.client.get('foo'))
+        self.assertEquals([], self.client.get('fo'))
+        self.assertRaises(AgentError, self.client.request, 'unknown')
+        # Invalid regex answered as an error
+        self.assertRaises(AgentError, self.client.search, 'foo[')
+        self.assertTrue(self.client.running())
+        # So is an unreadable ini file
+        self.passkeeper.load_encrypted.side_effect = lambda engine, \
+            passphrase, jobs: engine.add_file('bad.ini', b'no section\n')
+        self.assertRaises(AgentError, self.client.search, 'foo')
+        self.assertTrue(self.client.running())
+
+        # Socket of another user or in an open directory is not used
+        with patch('passkeeper.agent.os.getuid', return_value=os.getuid() + 1):
+            self.assertFalse(self.client.running())
+            self.assertRaises(AgentError, self.client.search, 'foo')
+        os.chmod(os.path.dirname(self.path), 0o755)
+        self.assertFalse(self.client.running())
+        self.assertRaises(AgentError, self.client.stop)
+        os.chmod(os.path.dirname(self.path), 0o700)
+
+        self.client.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEquals(None, self.agent.engine)
+        self.assertFalse(self.client.running())
+
+    @patch('passkeeper.agent.os')
+    def test_serve_background(self, mock_os):
+        self.agent.serve = Mock()
+        mock_os.fork.return_value = 42
+        self.assertEquals(42, self.agent.serve_background())
+        self.assertFalse(self.agent.serve.called)
+
+        # Child detached from the terminal, without its stdio
+        mock_os.fork.return_value = 0
+        mock_os.open.return_value = 7
+        self.agent.serve_background()
+        mock_os.setsid.assert_called_once_with()
+        self.assertEquals([((7, 0),), ((7, 1),), ((7, 2),)],
+                          mock_os.dup2.call_args_list)
+        self.agent.serve.assert_called_once_with()
+        mock_os._exit.assert_called_once_with(0)
+
+    def test_ttl(self):
+        self.agent.unlock('secret')
+        self.agent.ttl = 0.2
+        thread = self._serve()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.path))
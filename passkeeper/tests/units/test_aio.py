@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from . import base as test_base
+from passkeeper.crypt import Result
+from mock import Mock, patch
+if sys.version_info >= (3, 5):
+    from passkeeper.aio import (AsyncPasskeeper, CommandError, CommandRunner,
+                               ShredStage, run)
+
+
+@test_base.unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine')
+class AioTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(AioTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(AioTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _passkeeper(self, tasks):
+        "Passkeeper mock with a git index reading paths on stdin"
+        pk = Mock(directory=self.tmp_dir, chunks_dir='chunks')
+        pk.git.directory = self.tmp_dir
+        pk.git.command.side_effect = lambda args: [
+            sys.executable, '-c', 'import sys; sys.stdin.read()']
+        scanner = pk._scanner.return_value
+        scanner.raw_dirs = []
+        scanner.selection = None
+        scanner.ini_files = dict((task[0], Mock(path=task[1]))
+                                 for task in tasks
+                                 if task[0].endswith('.ini'))
+        plan = pk._plan_encrypt.return_value
+        plan.tasks = tasks
+        plan.git_files = ['encrypted/%s.passkeeper' % task[0]
+                          for task in tasks]
+        plan.store_for.return_value = None
+        pk.shredder.batch_size = 256
+        pk.shredder.list_tree.return_value = ([], [])
+        pk.shredder.shred.side_effect = lambda paths, remove=True, \
+            force=False: Mock(errors=[])
+        return pk
+
+    def test_run(self):
+        runner = CommandRunner(jobs=2)
+        returncode, stdout, stderr = run(runner.run(
+            [sys.executable, '-c', 'import sys; print(sys.stdin.read())'],
+            input=b'foo'))
+        self.assertEquals((0, b'foo'), (returncode, stdout.strip()))
+        self.assertRaises(CommandError, run, runner.run(
+            [sys.executable, '-c', 'import sys; sys.exit(3)']))
+        returncode, stdout, stderr = run(runner.run(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'], check=False))
+        self.assertEquals(3, returncode)
+
+    def test_cleanup(self):
+        # Files are shredded in batches
+        pk = self._passkeeper([('bar.ini', 'foo/bar.ini', None, True)])
+        pk.shredder.batch_size = 2
+        pk.shredder.list_tree.return_value = (['foo/foo.raw/a',
+                                               'foo/foo.raw/bad',
+                                               'foo/foo.raw/b'],
+                                              [])
+        pk.shredder.shred.side_effect = lambda paths, remove, force: \
+            Mock(errors=[path for path in paths if path.endswith('bad')])
+        apk = AsyncPasskeeper(pk, jobs=1)
+
+        self.assertEquals(['foo/foo.raw/bad'], run(apk.cleanup()))
+        shredded = [path for args, kwargs in pk.shredder.shred.call_args_list
+                    for path in args[0]]
+        self.assertEquals(['foo/bar.ini', 'foo/foo.raw/a', 'foo/foo.raw/b',
+                           'foo/foo.raw/bad'], sorted(shredded))
+        self.assertTrue(all(len(args[0]) <= 2 for args, kwargs
+                            in pk.shredder.shred.call_args_list))
+
+        # Selection of a selective decryption shredded too
+        pk.shredder.shred.reset_mock()
+        pk.shredder.shred.side_effect = lambda paths, remove, force: \
+            Mock(errors=[])
+        pk.shredder.list_tree.return_value = ([], [])
+        scanner = pk._scanner.return_value
+        scanner.selection = set(['bar.ini'])
+        scanner.selection_path = os.path.join(self.tmp_dir, '.decrypted')
+        open(scanner.selection_path, 'w').close()
+        self.assertEquals([], run(apk.cleanup()))
+        shredded = [path for args, kwargs in pk.shredder.shred.call_args_list
+                    for path in args[0]]
+        self.assertEquals(sorted(['foo/bar.ini', scanner.selection_path]),
+                          sorted(shredded))
+
+    def test_encrypt_jobs(self):
+        # At most jobs files encrypted at once
+        tasks = [('%d.ini' % i, 'foo/%d.ini' % i, None, True)
+                 for i in range(6)]
+        pk = self._passkeeper(tasks)
+        lock = threading.Lock()
+        running = [0, 0]
+        def encrypt_file(task, passphrase, store):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            threading.Event().wait(0.05)
+            with lock:
+                running[0] -= 1
+            return Result(ok=True, status='')
+        pk._encrypt_file.side_effect = encrypt_file
+        run(AsyncPasskeeper(pk, jobs=2).encrypt('secret'))
+        self.assertEquals(2, running[1])
+        self.assertEquals(0, pk.shredder.shred.call_count)
+
+    def test_encrypt(self):
+        tasks = [('bar.ini', 'foo/bar.ini', 'foo/encrypted/bar.ini.passkeeper',
+                  True),
+                 ('foo.ini', 'foo/foo.ini', 'foo/encrypted/foo.ini.passkeeper',
+                  True),
+                 ('foo.raw/bla', 'foo/foo.raw/bla',
+                  'foo/encrypted/foo.raw/bla.passkeeper', True)]
+        pk = self._passkeeper(tasks)
+        pk._encrypt_file.side_effect = lambda task, passphrase, store: \
+            Result(ok=task[0] != 'foo.ini', status='')
+        pk._finish_encrypt.return_value = False
+        apk = AsyncPasskeeper(pk, jobs=2)
+
+        # Encrypted files are staged, then raw sources shredded
+        self.assertFalse(run(apk.encrypt('secret', clean=True)))
+        args, kwargs = pk._finish_encrypt.call_args
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/foo.raw/bla.passkeeper'],
+                          sorted(kwargs['staged']))
+        self.assertEquals([True, False, True],
+                          [result.ok for result in args[1]])
+        pk.shredder.shred.assert_called_once_with(['foo/foo.raw/bla'],
+                                                  True, True)
+
+        # Once all files are encrypted, other files are shredded
+        pk._finish_encrypt.reset_mock()
+        pk._finish_encrypt.return_value = True
+        pk.shredder.shred.reset_mock()
+        pk._encrypt_file.side_effect = lambda task, passphrase, store: \
+            Result(ok=True, status='')
+        self.assertTrue(run(apk.encrypt('secret', clean=True)))
+        args, kwargs = pk._finish_encrypt.call_args
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/foo.ini.passkeeper',
+                           'encrypted/foo.raw/bla.passkeeper'],
+                          sorted(kwargs['staged']))
+        shredded = [path for args, kwargs in pk.shredder.shred.call_args_list
+                    for path in args[0]]
+        self.assertEquals(['foo/bar.ini', 'foo/foo.ini', 'foo/foo.raw/bla'],
+                          sorted(shredded))
+
+    def test_encrypt_index(self):
+        # Ini sources are still readable when the index is written
+        ini_path = os.path.join(self.tmp_dir, 'bar.ini')
+        raw_path = os.path.join(self.tmp_dir, 'bla')
+        for path in [ini_path, raw_path]:
+            with open(path, 'w') as fd:
+                fd.write('[bar]\n')
+        tasks = [('bar.ini', ini_path, 'encrypted/bar.ini.passkeeper', True),
+                 ('foo.raw/bla', raw_path,
+                  'encrypted/foo.raw/bla.passkeeper', True)]
+        pk = self._passkeeper(tasks)
+        pk._encrypt_file.return_value = Result(ok=True, status='')
+        def shred(paths, remove=True, force=False):
+            for path in paths:
+                os.remove(path)
+            return Mock(errors=[])
+        pk.shredder.shred.side_effect = shred
+        contents = []
+        def finish_encrypt(plan, results, passphrase, **kwargs):
+            with open(ini_path) as fd:
+                contents.append(fd.read())
+            return True
+        pk._finish_encrypt.side_effect = finish_encrypt
+
+        self.assertTrue(run(AsyncPasskeeper(pk, jobs=2).encrypt(
+            'secret', index=True, clean=True)))
+        self.assertEquals(['[bar]\n'], contents)
+        self.assertTrue(pk._finish_encrypt.call_args[1]['index'])
+        self.assertFalse(os.path.exists(ini_path))
+        self.assertFalse(os.path.exists(raw_path))
+
+    def test_encrypt_error(self):
+        # The shred stage is drained and closed on error
+        tasks = [('foo.raw/bla', 'foo/foo.raw/bla',
+                  'foo/encrypted/foo.raw/bla.passkeeper', True)]
+        pk = self._passkeeper(tasks)
+        pk._encrypt_file.return_value = Result(ok=True, status='')
+        pk._finish_encrypt.side_effect = OSError('No such file')
+        with patch.object(ShredStage, 'close', autospec=True,
+                          side_effect=ShredStage.close) as close:
+            self.assertRaises(OSError, run, AsyncPasskeeper(pk, jobs=2).encrypt(
+                'secret', clean=True))
+        self.assertEquals(1, close.call_count)
+        pk.shredder.shred.assert_called_once_with(['foo/foo.raw/bla'],
+                                                  True, True)
+
+    def test_remove_old_encrypted_files(self):
+        pk = self._passkeeper([])
+        pk.encrypted_dir = 'encrypted'
+        scanner = pk._scanner.return_value
+        scanner.old_encrypted_files.return_value = ['bar.ini', 'foo.raw/bla']
+        scanner.encrypted_files = {
+            'bar.ini': Mock(path='foo/encrypted/bar.ini.passkeeper'),
+            'foo.raw/bla': Mock(path='foo/encrypted/foo.raw/bla.passkeeper')}
+        apk = AsyncPasskeeper(pk, jobs=2)
+
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/foo.raw/bla.passkeeper'],
+                          run(apk.remove_old_encrypted_files()))
+        pk.git.commit.assert_called_once_with('Remove 2 files')
+
+        # Nothing to remove
+        pk.git.commit.reset_mock()
+        scanner.old_encrypted_files.return_value = []
+        self.assertEquals([], run(apk.remove_old_encrypted_files()))
+        self.assertEquals(0, pk.git.commit.call_count)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import subprocess
+from . import base as test_base
+from passkeeper.benchmark import generate_vault, measure, run_benchmark
+from passkeeper.benchmark import SpawnCounter, OPERATIONS
+from mock import patch, Mock
+
+class BenchmarkTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(BenchmarkTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(BenchmarkTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_vault(self):
+        ini_files, raw_files = generate_vault(self.tmp_dir, ini_files=3,
+                                              sections=4, raw_files=3,
+                                              raw_sizes=(10, 20),
+                                              raw_per_dir=2, seed=1)
+        self.assertEquals(['bench-0.ini', 'bench-1.ini', 'bench-2.ini'],
+                          ini_files)
+        self.assertEquals(['bench-0.raw/file-0', 'bench-0.raw/file-1',
+                           'bench-1.raw/file-2'], raw_files)
+        with open(os.path.join(self.tmp_dir, 'bench-2.ini')) as f:
+            content = f.read()
+        self.assertEquals(4, content.count('password = '))
+        self.assertTrue('[site-2-3]' in content)
+        for name in raw_files:
+            size = os.path.getsize(os.path.join(self.tmp_dir, name))
+            self.assertTrue(size in (10, 20))
+
+        # Same seed same passwords
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_dir)
+        generate_vault(other_dir, ini_files=3, sections=4, raw_files=0, seed=1)
+        with open(os.path.join(other_dir, 'bench-2.ini')) as f:
+            self.assertEquals(content, f.read())
+
+    def test_spawn_counter(self):
+        execute_child = subprocess.Popen.__dict__['_execute_child']
+        with SpawnCounter() as spawns:
+            subprocess.call(['true'])
+            subprocess.call(['true'])
+        subprocess.call(['true'])
+
+        self.assertEquals(2, spawns.count)
+        # Popen is restored
+        self.assertEquals(execute_child,
+                          subprocess.Popen.__dict__['_execute_child'])
+
+    def test_measure(self):
+        result, measures = measure('true', subprocess.call, ['true'])
+
+        self.assertEquals(0, result)
+        self.assertEquals('true', measures['operation'])
+        self.assertEquals(1, measures['spawns'])
+        self.assertTrue(measures['wall'] > 0)
+        self.assertTrue(measures['cpu'] >= measures['cpu_children'])
+        self.assertTrue(measures['peak_rss_kb'] > 0)
+
+    @patch('passkeeper.benchmark.Passkeeper')
+    def test_run_benchmark(self, mock_passkeeper):
+        directory = os.path.join(self.tmp_dir, 'vault')
+        os.mkdir(directory)
+        pk = mock_passkeeper.return_value
+        pk.crypt = Mock()
+        pk.shredder = Mock(method='python')
+
+        report = run_benchmark(directory, passphrase='secret', ini_files=5,
+                               sections=1, raw_files=5, jobs=2,
+                               remove_ratio=0.2, seed=1)
+
+        # Each operation measured in order
+        self.assertEquals(list(OPERATIONS),
+                          [r['operation'] for r in report['results']])
+        pk.init_dir.assert_called_once_with(passphrase='secret')
+        pk.encrypt.assert_called_once_with(passphrase='secret', jobs=2)
+        pk.search.assert_called_once_with('site-1-1', jobs=2)
+        pk.remove_old_encrypted_files.assert_called_once_with(
+            force_remove=True)
+        pk.flush_history.assert_called_once_with(pack=False)
+        self.assertEquals(5, report['parameters']['ini_files'])
+        self.assertEquals('python', report['environment']['shred_method'])
+
+        # 2 of the 10 generated files are removed
+        files = [name for root, dirs, names in os.walk(directory)
+                 for name in names]
+        self.assertEquals(8, len(files))
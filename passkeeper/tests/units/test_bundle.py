@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+from . import base as test_base
+from passkeeper.bundle import Bundle, pack, unpack
+from mock import Mock
+
+class BundleTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(BundleTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'bundle.passkeeper')
+        self.backend = test_base.fake_backend()
+
+    def tearDown(self):
+        super(BundleTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pack(self):
+        files = [('foo.ini', b'[foo]\na = b\n'), ('bar.ini', b''),
+                 ('dir/bli.ini', b'\x00\xff')]
+        data = pack(files)
+
+        # Sorted files, same archive for same files
+        self.assertEquals(sorted(files), unpack(data))
+        self.assertEquals(data, pack(files))
+        self.assertEquals([], unpack(pack([])))
+
+    def test_save_load(self):
+        bundle = Bundle(self.path, self.backend)
+        bundle.files = [('foo.ini', b'[foo]\n'), ('bar.ini', b'[bar]\n')]
+        self.assertTrue(bundle.save(passphrase='secret'))
+        self.assertEquals(['bundle.passkeeper'], os.listdir(self.tmp_dir))
+
+        # One decryption for all files
+        bundle = Bundle(self.path, self.backend)
+        self.assertTrue(bundle.load(passphrase='secret'))
+        self.assertEquals(['bar.ini', 'foo.ini'], bundle.names())
+        self.assertEquals(b'[foo]\n', bundle.files[1][1])
+        self.assertEquals(1, self.backend.decrypt_data.call_count)
+
+        # Wrong passphrase
+        self.assertFalse(bundle.load(passphrase='wrong'))
+        self.assertEquals([], bundle.files)
+
+    def test_load_invalid(self):
+        bundle = Bundle(self.path, self.backend)
+        # No bundle
+        self.assertFalse(bundle.load(passphrase='secret'))
+
+        with open(self.path, 'wb') as f:
+            f.write(b'not a tar archive')
+        self.assertFalse(bundle.load(passphrase='secret'))
+
+    def test_save_failed(self):
+        # Existing bundle is kept
+        with open(self.path, 'wb') as f:
+            f.write(b'previous')
+        self.backend.encrypt_data.side_effect = None
+        self.backend.encrypt_data.return_value = Mock(ok=False)
+        bundle = Bundle(self.path, self.backend)
+        self.assertFalse(bundle.save(passphrase='secret'))
+        with open(self.path, 'rb') as f:
+            self.assertEquals(b'previous', f.read())
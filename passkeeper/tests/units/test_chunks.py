@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import random
+import shutil
+import tempfile
+from . import base as test_base
+from passkeeper.chunks import (ChunkStore, chunk_stream, dump_list,
+                               load_list, MAGIC)
+from mock import Mock
+
+class ChunksTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(ChunksTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.backend = test_base.fake_backend()
+        self.store = ChunkStore(os.path.join(self.tmp_dir, 'chunks'),
+                                self.backend, key=b'k' * 32)
+        # Small chunks for tests
+        self.store.min_size = 2048
+        self.store.avg_size = 8192
+        self.store.max_size = 32768
+        rand = random.Random(42)
+        self.data = bytes(bytearray(rand.getrandbits(8)
+                                    for _ in range(100000)))
+
+    def tearDown(self):
+        super(ChunksTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _chunks(self, data):
+        return list(chunk_stream(io.BytesIO(data), 2048, 8192, 32768))
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_chunk_stream(self):
+        chunks = self._chunks(self.data)
+        self.assertEquals(self.data, b''.join(chunks))
+        self.assertTrue(len(chunks) > 5)
+        self.assertTrue(all(2048 < len(chunk) < 32768
+                            for chunk in chunks[:-1]))
+        self.assertEquals([], self._chunks(b''))
+        self.assertEquals([b'foo'], self._chunks(b'foo'))
+        # No boundary in the content, chunks of max_size
+        self.assertEquals([32768, 32768, 4464],
+                          [len(chunk) for chunk
+                           in self._chunks(b'\x00' * 70000)])
+
+        # A change in place only changes its chunk
+        edited = self.data[:50000] + b'foo' + self.data[50003:]
+        edited_chunks = self._chunks(edited)
+        self.assertEquals(edited, b''.join(edited_chunks))
+        self.assertEquals(1, len(set(edited_chunks) - set(chunks)))
+
+        # So does an insertion or a removal near the start
+        for edited in [self.data[:100] + b'foo' + self.data[100:],
+                       self.data[:100] + self.data[103:]]:
+            edited_chunks = self._chunks(edited)
+            self.assertEquals(edited, b''.join(edited_chunks))
+            self.assertEquals(1, len(set(edited_chunks) - set(chunks)))
+            self.assertEquals(len(chunks), len(edited_chunks))
+
+    def test_list(self):
+        content = dump_list(['a', 'b'], 42)
+        self.assertTrue(content.startswith(MAGIC))
+        self.assertEquals(['a', 'b'], load_list(content))
+        self.assertEquals(None, load_list(b'[foo]\n'))
+
+    def test_store_restore(self):
+        source = self._write('disk.img', self.data)
+        names, new_names = self.store.store(source, passphrase='secret')
+        self.assertEquals(sorted(set(names)), sorted(new_names))
+        self.assertEquals(sorted(set(names)),
+                          sorted(fname[:-len('.passkeeper')] for fname
+                                 in os.listdir(self.store.directory)))
+        # Names are keyed hashes of chunks, armor is useless on chunks
+        self.assertEquals(64, len(names[0]))
+        self.assertFalse(self.backend.encrypt_data.call_args[1]['armor'])
+
+        # Unchanged chunks are not encrypted again
+        self.backend.encrypt_data.reset_mock()
+        edited = self._write('disk.img',
+                             self.data[:100] + b'foo' + self.data[100:])
+        edited_names, new_names = self.store.store(edited, passphrase='secret')
+        self.assertEquals(1, len(new_names))
+        self.assertEquals(len(new_names), self.backend.encrypt_data.call_count)
+
+        # Stored chunks are read from the directory
+        store = ChunkStore(self.store.directory, self.backend, key=b'k' * 32)
+        self.assertEquals(set(names) | set(edited_names), store.names())
+
+        output = os.path.join(self.tmp_dir, 'restored.img')
+        self.assertTrue(store.restore(names, output, passphrase='secret'))
+        with open(output, 'rb') as f:
+            self.assertEquals(self.data, f.read())
+
+    def test_restore_failed(self):
+        source = self._write('disk.img', self.data)
+        names, new_names = self.store.store(source, passphrase='secret')
+        output = self._write('restored.img', b'foo')
+
+        # Wrong passphrase or missing chunk, output is unchanged
+        self.assertFalse(self.store.restore(names, output, passphrase='wrong'))
+        os.remove(self.store.path(names[-1]))
+        restored = self.store.restore(names, output, passphrase='secret')
+        self.assertEquals('missing chunk', restored.status)
+        with open(output, 'rb') as f:
+            self.assertEquals(b'foo', f.read())
+        self.assertEquals(['disk.img', 'restored.img'],
+                          sorted(fname for fname in os.listdir(self.tmp_dir)
+                                 if fname != 'chunks'))
+
+    def test_store_failed(self):
+        source = self._write('disk.img', self.data)
+        self.backend.encrypt_data.side_effect = lambda data, passphrase, \
+            armor: Mock(ok=False, stderr='bad')
+        self.assertEquals(None, self.store.store(source, passphrase='secret'))
+        self.assertEquals(set(), self.store.names())
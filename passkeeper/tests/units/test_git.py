@@ -16,7 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import base as test_base
+import os
+import shutil
+import tempfile
+import subprocess
+from . import base as test_base
 from passkeeper.git import Git
 from mock import patch, call, mock_open
 
@@ -32,61 +36,180 @@ class GitTestCase(test_base.TestCase):
 
     def test_constructor(self):
         self.assertEquals(self.git.directory, 'foo')
-
-    @patch('passkeeper.git.run_cmd')
-    def test__run_git_cmd(self, mock_cmd):
-        self.git._run_git_cmd('bar')
-
-        # Will call bar command in foo directory
-        self.assertEquals(mock_cmd.call_args,
-                          call('git --work-tree=foo  --git-dir=foo/.git bar'))
+        self.assertEquals(self.git.command_count, {})
+
+    @patch('passkeeper.git.subprocess.Popen')
+    def test__run_git_cmd(self, mock_popen):
+        mock_popen.return_value.returncode = 0
+        mock_popen.return_value.communicate.return_value = (None, None)
+        self.assertEquals(0, self.git._run_git_cmd(['bar', 'my file']))
+
+        # Will call bar command in foo directory without shell
+        mock_popen.assert_called_once_with(['git', '--work-tree=.',
+                                            '--git-dir=.git', 'bar', 'my file'],
+                                           cwd='foo', stdin=None,
+                                           stdout=None)
+        mock_popen.return_value.communicate.assert_called_once_with(None)
+        self.assertEquals(self.git.command_count, {'bar': 1})
+
+        # Input is given on stdin
+        mock_popen.reset_mock()
+        self.git._run_git_cmd(['bar'], input=b'data')
+        self.assertEquals(subprocess.PIPE, mock_popen.call_args[1]['stdin'])
+        mock_popen.return_value.communicate.assert_called_once_with(b'data')
+
+        # Output is returned instead of the return code
+        mock_popen.return_value.communicate.return_value = (b'out', None)
+        self.assertEquals(b'out', self.git._run_git_cmd(['bar'], output=True))
+        self.assertEquals(subprocess.PIPE, mock_popen.call_args[1]['stdout'])
+
+        # Failed command
+        mock_popen.return_value.returncode = 1
+        self.assertRaises(Exception, self.git._run_git_cmd, ['bar'])
+        self.assertEquals(1, self.git._run_git_cmd(['bar'], check=False))
 
     @patch('passkeeper.git.Git._run_git_cmd')
-    def test_init(self, mock_git_cmd):
-        self.git.init()
+    def test__update_index(self, mock_git_cmd):
+        # All files given on stdin of one command
+        self.git._update_index(['--add'], ['f1', 'f2', 'my file'])
 
-        calls = [call('init'), call('config user.name passkeeper')]
-        mock_git_cmd.assert_has_calls(calls)
+        mock_git_cmd.assert_called_once_with(['update-index', '--add', '-z',
+                                              '--stdin'],
+                                             input=b'f1\0f2\0my file\0')
+
+        # No file no command
+        mock_git_cmd.reset_mock()
+        self.git._update_index(['--add'], [])
+        self.assertEquals(mock_git_cmd.call_count, 0)
 
     @patch('passkeeper.git.Git._run_git_cmd')
-    def test_add(self, mock_git_cmd):
+    def test_init(self, mock_git_cmd):
+        # git config written without command
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data='[core]\n'),
+                   create=True) as file_mock:
+            self.git.init()
+
+        mock_git_cmd.assert_called_once_with(['init'])
+        file_mock.assert_called_with('foo/.git/config', 'a')
+        file_mock().write.assert_has_calls([call('[user]\n'),
+                                            call('\tname = passkeeper\n'),
+                                            call('\temail = you@example.com\n')])
+
+        # Existing user config is updated by git
+        mock_git_cmd.reset_mock()
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data='[user]\n'),
+                   create=True) as file_mock:
+            self.git.init()
+
+        calls = [call(['init']), call(['config', 'user.name', 'passkeeper']),
+                 call(['config', 'user.email', 'you@example.com'])]
+        self.assertEquals(mock_git_cmd.call_args_list, calls)
+
+    @patch('passkeeper.git.Git._update_index')
+    def test_add(self, mock_update_index):
         self.git.add(files = ['f1', 'f2'])
 
-        calls = [call('add f1'), call('add f2')]
-        mock_git_cmd.assert_has_calls(calls)
-
-    @patch('passkeeper.git.Git._run_git_cmd')
-    def test_soft_remove(self, mock_git_cmd):
+        mock_update_index.assert_called_once_with(['--add'], ['f1', 'f2'])
+
+        # Encrypted files of directories are added, not temporary files
+        mock_update_index.reset_mock()
+        walk = [('foo/d', ['b', 'a'], ['f4.passkeeper', 'f3.passkeeper',
+                                       'f3.passkeeper.rekey.tmp']),
+                ('foo/d/a', [], ['f5.passkeeper', '.f6.passkeeper.x1y2z3',
+                                 'f7.passkeeper.42.tmp'])]
+        with patch('passkeeper.git.os.path.isdir', lambda path: path == 'foo/d'):
+            with patch('passkeeper.git.os.walk', return_value=walk):
+                self.git.add(files = ['f1', 'd'])
+
+        mock_update_index.assert_called_once_with(['--add'],
+                                                  ['f1', 'd/f3.passkeeper',
+                                                   'd/f4.passkeeper',
+                                                   'd/a/f5.passkeeper'])
+
+    @patch('passkeeper.git.Git._remove_files')
+    @patch('passkeeper.git.Git._update_index')
+    def test_soft_remove(self, mock_update_index, mock_remove_files):
         self.git.soft_remove(files = ['f1', 'f2'])
 
-        calls = [call('rm --cached f1'), call('rm --cached f2')]
-        mock_git_cmd.assert_has_calls(calls)
+        mock_update_index.assert_called_once_with(['--force-remove'],
+                                                  ['f1', 'f2'])
+        self.assertEquals(mock_remove_files.call_count, 0)
 
-    @patch('passkeeper.git.Git._run_git_cmd')
-    def test_force_remove(self, mock_git_cmd):
+    @patch('passkeeper.git.Git._remove_files')
+    @patch('passkeeper.git.Git._update_index')
+    def test_force_remove(self, mock_update_index, mock_remove_files):
         self.git.force_remove(files = ['f1', 'f2'])
 
-        calls = [call('rm --force f1'), call('rm --force f2')]
-        mock_git_cmd.assert_has_calls(calls)
+        mock_remove_files.assert_called_once_with(['f1', 'f2'])
+        mock_update_index.assert_called_once_with(['--force-remove'],
+                                                  ['f1', 'f2'])
 
     @patch('passkeeper.git.Git._run_git_cmd')
-    def test_remove(self, mock_git_cmd):
+    @patch('passkeeper.git.Git._remove_files')
+    @patch('passkeeper.git.Git._update_index')
+    def test_remove(self, mock_update_index, mock_remove_files,
+                    mock_run_git_cmd):
+        mock_run_git_cmd.return_value = b'f3\0'
         self.git.remove(files = ['f1', 'f2'])
 
-        calls = [call('rm f1'), call('rm f2')]
-        mock_git_cmd.assert_has_calls(calls)
+        mock_run_git_cmd.assert_called_once_with(['diff-index', '--name-only',
+                                                  '-z', 'HEAD'], output=True)
+        mock_remove_files.assert_called_once_with(['f1', 'f2'])
+        mock_update_index.assert_called_once_with(['--remove'], ['f1', 'f2'])
+
+        # Files with local modifications are kept, like git rm
+        mock_remove_files.reset_mock()
+        mock_update_index.reset_mock()
+        mock_run_git_cmd.return_value = b'f2\0f3\0'
+        self.assertRaises(Exception, self.git.remove, ['f1', 'f2'])
+        self.assertFalse(mock_remove_files.called)
+        self.assertFalse(mock_update_index.called)
+
+    def test__remove_files(self):
+        # Files and their empty directories are removed
+        tmp_dir = tempfile.mkdtemp()
+        self.git.directory = tmp_dir + '/'
+        try:
+            for name in ['a/b/f1', 'a/f2', 'f3']:
+                path = os.path.join(tmp_dir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            self.git._remove_files(['a/b/f1', 'f3', 'missing/f4'])
+            self.assertEquals(['a'], os.listdir(tmp_dir))
+            self.assertEquals(['f2'], os.listdir(os.path.join(tmp_dir, 'a')))
+
+            self.git._remove_files(['a/f2'])
+            self.assertEquals([], os.listdir(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @patch('passkeeper.git.Git._run_git_cmd')
+    def test_ls_files(self, mock_git_cmd):
+        mock_git_cmd.return_value = b'.gitignore\0encrypted/my file\0'
+        self.assertEquals(['.gitignore', 'encrypted/my file'],
+                          self.git.ls_files())
+        mock_git_cmd.assert_called_once_with(['ls-files', '-z'], output=True)
 
     @patch('passkeeper.git.Git._run_git_cmd')
     def test_commit(self, mock_git_cmd):
-        self.git.commit(message = 'foo')
+        self.git.commit(message = 'foo "bar"')
+
+        mock_git_cmd.assert_called_once_with(['commit', '-m', 'foo "bar"'],
+                                             check=False)
+
+    @patch('passkeeper.git.Git._run_git_cmd')
+    def test_gc(self, mock_git_cmd):
+        self.git.gc()
 
-        calls = [call('commit -m "foo" || true')]
+        calls = [call(['reflog', 'expire', '--expire=now', '--all']),
+                 call(['gc', '--prune=now', '--quiet'])]
         mock_git_cmd.assert_has_calls(calls)
 
     @patch('passkeeper.git.Git.add')
     @patch('passkeeper.git.Git.commit')
     def test_add_gitignore(self, mock_commit, mock_add):
-        with patch('__builtin__.open', mock_open(), create=True) as file_mock:
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
             handle = file_mock()
             self.git.add_gitignore(lines = ['foo', 'bar'])
 
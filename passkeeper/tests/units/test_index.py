@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from . import base as test_base
+from passkeeper.index import SearchIndex, ngrams
+from mock import patch, mock_open
+
+class SearchIndexTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(SearchIndexTestCase, self).setUp()
+        self.backend = test_base.fake_backend()
+        self.index = SearchIndex('foo/index.passkeeper', self.backend)
+        self.index.build([('bar.ini', b'[Foo]\nurl = http://Foo.com\n'),
+                          ('bli.ini', b'[bar]\nlogin = john\n'
+                                      b'[blo]\nurl = foo.org\n')])
+
+    def tearDown(self):
+        super(SearchIndexTestCase, self).tearDown()
+        del self.index
+
+    def test_ngrams(self):
+        self.assertEquals(set(['foo', 'oo.', 'o.c']), ngrams('foo.c', 3))
+        self.assertEquals(set(), ngrams('fo', 3))
+
+    def test_build(self):
+        self.assertEquals(['bar.ini', 'bli.ini'], self.index.files)
+        self.assertEquals([['bar.ini', 'Foo'], ['bli.ini', 'bar'],
+                           ['bli.ini', 'blo']], self.index.locations)
+        # Section names and values are lowercased
+        self.assertEquals([0, 2], self.index.postings['foo'])
+        self.assertEquals([1], self.index.postings['joh'])
+
+    def test_candidates(self):
+        self.assertEquals(set(['bar.ini', 'bli.ini']),
+                          self.index.candidates('FOO'))
+        self.assertEquals(set(['bar.ini']), self.index.candidates('http:'))
+        self.assertEquals(set(['bli.ini']), self.index.candidates('john'))
+        self.assertEquals(set(), self.index.candidates('unknown'))
+        # Regex or too short pattern, index can't be used
+        self.assertEquals(None, self.index.candidates('fo'))
+        self.assertEquals(None, self.index.candidates('foo.*com'))
+
+    @patch('passkeeper.index.os.path.isfile')
+    def test_save_load(self, mock_isfile):
+        mock_isfile.return_value = True
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            self.assertTrue(self.index.save(passphrase='secret'))
+        file_mock.assert_called_once_with('foo/index.passkeeper', 'wb')
+        encrypted = file_mock().write.call_args[0][0]
+        self.assertEquals(1, self.backend.encrypt_data.call_count)
+
+        index = SearchIndex('foo/index.passkeeper', self.backend)
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data=encrypted),
+                   create=True):
+            self.assertTrue(index.load(passphrase='secret'))
+        self.assertEquals(self.index.locations, index.locations)
+        self.assertEquals(set(['bar.ini']), index.candidates('http:'))
+
+        # Wrong passphrase
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data=encrypted),
+                   create=True):
+            self.assertFalse(index.load(passphrase='wrong'))
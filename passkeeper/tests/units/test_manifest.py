@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import base as test_base
+from passkeeper.manifest import Manifest
+from mock import patch, Mock, mock_open
+
+class ManifestTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(ManifestTestCase, self).setUp()
+        self.backend = Mock()
+        self.manifest = Manifest('foo/manifest.passkeeper', self.backend)
+        self.manifest.key = b'key'
+
+    def tearDown(self):
+        super(ManifestTestCase, self).tearDown()
+        del self.manifest
+
+    @patch('passkeeper.manifest.os.path.isfile')
+    def test_load(self, mock_isfile):
+        # No manifest. Generate a new key
+        mock_isfile.return_value = False
+        self.assertFalse(self.manifest.load(passphrase='secret'))
+        self.assertEquals(32, len(self.manifest.key))
+        self.assertEquals({}, self.manifest.entries)
+
+        # Valid manifest
+        mock_isfile.return_value = True
+        self.backend.decrypt_data.return_value = Mock(ok=True,
+            data=b'{"version": 1, "key": "6b6579", "files": {"bar.ini": {}}}')
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data='encrypted'),
+                   create=True) as file_mock:
+            self.assertTrue(self.manifest.load(passphrase='secret'))
+        file_mock.assert_called_once_with('foo/manifest.passkeeper', 'rb')
+        self.backend.decrypt_data.assert_called_once_with('encrypted', 'secret')
+        self.assertEquals(b'key', self.manifest.key)
+        self.assertEquals({'bar.ini': {}}, self.manifest.entries)
+        self.assertFalse(self.manifest.modified())
+
+        # Wrong passphrase
+        self.backend.decrypt_data.return_value = Mock(ok=False)
+        with patch(test_base.BUILTIN_OPEN, mock_open(read_data='encrypted'),
+                   create=True):
+            self.assertFalse(self.manifest.load(passphrase='wrong'))
+        self.assertEquals({}, self.manifest.entries)
+
+    @patch('passkeeper.manifest.Manifest.hash_file')
+    @patch('passkeeper.manifest.os.stat')
+    def test_check(self, mock_stat, mock_hash):
+        mock_stat.return_value = Mock(st_size=10, st_mtime=42.0)
+        mock_hash.return_value = 'hash'
+
+        # New file
+        self.assertEquals((True, {'size': 10, 'mtime': 42.0, 'hash': 'hash'}),
+                          self.manifest.check('bar.ini', 'foo/bar.ini'))
+
+        # Same size and mtime. File is not hashed
+        mock_hash.reset_mock()
+        self.manifest.entries['bar.ini'] = {'size': 10, 'mtime': 42.0, 'hash': 'hash'}
+        changed, entry = self.manifest.check('bar.ini', 'foo/bar.ini')
+        self.assertFalse(changed)
+        self.assertEquals(0, mock_hash.call_count)
+
+        # Touched file with same content
+        mock_stat.return_value = Mock(st_size=10, st_mtime=43.0)
+        self.assertEquals((False, {'size': 10, 'mtime': 43.0, 'hash': 'hash'}),
+                          self.manifest.check('bar.ini', 'foo/bar.ini'))
+        self.assertTrue(mock_hash.called)
+
+        # Modified content
+        mock_hash.return_value = 'new hash'
+        changed, entry = self.manifest.check('bar.ini', 'foo/bar.ini')
+        self.assertTrue(changed)
+        self.assertEquals('new hash', entry['hash'])
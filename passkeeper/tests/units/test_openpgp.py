@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+from . import base as test_base
+from io import BytesIO
+from passkeeper import openpgp
+from passkeeper.crypt import OpenPGPBackend
+
+class OpenPGPTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(OpenPGPTestCase, self).setUp()
+        self.key_cache = {}
+
+    def test_armor(self):
+        data = b'\x00\x01binary data' * 10
+        armored = openpgp.armor(data)
+        self.assertTrue(openpgp.is_armored(armored))
+        self.assertFalse(openpgp.is_armored(data))
+        self.assertEquals(data, openpgp.dearmor(armored))
+
+        # Checksum (written by gpg) is ignored
+        lines = armored.splitlines()
+        lines.insert(-1, b'=AAAA')
+        self.assertEquals(data, openpgp.dearmor(b'\n'.join(lines)))
+
+        # Armor headers are skipped
+        lines.insert(1, b'Version: GnuPG v1')
+        self.assertEquals(data, openpgp.dearmor(b'\n'.join(lines)))
+
+        # No checksum and no footer
+        with self.assertRaises(openpgp.OpenPGPError):
+            openpgp.dearmor(b'\n'.join(lines[:-2]))
+
+    def test_packets(self):
+        # New format with 1, 2 and 5 octets lengths
+        for size in [10, 1000, 10000]:
+            packet = openpgp.write_packet(11, b'x' * size)
+            self.assertEquals([(11, b'x' * size)], openpgp.read_packets(packet))
+        # Old format, 1 octet length and indeterminate length
+        self.assertEquals([(11, b'abc')], openpgp.read_packets(b'\xac\x03abc'))
+        self.assertEquals([(8, b'abc')], openpgp.read_packets(b'\xa3abc'))
+        # New format with partial body lengths
+        self.assertEquals([(11, b'ab' + b'c')],
+                          openpgp.read_packets(b'\xcb\xe1ab\x01c'))
+
+    def test_s2k(self):
+        # Simple S2K is the hash of the passphrase
+        self.assertEquals(b'\x0b\xee\xc7\xb5', openpgp.s2k('foo', 2, None, None, 4))
+        # Key longer than the hash use preloaded hash
+        key = openpgp.s2k('foo', 2, b'saltsalt', 96, 32)
+        self.assertEquals(32, len(key))
+        self.assertEquals(key[:20], openpgp.s2k('foo', 2, b'saltsalt', 96, 20))
+
+    def test_message(self):
+        for armored in [True, False]:
+            message = openpgp.encrypt_message(b'secret data', 'secret',
+                                              armored=armored,
+                                              key_cache=self.key_cache)
+            self.assertEquals(armored, openpgp.is_armored(message))
+            self.assertEquals(b'secret data',
+                              openpgp.decrypt_message(message, 'secret',
+                                                      key_cache=self.key_cache))
+
+        # Salt and key are reused for the same passphrase
+        self.assertEquals(1, len([k for k in self.key_cache if k[0] == 'encrypt']))
+
+        # Wrong passphrase
+        with self.assertRaises(openpgp.BadPassphraseError):
+            openpgp.decrypt_message(message, 'wrong', key_cache=self.key_cache)
+
+        # Modified message
+        message = bytearray(message)
+        message[-5] ^= 1
+        with self.assertRaises(openpgp.OpenPGPError):
+            openpgp.decrypt_message(bytes(message), 'secret',
+                                    key_cache=self.key_cache)
+
+    def test_stream(self):
+        # Small buffers, body is written in partial lengths of 512 bytes
+        data = os.urandom(5000)
+        for armored in [True, False]:
+            encrypted = BytesIO()
+            openpgp.encrypt_stream(BytesIO(data), encrypted, 'secret',
+                                   armored=armored, key_cache=self.key_cache,
+                                   buffer_size=100)
+            decrypted = BytesIO()
+            openpgp.decrypt_stream(BytesIO(encrypted.getvalue()), decrypted,
+                                   'secret', key_cache=self.key_cache,
+                                   buffer_size=100)
+            self.assertEquals(data, decrypted.getvalue())
+
+        # Truncated message
+        with self.assertRaises(openpgp.OpenPGPError):
+            openpgp.decrypt_stream(BytesIO(encrypted.getvalue()[:-100]),
+                                   BytesIO(), 'secret',
+                                   key_cache=self.key_cache)
+
+    def test_backend(self):
+        backend = OpenPGPBackend()
+        encrypted = backend.encrypt_data(b'secret data', 'secret')
+        self.assertTrue(encrypted.ok)
+        self.assertEquals('encryption ok', encrypted.status)
+
+        decrypted = backend.decrypt_data(encrypted.data, 'secret')
+        self.assertTrue(decrypted.ok)
+        self.assertEquals(b'secret data', decrypted.data)
+
+        decrypted = backend.decrypt_data(encrypted.data, 'wrong')
+        self.assertFalse(decrypted.ok)
+        self.assertEquals('decryption failed', decrypted.status)
+
+    def test_backend_files(self):
+        backend = OpenPGPBackend(buffer_size=1024)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp_dir, 'source')
+            encrypted = os.path.join(tmp_dir, 'source.passkeeper')
+            decrypted = os.path.join(tmp_dir, 'decrypted')
+            with open(source, 'wb') as f:
+                f.write(b'secret data' * 1000)
+
+            self.assertTrue(backend.encrypt(source, encrypted, 'secret',
+                                            armor=False).ok)
+            self.assertTrue(backend.decrypt(encrypted, decrypted, 'secret').ok)
+            with open(decrypted, 'rb') as f:
+                self.assertEquals(b'secret data' * 1000, f.read())
+
+            # Nothing is written on failure
+            os.remove(decrypted)
+            self.assertFalse(backend.decrypt(encrypted, decrypted, 'wrong').ok)
+            self.assertEquals(['source', 'source.passkeeper'],
+                              sorted(os.listdir(tmp_dir)))
+
+            # Verify decrypts without writing anything
+            self.assertTrue(backend.verify(encrypted, 'secret').ok)
+            self.assertFalse(backend.verify(encrypted, 'wrong').ok)
+            self.assertEquals(['source', 'source.passkeeper'],
+                              sorted(os.listdir(tmp_dir)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_backend_reencrypt(self):
+        backend = OpenPGPBackend(buffer_size=1024)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp_dir, 'source.passkeeper')
+            output = os.path.join(tmp_dir, 'source.passkeeper.rekey.tmp')
+            # Bigger than the buffer of the pipe
+            data = os.urandom(256 * 1024)
+            with open(source, 'wb') as f:
+                f.write(backend.encrypt_data(data, 'secret').data)
+
+            reencrypted = backend.reencrypt(source, output, 'secret', 'new',
+                                            armor=False)
+            self.assertTrue(reencrypted.ok)
+            with open(output, 'rb') as f:
+                encrypted = f.read()
+            self.assertFalse(openpgp.is_armored(encrypted))
+            self.assertEquals(data, backend.decrypt_data(encrypted, 'new').data)
+
+            # Nothing is written on failure
+            os.remove(output)
+            reencrypted = backend.reencrypt(source, output, 'wrong', 'new')
+            self.assertFalse(reencrypted.ok)
+            self.assertEquals('decryption failed', reencrypted.status)
+            self.assertEquals(['source.passkeeper'], os.listdir(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -16,9 +16,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import base as test_base
+from . import base as test_base
 from passkeeper import Passkeeper
-from mock import patch, call, mock_open, MagicMock, Mock
+from passkeeper.crypt import GnupgBackend, DecryptionError
+from passkeeper.search import SearchEngine
+from passkeeper.scanner import VaultScanner, FileInfo
+from mock import patch, call, mock_open, Mock
 
 class PasskeeperTestCase(test_base.TestCase):
 
@@ -37,20 +40,42 @@ class PasskeeperTestCase(test_base.TestCase):
         self.mock_git.assert_called_once_with('foo')
         self.assertEquals(self.pk.directory, 'foo')
         self.assertEquals(self.pk.encrypted_dir, 'encrypted')
+        self.assertTrue(isinstance(self.pk.crypt, GnupgBackend))
+
+        backend = Mock()
+        self.assertEquals(Passkeeper('foo', backend=backend).crypt, backend)
+        # Chunks are encrypted by the selected backend
+        self.assertEquals(self.pk._chunk_store(b'k' * 32).backend,
+                          self.pk.crypt)
+
+
+    def _scanner(self, ini=(), raw=(), encrypted=(), size=1):
+        "Return a VaultScanner of foo with these relative files"
+        info = lambda path: FileInfo(path, Mock(st_size=size, st_mtime=1))
+        scanner = VaultScanner('foo')
+        scanner.ini_files = dict((name, info('foo/%s' % name)) for name in ini)
+        scanner.raw_files = dict((name, info('foo/%s' % name)) for name in raw)
+        scanner.raw_dirs = sorted(set(name.split('/')[0] for name in raw))
+        scanner.encrypted_files = dict(
+            (name, info('foo/encrypted/%s.passkeeper' % name))
+            for name in encrypted)
+        return scanner
 
 
     @patch('passkeeper.Passkeeper.remove_old_encrypted_files')
     @patch('passkeeper.Passkeeper.cleanup')
     @patch('passkeeper.Passkeeper.encrypt')
+    @patch('passkeeper.Passkeeper.scan')
     @patch('passkeeper.create_dir')
-    def test_init_dir(self, mock_create_dir, mock_encrypt, mock_cleanup,
-                      remove_old_encrypted_files):
+    def test_init_dir(self, mock_create_dir, mock_scan, mock_encrypt,
+                      mock_cleanup, remove_old_encrypted_files):
         self.mock_git.reset_mock()
-        with patch('__builtin__.open', mock_open(), create=True) as file_mock:
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
             file_handle = file_mock()
             self.pk.init_dir(passphrase='secret')
 
-        calls = [call().init(), call().add_gitignore(['*.ini', '/*.raw'])]
+        calls = [call().init(),
+                 call().add_gitignore(['*.ini', '/*.raw', '/.decrypted'])]
         self.mock_git.assert_has_calls(calls)
 
         calls = [call('foo'), call('foo/default.raw')]
@@ -61,169 +86,742 @@ class PasskeeperTestCase(test_base.TestCase):
 
         self.assertEquals(True, file_handle.write.called)
 
-        remove_old_encrypted_files.assert_called_once_with(force_remove=True)
+        # Directory scanned once for all steps
+        scanner = mock_scan.return_value
+        mock_scan.assert_called_once_with()
+        remove_old_encrypted_files.assert_called_once_with(force_remove=True,
+                                                           scanner=scanner,
+                                                           passphrase='secret')
 
-        mock_encrypt.assert_called_once_with(passphrase='secret')
-        mock_cleanup.assert_called_once_with()
+        mock_encrypt.assert_called_once_with(passphrase='secret',
+                                             scanner=scanner)
+        mock_cleanup.assert_called_once_with(scanner=scanner)
 
 
-    @patch('passkeeper.run_cmd')
-    @patch('passkeeper.os.listdir')
-    @patch('passkeeper.os.path.isfile')
-    def test_cleanup(self, mock_isfile, mock_listdir, mock_cmd):
-        # One ignored file and one valid file
-        mock_listdir.return_value = ['ignored', 'bar.ini']
-        mock_isfile.return_value = True
+    @patch('passkeeper.VaultScanner')
+    def test_cleanup(self, mock_scanner):
+        # One valid file and one raw directory shredded in one run
+        self.pk.shredder = Mock()
+        mock_scanner.return_value.scan.return_value = self._scanner(
+            ini=['bar.ini'], raw=['bli.raw/bla'], encrypted=['old.ini'])
         self.pk.cleanup()
 
-        mock_cmd.assert_called_once_with('shred --remove foo/bar.ini')
+        mock_scanner.assert_called_once_with('foo', 'encrypted', '.decrypted')
+        self.pk.shredder.shred_tree.assert_called_once_with(['foo/bli.raw'],
+                                                            ['foo/bar.ini'])
 
-        # Test with bad filepath. Do nothing
-        mock_cmd.reset_mock()
-        mock_listdir.return_value = ['bar.ini']
-        mock_isfile.return_value = False
-        self.pk.cleanup()
+        # Nothing to clean. Do nothing
+        self.pk.shredder.reset_mock()
+        self.assertEquals(None, self.pk.cleanup(scanner=self._scanner()))
+
+        self.assertEquals(self.pk.shredder.shred_tree.call_count, 0)
 
-        self.assertEquals(mock_cmd.call_count, 0)
+        # Selection of a selective decryption shredded too
+        scanner = self._scanner(ini=['bar.ini'])
+        scanner.selection = set(['bar.ini'])
+        with patch('passkeeper.os.path.isfile', return_value=True):
+            self.pk.cleanup(scanner=scanner)
+        self.pk.shredder.shred_tree.assert_called_once_with(
+            [], ['foo/bar.ini', 'foo/.decrypted'])
 
 
     @patch('passkeeper.raw_input')
-    @patch('passkeeper.run_cmd')
-    @patch('passkeeper.os.listdir')
-    @patch('passkeeper.os.path.isfile')
-    def test_remove_old_encrypted_files(self, mock_isfile, mock_listdir,
-                               mock_cmd, mock_raw_input):
-        # One file and 3 in encrypted so delete one.
-        # Basicly the script will remove 2 file.
-        # But we will cancel one of them
-        #  * bar keep
-        #  * foo delete canceled
-        #  * bli deleted
-
-        mock_raw_input.side_effect = ['n', 'y']
-        # listdir is used by walk
-        mock_listdir.return_value = [ 'bar.ini.passkeeper',
-                                      'foo.ini.passkeeper',
-                                      'dir/bli.ini.passkeeper']
-        mock_isfile.side_effect = [ True, False, False ]
-        self.pk.remove_old_encrypted_files(force_remove=False)
-
-        mock_cmd.assert_called_once_with('shred foo/encrypted/dir/bli.ini.passkeeper')
-        calls = [ call().force_remove(['encrypted/dir/bli.ini.passkeeper']),
-                  call().commit('Remove file encrypted/dir/bli.ini.passkeeper')]
+    def test_remove_old_encrypted_files(self, mock_raw_input):
+        # bar.ini and foo.raw/bla exist, 4 encrypted files
+        # so delete bli.ini and foo.raw/blo once confirmed
+        self.pk.shredder = Mock()
+        self.pk.shredder.shred.return_value = Mock(errors=[])
+        scanner = self._scanner(ini=['bar.ini'], raw=['foo.raw/bla'],
+                                encrypted=['bar.ini', 'bli.ini',
+                                           'foo.raw/bla', 'foo.raw/blo'])
+
+        # Canceled, nothing removed
+        mock_raw_input.return_value = 'n'
+        self.assertEquals([], self.pk.remove_old_encrypted_files(scanner=scanner))
+        self.assertEquals(1, mock_raw_input.call_count)
+        self.assertEquals(0, self.pk.shredder.shred.call_count)
+        self.assertEquals(0, self.mock_git.return_value.force_remove.call_count)
+
+        # Confirmed once for both files
+        mock_raw_input.reset_mock()
+        mock_raw_input.return_value = 'y'
+        removed = ['encrypted/bli.ini.passkeeper',
+                   'encrypted/foo.raw/blo.passkeeper']
+        self.assertEquals(removed,
+                          self.pk.remove_old_encrypted_files(scanner=scanner))
+        self.assertEquals(1, mock_raw_input.call_count)
+        self.pk.shredder.shred.assert_called_once_with(
+            ['foo/encrypted/bli.ini.passkeeper',
+             'foo/encrypted/foo.raw/blo.passkeeper'], remove=False)
+        calls = [ call().force_remove(removed),
+                  call().commit('Remove 2 files')]
         self.mock_git.assert_has_calls(calls)
 
         # Same test with force remove.
         # Never ask confirmation, just delete both files
-        mock_cmd.reset_mock()
+        self.pk.shredder.reset_mock()
         mock_raw_input.reset_mock()
-        mock_isfile.side_effect = [ True, False, False ]
-
-        self.pk.remove_old_encrypted_files(force_remove=True)
-
-        self.assertEquals(2, mock_cmd.call_count)
+        self.assertEquals(removed,
+                          self.pk.remove_old_encrypted_files(force_remove=True,
+                                                             scanner=scanner))
         self.assertEquals(0, mock_raw_input.call_count)
+        self.assertEquals(1, self.pk.shredder.shred.call_count)
+
+        # Nothing to remove
+        self.mock_git.reset_mock()
+        scanner = self._scanner(ini=['bar.ini'], encrypted=['bar.ini'])
+        self.assertEquals([], self.pk.remove_old_encrypted_files(scanner=scanner))
+        self.assertEquals(0, self.mock_git.return_value.commit.call_count)
+
+
+    @patch('passkeeper.Bundle')
+    @patch('passkeeper.Passkeeper.bundled')
+    def test_remove_old_encrypted_files_bundle(self, mock_bundled,
+                                               mock_bundle):
+        # bli.ini is only in the bundle
+        mock_bundled.return_value = True
+        bundle = mock_bundle.return_value
+        bundle.load.return_value = True
+        bundle.files = [('bar.ini', b'[bar]'), ('bli.ini', b'[bli]')]
+        bundle.names.return_value = ['bar.ini', 'bli.ini']
+        scanner = self._scanner(ini=['bar.ini'])
+
+        # Bundle kept without passphrase
+        self.assertEquals([], self.pk.remove_old_encrypted_files(
+            force_remove=True, scanner=scanner))
+        self.assertEquals(0, bundle.save.call_count)
+
+        self.assertEquals(['bundle.passkeeper:bli.ini'],
+                          self.pk.remove_old_encrypted_files(
+                              force_remove=True, scanner=scanner,
+                              passphrase='secret'))
+        self.assertEquals([('bar.ini', b'[bar]')], bundle.files)
+        bundle.save.assert_called_once_with(passphrase='secret')
+        calls = [call().add(['bundle.passkeeper']),
+                 call().commit('Remove file bundle.passkeeper:bli.ini')]
+        self.mock_git.assert_has_calls(calls)
 
 
-    @patch('passkeeper.decrypt')
-    @patch('passkeeper.os.listdir')
-    @patch('passkeeper.os.path.isfile')
-    def test_decrypt(self, mock_isfile, mock_listdir, mock_decrypt):
-        # One ignored file, one valid file adn one file in raw dir.
-        # Used in walk dir
-        mock_listdir.return_value = ['ignored', 'bar.ini.passkeeper', 'foo.raw/bli.passkeeper']
-        mock_isfile.return_value = True
-        self.pk.decrypt(passphrase='secret')
+    @patch('passkeeper.Passkeeper._decrypt_chunks')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.decrypt')
+    def test_decrypt(self, mock_decrypt, mock_create_dir,
+                     mock_decrypt_chunks):
+        # One valid file and one file in raw dir.
+        mock_decrypt_chunks.side_effect = lambda name, output, passphrase, \
+            decrypted: decrypted
+        scanner = self._scanner(encrypted=['bar.ini', 'foo.raw/bli'])
+        self.pk.decrypt(passphrase='secret', scanner=scanner)
 
         mock_decrypt.assert_any_call(output='foo/bar.ini', passphrase='secret',
                                      source='foo/encrypted/bar.ini.passkeeper')
         mock_decrypt.assert_any_call(output='foo/foo.raw/bli', passphrase='secret',
                                      source='foo/encrypted/foo.raw/bli.passkeeper')
-
-        # Test with bad filepath. Do nothing
+        mock_create_dir.assert_has_calls([call(path='foo'),
+                                          call(path='foo/foo.raw')])
+        # Only raw files can be stored in chunks
+        mock_decrypt_chunks.assert_called_once_with(
+            'foo.raw/bli.passkeeper', 'foo/foo.raw/bli', 'secret',
+            mock_decrypt.return_value)
+
+        # No encrypted file. Do nothing
         mock_decrypt.reset_mock()
-        mock_listdir.return_value = ['bad_fake_file']
-        mock_isfile.return_value = False
-        self.pk.decrypt(passphrase='secret')
+        self.assertTrue(self.pk.decrypt(passphrase='secret',
+                                        scanner=self._scanner()))
 
         self.assertEquals(mock_decrypt.call_count, 0)
 
+    @patch('passkeeper.Passkeeper._decrypt_chunks')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.decrypt')
+    def test_decrypt_wrong_passphrase(self, mock_decrypt, mock_create_dir,
+                                      mock_decrypt_chunks):
+        # The passphrase is checked on the ini file first.
+        # Other files are never decrypted
+        mock_decrypt_chunks.side_effect = lambda name, output, passphrase, \
+            decrypted: decrypted
+        scanner = self._scanner(encrypted=['foo.raw/bli', 'bar.ini',
+                                           'foo.raw/bla'])
+        mock_decrypt.return_value = Mock(ok=False, status='decryption failed')
+
+        self.assertFalse(self.pk.decrypt(passphrase='wrong', jobs=2,
+                                         scanner=scanner))
+        mock_decrypt.assert_called_once_with(output='foo/bar.ini', passphrase='wrong',
+                                             source='foo/encrypted/bar.ini.passkeeper')
+
+        # Failed on a raw file. Pending files are cancelled
+        mock_decrypt.reset_mock()
+        mock_decrypt.side_effect = [Mock(ok=True, status='decryption ok'),
+                                    Mock(ok=False, status='decryption failed')]
+        self.assertFalse(self.pk.decrypt(passphrase='secret', scanner=scanner))
+        self.assertEquals(mock_decrypt.call_count, 2)
+
+        # Every files decrypted
+        mock_decrypt.reset_mock()
+        mock_decrypt.side_effect = None
+        mock_decrypt.return_value = Mock(ok=True, status='decryption ok')
+        self.assertTrue(self.pk.decrypt(passphrase='secret', jobs=2,
+                                        scanner=scanner))
+        self.assertEquals(mock_decrypt.call_count, 3)
+
 
+    @patch('passkeeper.write_selection')
+    @patch('passkeeper.Passkeeper._decrypt_chunks')
+    @patch('passkeeper.Passkeeper._write_decrypted')
+    @patch('passkeeper.Passkeeper._decrypt_ini_files')
     @patch('passkeeper.create_dir')
-    @patch('passkeeper.encrypt')
-    @patch('passkeeper.os.listdir')
-    @patch('passkeeper.os.path.isfile')
-    def test_encrypt(self, mock_isfile, mock_listdir, mock_encrypt, mock_create_dir):
-        # Test with bad filepath. Don't encrypt this file
+    @patch('passkeeper.crypt.GnupgBackend.decrypt')
+    def test_decrypt_selected(self, mock_decrypt, mock_create_dir,
+                              mock_decrypt_ini_files, mock_write_decrypted,
+                              mock_decrypt_chunks, mock_write_selection):
+        mock_decrypt_chunks.side_effect = lambda name, output, passphrase, \
+            decrypted: decrypted
+        scanner = self._scanner(encrypted=['bar.ini', 'foo.ini', 'foo.raw/bla',
+                                           'foo.raw/bli', 'bli.raw/bla'])
+        mock_decrypt_ini_files.return_value = [('foo.ini', b'[foo]\na = b\n')]
+
+        # Globs, ini files decrypted in memory
+        self.assertTrue(self.pk.decrypt('secret', patterns=['foo*'],
+                                        scanner=scanner))
+        mock_decrypt_ini_files.assert_called_once_with('secret', jobs=1,
+                                                       names=['foo.ini'],
+                                                       scanner=scanner)
+        mock_write_decrypted.assert_called_once_with(
+            [('foo.ini', b'[foo]\na = b\n')])
+        self.assertEquals(['foo/foo.raw/bla', 'foo/foo.raw/bli'],
+                          sorted(kwargs['output'] for args, kwargs
+                                 in mock_decrypt.call_args_list))
+        # Decrypted files are added to the selection
+        mock_write_selection.assert_called_once_with(
+            'foo/.decrypted', set(['foo.ini', 'foo.raw/bla', 'foo.raw/bli']))
+        scanner.selection = set(['foo.ini'])
+
+        # Ini files where the pattern is found
+        mock_decrypt.reset_mock()
+        mock_decrypt_ini_files.reset_mock()
+        mock_decrypt_ini_files.return_value = [('bar.ini', b'[bar]\n'),
+                                               ('foo.ini', b'[foo]\n')]
+        self.assertTrue(self.pk.decrypt('secret', patterns=['bli.raw'],
+                                        matching='fo', scanner=scanner))
+        mock_decrypt_ini_files.assert_called_once_with(
+            'secret', jobs=1, names=['bar.ini', 'foo.ini'], scanner=scanner)
+        mock_write_decrypted.assert_called_with([('foo.ini', b'[foo]\n')])
+        mock_write_selection.assert_called_with(
+            'foo/.decrypted', set(['foo.ini', 'bli.raw/bla']))
+        mock_decrypt.assert_called_once_with(output='foo/bli.raw/bla',
+                                             passphrase='secret',
+                                             source='foo/encrypted/bli.raw/bla.passkeeper')
+
+        # Ini files can't be decrypted
+        mock_decrypt.reset_mock()
+        mock_decrypt_ini_files.return_value = None
+        self.assertFalse(self.pk.decrypt('wrong', matching='fo',
+                                         scanner=scanner))
+        self.assertEquals(0, mock_decrypt.call_count)
+
+
+    @patch('passkeeper.Passkeeper._write_index')
+    @patch('passkeeper.Manifest')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.encrypt')
+    def test_encrypt(self, mock_encrypt, mock_create_dir, mock_manifest,
+                     mock_write_index):
+        mock_write_index.return_value = False
+        # Unchanged files, encrypted anyway without incremental
+        manifest = mock_manifest.return_value
+        manifest.entries = {}
+        manifest.check.side_effect = lambda name, path, stat: \
+            (False, '%s entry' % name)
+        manifest.modified.return_value = False
+        # No file. Don't encrypt
         mock_encrypt.reset_mock()
         self.mock_git.reset_mock()
-        mock_listdir.return_value = ['fake_bar_file.ini']
-        mock_isfile.return_value = False
 
-        self.assertTrue(self.pk.encrypt(passphrase='secret'))
+        self.assertTrue(self.pk.encrypt(passphrase='secret', incremental=False,
+                                        scanner=self._scanner()))
         self.assertEquals(mock_encrypt.call_count, 0)
 
-        # One ignored file and one valid file
-        # And one file in raw subdir
+        # One valid file and one file in raw subdir
         mock_encrypt.reset_mock()
         self.mock_git.reset_mock()
         mock_create_dir.reset_mock()
-        # First for listdir, second for walk
-        mock_listdir.side_effect = [['ignored', 'bar.ini', 'foo.raw'], ['bli']]
-        mock_isfile.return_value = True
+        scanner = self._scanner(ini=['bar.ini'], raw=['foo.raw/bli'])
 
-        self.assertTrue(self.pk.encrypt(passphrase='secret', commit_message='my message'))
+        self.assertTrue(self.pk.encrypt(passphrase='secret', commit_message='my message',
+                                        incremental=False, scanner=scanner))
 
         calls = [call('foo/encrypted'), call('foo/encrypted/foo.raw')]
         mock_create_dir.assert_has_calls(calls)
 
         mock_encrypt.assert_any_call(passphrase='secret',
                                      source='foo/bar.ini',
-                                     output='foo/encrypted/bar.ini.passkeeper')
+                                     output='foo/encrypted/bar.ini.passkeeper',
+                                     armor=True)
         mock_encrypt.assert_any_call(passphrase='secret',
                                      source='foo/foo.raw/bli',
-                                     output='foo/encrypted/foo.raw/bli.passkeeper')
-        calls = [call().add(['encrypted/bar.ini.passkeeper']),
-                 call().add(['encrypted/foo.raw/bli.passkeeper']),
+                                     output='foo/encrypted/foo.raw/bli.passkeeper',
+                                     armor=True)
+        calls = [call().add(['encrypted/bar.ini.passkeeper',
+                             'encrypted/foo.raw/bli.passkeeper']),
                  call().commit('my message')]
         self.mock_git.assert_has_calls(calls)
+        # The manifest is refreshed by a full encryption too
+        self.assertEquals({'bar.ini': 'bar.ini entry',
+                           'foo.raw/bli': 'foo.raw/bli entry'},
+                          manifest.entries)
+        manifest.entries = {}
+
+        # Same files with a pool of workers and one failed encryption.
+        # Only the encrypted file is added and encrypt return False
+        mock_encrypt.reset_mock()
+        self.mock_git.reset_mock()
+        failed = Mock(ok=False, stderr='error')
+        mock_encrypt.side_effect = lambda source, output, passphrase, armor: (
+            failed if source == 'foo/bar.ini' else Mock(ok=True))
 
+        self.assertFalse(self.pk.encrypt(passphrase='secret', jobs=4,
+                                         incremental=False, scanner=scanner))
 
-    @patch('passkeeper.ConfigParser.RawConfigParser')
-    @patch('passkeeper.os.listdir')
+        self.assertEquals(mock_encrypt.call_count, 2)
+        calls = [call().add(['encrypted/foo.raw/bli.passkeeper']),
+                 call().commit('Update encrypted files')]
+        self.mock_git.assert_has_calls(calls)
+
+
+    @patch('passkeeper.Passkeeper._write_index')
+    @patch('passkeeper.Manifest')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.encrypt')
+    def test_encrypt_incremental(self, mock_encrypt, mock_create_dir,
+                                 mock_manifest, mock_write_index):
+        mock_write_index.return_value = False
+        # bar.ini changed, foo.raw/bli unchanged.
+        # Only bar.ini and the manifest are encrypted and added
+        scanner = self._scanner(ini=['bar.ini'], raw=['foo.raw/bli'],
+                                encrypted=['bar.ini', 'foo.raw/bli'])
+        manifest = mock_manifest.return_value
+        checks = {'bar.ini': (True, 'bar entry'),
+                  'foo.raw/bli': (False, 'bli entry')}
+        manifest.check.side_effect = lambda name, path, stat: checks[name]
+        manifest.modified.return_value = True
+        manifest.save.return_value = True
+
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+
+        mock_manifest.assert_called_once_with('foo/manifest.passkeeper', self.pk.crypt)
+        manifest.load.assert_called_once_with(passphrase='secret')
+        # Stat of the scan are used
+        manifest.check.assert_any_call('bar.ini', 'foo/bar.ini',
+                                       scanner.ini_files['bar.ini'].stat)
+        mock_encrypt.assert_called_once_with(passphrase='secret',
+                                             source='foo/bar.ini',
+                                             output='foo/encrypted/bar.ini.passkeeper',
+                                             armor=True)
+        self.assertEquals({'bar.ini': 'bar entry', 'foo.raw/bli': 'bli entry'},
+                          manifest.entries)
+        manifest.save.assert_called_once_with(passphrase='secret')
+        calls = [call().add(['encrypted/bar.ini.passkeeper', 'manifest.passkeeper']),
+                 call().commit('Update encrypted files')]
+        self.mock_git.assert_has_calls(calls)
+
+        # Unchanged file without encrypted file is encrypted
+        mock_encrypt.reset_mock()
+        scanner = self._scanner(raw=['foo.raw/bli'])
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        mock_encrypt.assert_called_once_with(passphrase='secret',
+                                             source='foo/foo.raw/bli',
+                                             output='foo/encrypted/foo.raw/bli.passkeeper',
+                                             armor=True)
+
+
+    @patch('passkeeper.Passkeeper._write_index')
+    @patch('passkeeper.Manifest')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.encrypt')
     @patch('passkeeper.os.path.isfile')
-    def test_search(self, mock_isfile, mock_listdir, mock_rawconfig):
-        # One ignored file and one valid file
-        # In this file we have 4 sections :
+    def test_encrypt_index(self, mock_isfile, mock_encrypt, mock_create_dir,
+                           mock_manifest, mock_write_index):
+        # Index is written when asked
+        scanner = self._scanner(ini=['bar.ini'], encrypted=['bar.ini'])
+        mock_isfile.return_value = False
+        manifest = mock_manifest.return_value
+        manifest.entries = {}
+        manifest.check.return_value = (True, 'bar entry')
+        manifest.modified.return_value = False
+        self.assertTrue(self.pk.encrypt(passphrase='secret', index=True,
+                                        scanner=scanner))
+        mock_write_index.assert_called_once_with([('bar.ini', 'foo/bar.ini')],
+                                                 'secret', scanner)
+        calls = [call().add(['encrypted/bar.ini.passkeeper', 'index.passkeeper']),
+                 call().commit('Update encrypted files')]
+        self.mock_git.assert_has_calls(calls)
+
+        # Existing index is not written if no ini file changed
+        mock_write_index.reset_mock()
+        mock_isfile.side_effect = lambda path: path == "foo/index.passkeeper"
+        manifest.entries = {'bar.ini': 'bar entry'}
+        manifest.check.return_value = (False, 'bar entry')
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        self.assertEquals(0, mock_write_index.call_count)
+
+        # Existing index is not written if an ini file is not decrypted
+        scanner = self._scanner()
+        scanner.selection = set()
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        self.assertEquals(0, mock_write_index.call_count)
+        self.assertEquals({'bar.ini': 'bar entry'}, manifest.entries)
+
+        # Existing index is written if an ini file is removed
+        scanner = self._scanner()
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        mock_write_index.assert_called_once_with([], 'secret', scanner)
+
+
+    @patch('passkeeper.Passkeeper._write_bundle')
+    @patch('passkeeper.Passkeeper.bundled')
+    @patch('passkeeper.Manifest')
+    @patch('passkeeper.create_dir')
+    @patch('passkeeper.crypt.GnupgBackend.encrypt')
+    def test_encrypt_bundle(self, mock_encrypt, mock_create_dir,
+                            mock_manifest, mock_bundled, mock_write_bundle):
+        # Bundle layout : ini files are encrypted in the bundle,
+        # raw files in encrypted files
+        mock_bundled.return_value = True
+        mock_write_bundle.return_value = True
+        scanner = self._scanner(ini=['bar.ini', 'bli.ini'],
+                                raw=['foo.raw/bla'], encrypted=['foo.raw/bla'])
+        manifest = mock_manifest.return_value
+        manifest.entries = {}
+        checks = {'bar.ini': True, 'bli.ini': False, 'foo.raw/bla': True}
+        manifest.check.side_effect = lambda name, path, stat: (checks[name],
+                                                               name)
+        manifest.modified.return_value = False
+
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        mock_encrypt.assert_called_once_with(passphrase='secret',
+                                             source='foo/foo.raw/bla',
+                                             output='foo/encrypted/foo.raw/bla.passkeeper',
+                                             armor=True)
+        mock_write_bundle.assert_called_once_with([('bar.ini', 'foo/bar.ini'),
+                                                   ('bli.ini', 'foo/bli.ini')],
+                                                  'secret')
+        calls = [call().add(['encrypted/foo.raw/bla.passkeeper',
+                             'bundle.passkeeper'])]
+        self.mock_git.assert_has_calls(calls)
+
+        # Unchanged ini files, bundle not written
+        mock_write_bundle.reset_mock()
+        checks['bar.ini'] = False
+        self.assertTrue(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        self.assertEquals(0, mock_write_bundle.call_count)
+
+        # Bundle not written, ini files encrypted again next time
+        manifest.entries = {}
+        checks['bar.ini'] = True
+        manifest.modified.return_value = True
+        mock_write_bundle.return_value = False
+        self.assertFalse(self.pk.encrypt(passphrase='secret', scanner=scanner))
+        self.assertEquals({'foo.raw/bla': 'foo.raw/bla'}, manifest.entries)
+
+
+    @patch('os.remove')
+    @patch('os.rename')
+    @patch('os.path.getsize')
+    @patch('os.path.isfile')
+    @patch('os.path.isdir')
+    @patch('passkeeper.Passkeeper._rekey_file')
+    def test_rekey(self, mock_rekey_file, mock_isdir, mock_isfile,
+                   mock_getsize, mock_rename, mock_remove):
+        mock_isdir.return_value = False
+        mock_isfile.side_effect = lambda path: path == 'foo/manifest.passkeeper'
+        mock_getsize.side_effect = lambda path: len(path)
+        mock_rekey_file.return_value = Mock(ok=True)
+        scanner = self._scanner(encrypted=['bar.ini', 'foo.raw/bla'])
+
+        # Smallest file first, all files replaced and committed once
+        self.assertTrue(self.pk.rekey('old', 'new', scanner=scanner))
+        self.assertEquals(call('foo/manifest.passkeeper', 'old', 'new'),
+                          mock_rekey_file.call_args_list[0])
+        self.assertEquals(3, mock_rename.call_count)
+        mock_rename.assert_any_call(
+            'foo/encrypted/foo.raw/bla.passkeeper.rekey.tmp',
+            'foo/encrypted/foo.raw/bla.passkeeper')
+        calls = [call().add(['encrypted/bar.ini.passkeeper',
+                             'encrypted/foo.raw/bla.passkeeper',
+                             'manifest.passkeeper']),
+                 call().commit('Change passphrase of 3 files')]
+        self.mock_git.assert_has_calls(calls)
+
+        # Wrong passphrase, nothing is changed
+        self.mock_git.reset_mock()
+        mock_rename.reset_mock()
+        mock_rekey_file.reset_mock()
+        mock_rekey_file.return_value = Mock(ok=False)
+        self.assertFalse(self.pk.rekey('wrong', 'new', scanner=scanner))
+        self.assertEquals(1, mock_rekey_file.call_count)
+        self.assertEquals(0, mock_rename.call_count)
+        self.assertEquals(0, self.mock_git.return_value.commit.call_count)
+
+        # A file failed, new files are removed
+        mock_rekey_file.side_effect = [Mock(ok=True), Mock(ok=True),
+                                       Mock(ok=False)]
+        self.assertFalse(self.pk.rekey('old', 'new', scanner=scanner))
+        self.assertEquals(0, mock_rename.call_count)
+        self.assertEquals(2, mock_remove.call_count)
+        self.assertEquals(0, self.mock_git.return_value.commit.call_count)
+
+
+    @patch('passkeeper.Manifest')
+    @patch('os.path.getsize')
+    @patch('os.path.isfile')
+    @patch('os.path.isdir')
+    def test_verify(self, mock_isdir, mock_isfile, mock_getsize,
+                    mock_manifest):
+        self.pk.crypt = Mock()
+        self.pk.crypt.verify.return_value = Mock(ok=True, status='ok')
+        mock_isdir.return_value = False
+        mock_isfile.side_effect = lambda path: path == 'foo/manifest.passkeeper'
+        mock_getsize.return_value = 10
+        manifest = mock_manifest.return_value
+        manifest.load.return_value = True
+        manifest.entries = {'bar.ini': {}, 'foo.raw/bla': {}}
+        self.mock_git.return_value.ls_files.return_value = [
+            '.gitignore', 'encrypted/bar.ini.passkeeper',
+            'encrypted/foo.raw/bla.passkeeper', 'manifest.passkeeper']
+        scanner = self._scanner(encrypted=['bar.ini', 'foo.raw/bla'])
+
+        # All files decrypted, known and tracked
+        report = self.pk.verify('secret', scanner=scanner)
+        self.assertTrue(report.ok)
+        self.assertEquals(['encrypted/bar.ini.passkeeper',
+                           'encrypted/foo.raw/bla.passkeeper',
+                           'manifest.passkeeper'],
+                          [check.path for check in report.checks])
+        self.pk.crypt.verify.assert_any_call(
+            'foo/encrypted/bar.ini.passkeeper', 'secret')
+        self.assertEquals(30, sum(check.bytes for check in report.checks))
+        self.assertEquals(3, len(report.lines()))
+        self.assertTrue(str(report).startswith('3 file(s), 30 bytes'))
+
+        # Wrong passphrase or corrupted file
+        self.pk.crypt.verify.return_value = Mock(ok=False,
+                                                 status='decryption failed')
+        report = self.pk.verify('wrong', scanner=scanner)
+        self.assertFalse(report.ok)
+        self.assertEquals(3, len(report.failed))
+        self.assertEquals('decryption failed', report.checks[0].status)
+
+        # Orphan, untracked, missing files and chunks
+        self.pk.crypt.verify.return_value = Mock(ok=True, status='ok')
+        manifest.entries = {'bar.ini': {}, 'old.raw/big': {'chunks': ['c1']}}
+        self.mock_git.return_value.ls_files.return_value = [
+            'encrypted/bar.ini.passkeeper', 'encrypted/old.ini.passkeeper',
+            'manifest.passkeeper']
+        report = self.pk.verify('secret', scanner=scanner)
+        self.assertFalse(report.ok)
+        self.assertEquals(['encrypted/foo.raw/bla.passkeeper'], report.orphans)
+        self.assertEquals(['encrypted/foo.raw/bla.passkeeper'],
+                          report.untracked)
+        self.assertEquals(['encrypted/old.ini.passkeeper'], report.missing)
+        self.assertEquals(['chunks/c1.passkeeper'], report.missing_chunks)
+
+
+    @patch('passkeeper.Bundle')
+    @patch('passkeeper.Passkeeper._decrypt_ini_files')
+    @patch('passkeeper.Passkeeper.bundled')
+    def test_migrate(self, mock_bundled, mock_decrypt_ini_files,
+                     mock_bundle):
+        self.pk.shredder = Mock()
+        self.pk.shredder.shred.return_value = Mock(errors=[])
+        scanner = self._scanner(encrypted=['bar.ini', 'foo.ini'])
+        ini_files = [('bar.ini', b'[bar]'), ('foo.ini', b'[foo]')]
+        mock_decrypt_ini_files.return_value = ini_files
+
+        # Already in this layout
+        mock_bundled.return_value = False
+        self.assertTrue(self.pk.migrate('secret', 'files', scanner=scanner))
+        self.assertEquals(0, mock_decrypt_ini_files.call_count)
+        self.assertRaises(ValueError, self.pk.migrate, 'secret', 'tar')
+
+        # Encrypted ini files in the bundle
+        self.assertTrue(self.pk.migrate('secret', 'bundle', scanner=scanner))
+        mock_bundle.assert_called_once_with('foo/bundle.passkeeper',
+                                            self.pk.crypt)
+        self.assertEquals(ini_files, mock_bundle.return_value.files)
+        mock_bundle.return_value.save.assert_called_once_with(
+            passphrase='secret')
+        self.pk.shredder.shred.assert_called_once_with(
+            ['foo/encrypted/bar.ini.passkeeper',
+             'foo/encrypted/foo.ini.passkeeper'], remove=False)
+        calls = [call().add(['bundle.passkeeper']),
+                 call().force_remove(['encrypted/bar.ini.passkeeper',
+                                      'encrypted/foo.ini.passkeeper']),
+                 call().commit('Migrate ini files to bundle layout')]
+        self.mock_git.assert_has_calls(calls)
+
+        # Bundle back in encrypted files
+        mock_bundled.return_value = True
+        self.pk.shredder.reset_mock()
+        self.pk.crypt = Mock()
+        self.pk.crypt.encrypt_data.return_value = Mock(ok=True, data=b'data')
+        with patch('passkeeper.create_dir'):
+            with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+                self.assertTrue(self.pk.migrate('secret', 'files',
+                                                scanner=self._scanner()))
+        file_mock.assert_any_call('foo/encrypted/bar.ini.passkeeper', 'wb')
+        self.pk.shredder.shred.assert_called_once_with(
+            ['foo/bundle.passkeeper'], remove=False)
+        calls = [call().add(['encrypted/bar.ini.passkeeper',
+                             'encrypted/foo.ini.passkeeper']),
+                 call().force_remove(['bundle.passkeeper']),
+                 call().commit('Migrate ini files to files layout')]
+        self.mock_git.assert_has_calls(calls)
+
+        # Encrypted files can't be decrypted
+        mock_decrypt_ini_files.return_value = None
+        self.assertFalse(self.pk.migrate('wrong', 'files'))
+
+
+    def test_search(self):
+        # Two valid files
+        # In these files we have 4 sections :
         # - one matching in section name
         # - one matching not matching at all
-        # - one matching with value content
-        mock_config = MagicMock()
-        mock_config.sections.return_value = ['unmatched', 'WanTed', 'value']
-        vals = {('unmatched',): [('foo', 'bar')],
-                ('WanTed',): [('foo', 'bar')],
-                ('value',): [('found', '.wanted.')]}
-        def side_effect(*args):
-            return vals[args]
-        mock_config.items = MagicMock(side_effect=side_effect)
-        mock_rawconfig.return_value = mock_config
-        mock_listdir.return_value = ['ignored', 'bar.ini']
-        mock_isfile.return_value = True
-        config, matching_sections = self.pk.search(pattern='WANTED')
-
-        mock_config.read.assert_called_once_with('foo/bar.ini')
-        self.assertEquals(['WanTed', 'value'], matching_sections)
-
-        # Test with bad filepath.
-        mock_config = Mock()
-        mock_config.sections.return_value = []
-        mock_rawconfig.return_value = mock_config
-        mock_listdir.return_value = ['bar.ini']
-        mock_isfile.return_value = False
-        config, matching_sections = self.pk.search(pattern='WANTED')
+        # - one matching with value content, in both files
+        contents = {'foo/bar.ini': b'[unmatched]\nfoo = bar\n'
+                                   b'[WanTed]\nfoo = bar\n'
+                                   b'[value]\nfound = .wanted.\n',
+                    'foo/bli.ini': b'[value]\nfound = wanted\n'}
+        scanner = self._scanner(ini=['bar.ini', 'bli.ini'])
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            file_mock.return_value.read.side_effect = lambda: contents[
+                file_mock.call_args[0][0]]
+            hits = self.pk.search(pattern='WANTED', scanner=scanner)
+
+            # Sections with the same name are kept with their file
+            self.assertEquals([('bar.ini', 'WanTed', [('foo', 'bar')]),
+                               ('bar.ini', 'value', [('found', '.wanted.')]),
+                               ('bli.ini', 'value', [('found', 'wanted')])],
+                              hits)
+            self.assertEquals('bli.ini', hits[2].file)
+            self.assertEquals(2, file_mock.call_count)
+
+            # Unchanged files are not read again
+            hits = self.pk.search(pattern='^\\.wanted', scanner=scanner)
+            self.assertEquals([('bar.ini', 'value', [('found', '.wanted.')])],
+                              hits)
+            self.assertEquals(2, file_mock.call_count)
+
+            # Changed file is read again
+            scanner.ini_files['bli.ini'] = FileInfo(
+                'foo/bli.ini', Mock(st_size=2, st_mtime=1))
+            self.pk.search(pattern='WANTED', scanner=scanner)
+            self.assertEquals(3, file_mock.call_count)
+
+        # No file.
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            hits = self.pk.search(pattern='WANTED', scanner=self._scanner())
+
+        self.assertEquals(file_mock.call_count, 0)
+        self.assertEquals([], hits)
+
 
-        self.assertEquals(mock_config.read.call_count, 0)
-        self.assertEquals([], matching_sections)
+    @patch('passkeeper.os.path.isfile')
+    def test_search_encrypted(self, mock_isfile):
+        # Search in encrypted ini files decrypted in memory.
+        # Raw files are ignored
+        # No search index
+        mock_isfile.return_value = False
+        scanner = self._scanner(encrypted=['foo.raw/bla', 'bar.ini', 'bli.ini'])
+        contents = {'bar': b'[unmatched]\nfoo = bar\n',
+                    'bli': b'[WanTed]\nfoo = bar\n'}
+        self.pk.crypt = Mock()
+        self.pk.crypt.decrypt_data.side_effect = lambda data, passphrase: \
+            Mock(ok=True, data=contents[data])
+
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            file_mock.return_value.read.side_effect = ['bar', 'bli']
+            hits = self.pk.search(pattern='wanted', passphrase='secret',
+                                  scanner=scanner)
+
+        file_mock.assert_any_call('foo/encrypted/bar.ini.passkeeper', 'rb')
+        file_mock.assert_any_call('foo/encrypted/bli.ini.passkeeper', 'rb')
+        self.assertEquals(2, self.pk.crypt.decrypt_data.call_count)
+        self.assertEquals([('bli.ini', 'WanTed', [('foo', 'bar')])], hits)
+        # Decrypted files are not kept
+        self.assertEquals({}, self.pk.search_engine.files)
+
+        # Wrong passphrase, nothing found
+        self.pk.crypt.decrypt_data.side_effect = None
+        self.pk.crypt.decrypt_data.return_value = Mock(ok=False)
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True):
+            hits = self.pk.search(pattern='wanted', passphrase='wrong',
+                                  scanner=scanner)
+        self.assertEquals([], hits)
+
+
+    @patch('os.path.isfile')
+    def test_iter_search(self, mock_isfile):
+        # Files are decrypted and searched one at a time, nothing is kept
+        mock_isfile.return_value = False
+        scanner = self._scanner(encrypted=['bar.ini', 'bli.ini', 'blo.ini'])
+        contents = {'bar': b'[WanTed]\nfoo = bar\n',
+                    'bli': b'[unmatched]\nfoo = bar\n',
+                    'blo': b'[wanted]\nfoo = bar\n'}
+        self.pk.crypt = Mock()
+        self.pk.crypt.decrypt_data.side_effect = lambda data, passphrase: \
+            Mock(ok=data != 'blo', data=contents[data])
+
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            file_mock.return_value.read.side_effect = ['bar', 'bli', 'blo']
+            hits = self.pk.iter_search(pattern='wanted', passphrase='secret',
+                                       scanner=scanner)
+            self.assertEquals(('bar.ini', 'WanTed', [('foo', 'bar')]),
+                              next(hits))
+            self.assertEquals(1, self.pk.crypt.decrypt_data.call_count)
+            # Stop at the first file not decrypted
+            self.assertRaises(DecryptionError, list, hits)
+        self.assertEquals({}, self.pk.search_engine.files)
+
+        # Decrypted ini files
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True) as file_mock:
+            file_mock.return_value.read.side_effect = [b'[Wanted]\n']
+            hits = self.pk.iter_get('wanted', scanner=self._scanner(
+                                    ini=['bar.ini']))
+            self.assertEquals([('bar.ini', 'Wanted', [])], list(hits))
+
+
+    @patch('passkeeper.VaultScanner')
+    def test_load_encrypted(self, mock_scanner):
+        # Only files changed since last load are decrypted
+        scan = mock_scanner.return_value.scan
+        scan.return_value = self._scanner(encrypted=['bar.ini', 'bli.ini'])
+        self.pk.crypt = Mock()
+        self.pk.crypt.decrypt_data.return_value = Mock(ok=True,
+                                                       data=b'[foo]\na = b\n')
+        engine = SearchEngine()
+        with patch(test_base.BUILTIN_OPEN, mock_open(), create=True):
+            self.assertTrue(self.pk.load_encrypted(engine, 'secret'))
+            # Raw files are not scanned
+            scan.assert_called_once_with(raw=False)
+            self.assertEquals(['bar.ini', 'bli.ini'], sorted(engine.files))
+            self.assertEquals(2, self.pk.crypt.decrypt_data.call_count)
+
+            scan.return_value = self._scanner(encrypted=['bli.ini'], size=2)
+            self.assertTrue(self.pk.load_encrypted(engine, 'secret'))
+            self.assertEquals(['bli.ini'], list(engine.files))
+            self.assertEquals(3, self.pk.crypt.decrypt_data.call_count)
+
+            # Unchanged
+            self.assertTrue(self.pk.load_encrypted(engine, 'secret'))
+            self.assertEquals(3, self.pk.crypt.decrypt_data.call_count)
+
+            # Wrong passphrase
+            scan.return_value = self._scanner(encrypted=['bli.ini'], size=3)
+            self.pk.crypt.decrypt_data.return_value = Mock(ok=False)
+            self.assertFalse(self.pk.load_encrypted(engine, 'wrong'))
+
+        self.assertEquals(['foo'], [hit.section for hit in engine.get('FOO')])
 
 
     @patch('passkeeper.shred_dir')
@@ -231,9 +829,17 @@ class PasskeeperTestCase(test_base.TestCase):
 
         self.pk.flush_history()
 
-        mock_shred.assert_called_once_with('foo/.git')
+        mock_shred.assert_called_once_with('foo/.git',
+                                           shredder=self.pk.shredder)
         calls = [ call().init(),
                   call().add(['encrypted', '.gitignore']),
                   call().commit('Clean git History')]
 
         self.mock_git.assert_has_calls(calls)
+
+        # Pack git objects first
+        self.mock_git.reset_mock()
+        self.pk.flush_history(pack=True)
+        calls = [ call().gc(),
+                  call().init()]
+        self.mock_git.assert_has_calls(calls)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+from . import base as test_base
+from passkeeper.scanner import VaultScanner, scan_dir, write_selection, _Entry
+from mock import patch
+
+class VaultScannerTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(VaultScannerTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ['bar.ini', 'notes.txt', 'foo.raw/bli', 'foo.raw/sub/bla',
+                     'encrypted/bar.ini.passkeeper',
+                     'encrypted/old.ini.passkeeper',
+                     'encrypted/foo.raw/bli.passkeeper',
+                     'encrypted/foo.raw/old.passkeeper',
+                     'encrypted/foo.raw/ignored']:
+            path = os.path.join(self.tmp_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('content')
+        os.mkdir(os.path.join(self.tmp_dir, 'dir.ini'))
+
+    def tearDown(self):
+        super(VaultScannerTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _check_scan(self):
+        scanner = VaultScanner(self.tmp_dir).scan()
+        self.assertEquals(['bar.ini'], list(scanner.ini_files))
+        self.assertEquals(['foo.raw/bli', 'foo.raw/sub/bla'],
+                          sorted(scanner.raw_files))
+        self.assertEquals(['foo.raw'], scanner.raw_dirs)
+        self.assertEquals(['bar.ini', 'foo.raw/bli', 'foo.raw/old', 'old.ini'],
+                          sorted(scanner.encrypted_files))
+        info = scanner.raw_files['foo.raw/sub/bla']
+        self.assertEquals(os.path.join(self.tmp_dir, 'foo.raw/sub/bla'),
+                          info.path)
+        self.assertEquals(7, info.stat.st_size)
+        return scanner
+
+    def test_scan(self):
+        scanner = self._check_scan()
+        self.assertEquals(['foo.raw/old', 'old.ini'],
+                          scanner.old_encrypted_files())
+        self.assertEquals(['bar.ini', 'old.ini'], scanner.encrypted_ini_files())
+        self.assertEquals(os.path.join(self.tmp_dir,
+                                       'encrypted/foo.raw/bli.passkeeper'),
+                          scanner.encrypted_path('foo.raw/bli'))
+        self.assertEquals(['bar.ini', 'foo.raw/bli', 'foo.raw/sub/bla'],
+                          sorted(scanner.plain_files()))
+
+    def test_scan_selection(self):
+        # Only decrypted files are old, others are not decrypted
+        write_selection(os.path.join(self.tmp_dir, '.decrypted'),
+                        ['foo.raw/old', 'bar.ini'])
+        scanner = self._check_scan()
+        self.assertEquals(set(['bar.ini', 'foo.raw/old']), scanner.selection)
+        self.assertEquals(['foo.raw/old'], scanner.old_encrypted_files())
+        self.assertEquals(['old.ini'], scanner.not_decrypted(
+            ['bar.ini', 'foo.raw/old', 'old.ini']))
+
+        os.remove(scanner.selection_path)
+        self.assertEquals(None, scanner.scan().selection)
+        self.assertEquals([], scanner.not_decrypted(['old.ini']))
+
+    def test_scan_listdir(self):
+        # Same inventory without scandir
+        with patch('passkeeper.scanner.scandir', None):
+            self._check_scan()
+            self.assertTrue(all(isinstance(entry, _Entry)
+                                for entry in scan_dir(self.tmp_dir)))
+
+    def test_scan_without_raw(self):
+        # Raw directories are listed but not walked
+        scanner = VaultScanner(self.tmp_dir).scan(raw=False)
+        self.assertEquals(['bar.ini'], list(scanner.ini_files))
+        self.assertEquals({}, scanner.raw_files)
+        self.assertEquals(['foo.raw'], scanner.raw_dirs)
+        self.assertEquals(['bar.ini', 'old.ini'], sorted(scanner.encrypted_files))
+
+    def test_scan_symlinks(self):
+        # Linked directories are not followed in raw directories
+        os.symlink(self.tmp_dir, os.path.join(self.tmp_dir, 'foo.raw/loop'))
+        scanner = VaultScanner(self.tmp_dir).scan()
+        self.assertEquals(['foo.raw/bli', 'foo.raw/sub/bla'],
+                          sorted(scanner.raw_files))
+
+    def test_scan_missing_directory(self):
+        scanner = VaultScanner(os.path.join(self.tmp_dir, 'missing')).scan()
+        self.assertEquals({}, scanner.ini_files)
+        self.assertEquals([], scanner.old_encrypted_files())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from . import base as test_base
+from passkeeper.search import SearchEngine, Hit, is_literal, parse_ini
+from passkeeper.search import search_files, get_files
+
+class SearchEngineTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(SearchEngineTestCase, self).setUp()
+        self.engine = SearchEngine()
+        self.engine.add_file('bar.ini', b'[Foo]\nurl = http://Foo.com\n',
+                             signature=(1, 1))
+        self.engine.add_file('bli.ini', b'[foo]\nlogin = john\n'
+                                        b'[blo]\nurl = foo.org\n',
+                             signature=(2, 1))
+
+    def tearDown(self):
+        super(SearchEngineTestCase, self).tearDown()
+        del self.engine
+
+    def test_is_literal(self):
+        self.assertTrue(is_literal('foo bar'))
+        self.assertFalse(is_literal('foo.com'))
+        self.assertFalse(is_literal('^foo'))
+
+    def test_parse_ini(self):
+        self.assertEquals([('Foo', 'foo', [('url', 'A', 'a')])],
+                          parse_ini(b'[Foo]\nurl = A\n', 'bar.ini'))
+
+    def test_loaded(self):
+        self.assertTrue(self.engine.loaded('bar.ini', (1, 1)))
+        self.assertFalse(self.engine.loaded('bar.ini', (1, 2)))
+        self.assertFalse(self.engine.loaded('unknown.ini', (1, 1)))
+        self.engine.keep_files(['bli.ini'])
+        self.assertEquals(['bli.ini'], list(self.engine.files))
+
+    def test_search(self):
+        # Substring, same section name in both files
+        self.assertEquals([Hit('bar.ini', 'Foo', [('url', 'http://Foo.com')]),
+                           Hit('bli.ini', 'foo', [('login', 'john')]),
+                           Hit('bli.ini', 'blo', [('url', 'foo.org')])],
+                          self.engine.search('FOO'))
+        # Value match
+        self.assertEquals([Hit('bli.ini', 'blo', [('url', 'foo.org')])],
+                          self.engine.search('o.or'))
+        # Regex
+        self.assertEquals(['Foo', 'foo'],
+                          [hit.section for hit in
+                           self.engine.search('^(http.*|john)$')])
+        # Restricted to some files
+        self.assertEquals(['foo', 'blo'],
+                          [hit.section for hit in
+                           self.engine.search('o', ['bli.ini'])])
+        self.assertEquals([], self.engine.search('unknown'))
+
+    def test_get(self):
+        self.assertEquals([Hit('bar.ini', 'Foo', [('url', 'http://Foo.com')]),
+                           Hit('bli.ini', 'foo', [('login', 'john')])],
+                          self.engine.get('FOO'))
+        self.assertEquals([], self.engine.get('fo'))
+
+    def test_search_files(self):
+        # Files are parsed when the previous one is searched
+        parsed = []
+        def files():
+            for name, content in [('bar.ini', b'[Foo]\nurl = http://Foo.com\n'),
+                                  ('bli.ini', b'[foo]\nlogin = john\n')]:
+                parsed.append(name)
+                yield name, content
+        hits = search_files(files(), 'FOO')
+        self.assertEquals(Hit('bar.ini', 'Foo', [('url', 'http://Foo.com')]),
+                          next(hits))
+        self.assertEquals(['bar.ini'], parsed)
+        self.assertEquals([Hit('bli.ini', 'foo', [('login', 'john')])],
+                          list(hits))
+        self.assertEquals(['foo'], [hit.section for hit in
+                                    search_files(files(), '^john$')])
+        self.assertEquals(['Foo', 'foo'], [hit.section for hit in
+                                           get_files(files(), 'fOO')])
+        self.assertEquals([], list(get_files(files(), 'fo')))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+from . import base as test_base
+from passkeeper.shred import Shredder, ShredError
+from mock import patch, call
+
+class ShredderTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(ShredderTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(ShredderTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content=b'secret'):
+        path = os.path.join(self.tmp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_method(self):
+        self.assertRaises(ShredError, Shredder, method='unknown')
+        self.assertEquals('python', Shredder(method='python').method)
+        with patch('passkeeper.shred.which') as mock_which:
+            mock_which.return_value = None
+            self.assertEquals('python', Shredder().method)
+            mock_which.return_value = '/usr/bin/shred'
+            self.assertEquals('shred', Shredder().method)
+
+    def test_batches(self):
+        shredder = Shredder(method='shred', batch_size=2)
+        self.assertEquals([['a', 'b'], ['c']],
+                          list(shredder._batches(['a', 'b', 'c'])))
+        # At least one batch per worker
+        shredder.jobs = 3
+        self.assertEquals([['a'], ['b'], ['c']],
+                          list(shredder._batches(['a', 'b', 'c'])))
+        # Limited by command length
+        shredder = Shredder(method='shred')
+        shredder.max_args_length = 4
+        self.assertEquals([['a', 'b'], ['c']],
+                          list(shredder._batches(['a', 'b', 'c'])))
+
+    @patch('passkeeper.shred.subprocess.call')
+    def test_shred_cmd(self, mock_call):
+        mock_call.return_value = 0
+        paths = [self._write('a'), self._write('b', b'1234')]
+        shredder = Shredder(method='shred', passes=1)
+        report = shredder.shred(paths, force=True)
+        mock_call.assert_called_once_with(
+            ['shred', '-n', '1', '-f', '--remove', '--'] + paths)
+        self.assertEquals(2, report.files)
+        self.assertEquals(10, report.bytes)
+        self.assertEquals([], report.errors)
+
+        # Failed command, remaining files are errors
+        mock_call.reset_mock()
+        mock_call.return_value = 1
+        shredder.batch_size = 1
+        report = shredder.shred(paths, remove=False)
+        self.assertEquals([call(['shred', '-n', '1', '--', paths[0]]),
+                           call(['shred', '-n', '1', '--', paths[1]])],
+                          mock_call.call_args_list)
+        self.assertEquals(paths, report.errors)
+
+    def test_shred_python(self):
+        paths = [self._write('a'), self._write('b', b'1234' * 30000)]
+        shredder = Shredder(method='python', passes=2, jobs=2)
+        # Overwrite only
+        report = shredder.shred(paths, remove=False)
+        self.assertEquals(120006, report.bytes)
+        with open(paths[1], 'rb') as f:
+            content = f.read()
+        self.assertEquals(120000, len(content))
+        self.assertNotEquals(b'1234' * 30000, content)
+
+        # Read only file with force
+        os.chmod(paths[0], 0o400)
+        report = shredder.shred(paths, force=True)
+        self.assertEquals([], report.errors)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+
+        # Missing file
+        report = shredder.shred(paths[:1])
+        self.assertEquals(paths[:1], report.errors)
+
+    def test_shred_tree(self):
+        self._write('foo.raw/a')
+        self._write('foo.raw/sub/b')
+        ini = self._write('foo.ini')
+        os.symlink(ini, os.path.join(self.tmp_dir, 'foo.raw', 'link'))
+        shredder = Shredder(method='python', passes=1)
+        report = shredder.shred_tree([os.path.join(self.tmp_dir, 'foo.raw')],
+                                     [ini])
+        self.assertEquals(3, report.files)
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+        # Errors, directories are kept
+        self._write('foo.raw/a')
+        with patch.object(shredder, '_shred_python') as mock_shred:
+            mock_shred.side_effect = lambda batch, remove, force: batch
+            self.assertRaises(ShredError, shredder.shred_tree,
+                              [os.path.join(self.tmp_dir, 'foo.raw')])
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp_dir, 'foo.raw')))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import shutil
+import tempfile
+from . import base as test_base
+from passkeeper.stats import Stats, STATS
+from passkeeper.crypt import OpenPGPBackend
+from mock import patch
+
+class StatsTestCase(test_base.TestCase):
+
+    def setUp(self):
+        super(StatsTestCase, self).setUp()
+        self.stats = Stats()
+
+    @patch('passkeeper.stats.time.time')
+    def test_phase(self, mock_time):
+        mock_time.side_effect = [10, 11, 13, 20, 21, 21]
+        self.stats.reset()
+        with self.stats.phase('encrypt', files=1, bytes=42, processes=1):
+            pass
+        with self.stats.phase('encrypt', files=2, bytes=8, processes=1):
+            pass
+        self.stats.count('git', files=3)
+
+        self.assertEquals({'calls': 2, 'seconds': 3, 'files': 3, 'bytes': 50,
+                           'processes': 2}, self.stats.phases['encrypt'])
+        self.assertEquals({'calls': 0, 'seconds': 0, 'files': 3, 'bytes': 0,
+                           'processes': 0}, self.stats.phases['git'])
+        report = self.stats.report()
+        self.assertEquals(11, report['seconds'])
+        self.assertEquals(2, report['processes'])
+        self.assertEquals(['encrypt', 'git'], list(report['phases']))
+
+    def test_phase_exception(self):
+        # Failed calls are recorded too
+        def _fail():
+            with self.stats.phase('fail'):
+                raise ValueError()
+        self.assertRaises(ValueError, _fail)
+        self.assertEquals(1, self.stats.phases['fail']['calls'])
+
+    def test_timed(self):
+        @self.stats.timed('double')
+        def double(value):
+            "Double value"
+            return value * 2
+
+        self.assertEquals(4, double(2))
+        self.assertEquals(6, double(3))
+        self.assertEquals('double', double.__name__)
+        self.assertEquals(2, self.stats.phases['double']['calls'])
+
+    def test_table(self):
+        self.stats.count('crypt.encrypt', calls=2, seconds=1.5, files=2,
+                         bytes=1024, processes=2)
+        lines = self.stats.table().split('\n')
+
+        self.assertEquals(3, len(lines))
+        self.assertEquals(['Phase', 'Calls', 'Seconds', 'Files', 'Bytes',
+                           'Processes'], lines[0].split())
+        self.assertEquals(['crypt.encrypt', '2', '1.500', '2', '1024', '2'],
+                          lines[1].split())
+        self.assertEquals('total', lines[2].split()[0])
+        self.assertEquals('2', lines[2].split()[-1])
+
+    def test_write_json(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'stats.json')
+            self.stats.count('scan', calls=1, files=3)
+            self.stats.write_json(path)
+            with open(path) as f:
+                report = json.load(f)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEquals(3, report['phases']['scan']['files'])
+        self.assertEquals(0, report['processes'])
+
+    def test_crypt_stats(self):
+        # Backend operations are recorded with their size
+        STATS.reset()
+        backend = OpenPGPBackend()
+        encrypted = backend.encrypt_data(b'secret', 'pass')
+        backend.decrypt_data(encrypted.data, 'pass')
+
+        phases = STATS.report()['phases']
+        self.assertEquals(1, phases['crypt.encrypt_data']['files'])
+        self.assertEquals(6, phases['crypt.encrypt_data']['bytes'])
+        self.assertEquals(len(encrypted.data),
+                          phases['crypt.decrypt_data']['bytes'])
+        self.assertEquals(0, phases['crypt.decrypt_data']['processes'])
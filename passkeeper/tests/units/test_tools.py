@@ -16,9 +16,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import base as test_base
+from . import base as test_base
 from passkeeper.tools import *
-from mock import patch, call, mock_open
+from mock import patch, Mock
 
 class ToolsTestCase(test_base.TestCase):
 
@@ -67,17 +67,52 @@ class ToolsTestCase(test_base.TestCase):
         mock_call.assert_called_once_with('foo', shell=True)
 
 
-    @patch('passkeeper.tools.run_cmd')
-    @patch('passkeeper.os.rmdir')
-    @patch('passkeeper.os.walk')
-    def test_shred_dir(self, mock_walk, mock_rmdir, mock_cmd):
-
-        mock_walk.return_value = [ ('foo/.git', ['subdir1'], ['bli']), ('foo/.git/subdir1', [], ['bar'])]
-
-        shred_dir('foo/.git')
-
-        calls = [call('shred -f --remove foo/.git/bli'), call('shred -f --remove foo/.git/subdir1/bar')]
-        mock_cmd.assert_has_calls(calls)
-
-        calls = [call('foo/.git/subdir1'), call('foo/.git')]
-        mock_rmdir.assert_has_calls(calls)
+    def test_run_pool(self):
+        # Results keep items order, sequential or with workers
+        self.assertEquals([2, 4, 6], run_pool(lambda x: x * 2, [1, 2, 3]))
+        self.assertEquals([2, 4, 6], run_pool(lambda x: x * 2, [1, 2, 3],
+                                              jobs=2))
+
+        # Pending items are cancelled once stop return True
+        calls = []
+        def func(item):
+            calls.append(item)
+            return item
+        results = run_pool(func, [1, 2, 3], stop=lambda result: result == 2)
+        self.assertEquals([1, 2, None], results)
+        self.assertEquals([1, 2], calls)
+
+
+    def test_iter_pool(self):
+        # Results keep items order, sequential or with workers
+        self.assertEquals([2, 4, 6], list(iter_pool(lambda x: x * 2, [1, 2, 3])))
+        self.assertEquals(list(range(0, 40, 2)),
+                          list(iter_pool(lambda x: x * 2, range(20), jobs=3)))
+
+        # Items are processed as results are consumed
+        calls = []
+        def func(item):
+            calls.append(item)
+            return item
+        results = iter_pool(func, range(20), jobs=2)
+        self.assertEquals(0, next(results))
+        self.assertTrue(len(calls) <= 5)
+        results.close()
+
+
+    def test_match_paths(self):
+        self.assertTrue(match_paths('foo.ini', ['*.ini']))
+        self.assertTrue(match_paths('foo.ini', ['bar.ini', 'f?o.ini']))
+        self.assertFalse(match_paths('foo.ini', ['bar*']))
+        self.assertFalse(match_paths('foo.ini', []))
+        # Files of a matching directory
+        self.assertTrue(match_paths('foo.raw/dir/bar', ['foo.raw']))
+        self.assertTrue(match_paths('foo.raw/dir/bar', ['foo.raw/dir/']))
+        self.assertTrue(match_paths('foo.raw/dir/bar', ['*/dir/b*']))
+        self.assertFalse(match_paths('foo.raw/bar', ['*.ini', 'bar']))
+
+
+    def test_shred_dir(self):
+        shredder = Mock()
+        shred_dir('foo/.git', shredder=shredder)
+        shredder.shred_tree.assert_called_once_with(['foo/.git'])
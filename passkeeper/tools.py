@@ -18,8 +18,16 @@
 
 import os
 import logging
+import fnmatch
+import threading
 import subprocess
-from os.path import join as os_join
+from itertools import islice
+from collections import deque
+from passkeeper.stats import STATS
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 LOG = logging.getLogger(__name__)
 
@@ -74,13 +82,138 @@ def run_cmd(cmd, dry_run=False):
         LOG.warning('Exec command %s' % cmd)
     else:
         LOG.debug('Exec command %s' % cmd)
-        output = subprocess.call(cmd, shell=True)
+        with STATS.phase('cmd', processes=1):
+            output = subprocess.call(cmd, shell=True)
         if output != 0:
             LOG.critical('Command ERROR %s return code : %d' % (cmd, output))
             raise Exception('Unable to execute command')
 
 
-def shred_dir(directory):
+def run_pool(func, items, jobs=1, stop=None):
+    """
+    Apply func on each item with a pool of worker threads.
+
+    Items are processed concurrently by jobs threads (sequentially if jobs
+    is 1). Results are returned in the order of items.
+
+    :param func: Function called with one item
+    :type func: callable
+    :param items: Items to process
+    :type items: list
+    :param jobs: Number of workers
+    :type jobs: int
+    :param stop: Called with each result. If it returns True, all pending
+                 items are cancelled and their result is None
+    :type stop: callable
+
+    :Example:
+
+    >>> run_pool(lambda x: x * 2, [1, 2, 3], jobs=2)
+    [2, 4, 6]
+    """
+    cancelled = threading.Event()
+
+    def _worker(item):
+        if cancelled.is_set():
+            return None
+        result = func(item)
+        if stop is not None and stop(result):
+            cancelled.set()
+        return result
+
+    items = list(items)
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        return [_worker(item) for item in items]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        # chunksize 1 so a cancel affects every item not started yet
+        return pool.map(_worker, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_pool(func, items, jobs=1):
+    """
+    Apply func on each item with a pool of worker threads like run_pool,
+    yield results in the order of items as soon as they are ready.
+
+    At most 2 * jobs items are processed ahead of the consumer, so
+    memory does not grow with the number of items. Workers stop when the
+    generator is closed.
+
+    :Example:
+
+    >>> for result in iter_pool(lambda x: x * 2, [1, 2, 3], jobs=2):
+    ...     print(result)
+    2
+    4
+    6
+    """
+    items = list(items)
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    remaining = iter(items)
+    pending = deque(pool.apply_async(func, (item,))
+                    for item in islice(remaining, 2 * jobs))
+    try:
+        while pending:
+            result = pending.popleft().get()
+            for item in islice(remaining, 1):
+                pending.append(pool.apply_async(func, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def match_paths(name, patterns):
+    """
+    Return True if name, or one of its parent directories, matches one of
+    the glob patterns
+
+    :param name: Path relative to the passkeeper directory
+    :type name: str
+    :param patterns: Glob patterns, like *.ini or default.raw
+    :type patterns: list
+
+    :Example:
+
+    >>> match_paths('default.raw/ssh_id.rsa', ['default.raw'])
+    True
+    >>> match_paths('default.ini', ['foo*.ini'])
+    False
+    """
+    parts = name.split('/')
+    paths = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+    return any(fnmatch.fnmatchcase(path, pattern.rstrip('/'))
+               for pattern in patterns for path in paths)
+
+
+def read_config_string(config, content, name):
+    """
+    Read ini content (bytes) in a ConfigParser
+
+    :param config: ConfigParser
+    :param content: Ini file content
+    :type content: bytes
+    :param name: Name of the content in errors
+    :type name: str
+    """
+    if hasattr(config, 'read_string'):
+        config.read_string(content.decode('utf-8'), source=name)
+    else:
+        config.readfp(StringIO(content), name)
+
+
+def shred_dir(directory, shredder=None):
     """
     Shred all files in directory and remove this directory.
 
@@ -88,6 +221,8 @@ def shred_dir(directory):
 
     :param directory: Path of directory to shred
     :type directory: str
+    :param shredder: Shredder used, a default one if None
+    :type shredder: passkeeper.shred.Shredder
 
     :Example:
 
@@ -96,16 +231,9 @@ def shred_dir(directory):
     Clean file HEAD
     Clean file exclude
 
-    .. seealso:: run_cmd()
+    .. seealso:: passkeeper.shred.Shredder.shred_tree()
     """
-    # Remove directory content
-    for root, dirs, files in os.walk(directory, topdown=False):
-        for fname in files:
-            filepath = os_join(root, fname)
-            LOG.info('Clean file %s' % fname)
-            run_cmd('shred -f --remove %s' % filepath)
-        for dname in dirs:
-            dpath = os_join(root, dname)
-            os.rmdir('%s' % dpath)
-    # Remove the directory
-    os.rmdir(directory)
+    from passkeeper.shred import Shredder
+    if shredder is None:
+        shredder = Shredder()
+    return shredder.shred_tree([directory])
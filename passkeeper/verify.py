@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: Gaël Lambert (gaelL) <gael.lambert@netwiki.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import namedtuple
+
+# Verification of one encrypted file, path is relative to the directory
+FileCheck = namedtuple('FileCheck', ['path', 'ok', 'status', 'seconds',
+                                     'bytes'])
+
+
+class VerifyReport(object):
+    """
+    Result of the verification of a passkeeper directory, see
+    Passkeeper.verify
+
+    :Example:
+
+    >>> report = pk.verify(passphrase='foo', jobs=4)
+    >>> print(report)
+    12 file(s), 4096 bytes in 0.153s : 12 ok, 0 failed, 0 orphan(s), 0 untracked, 0 missing
+    """
+
+    def __init__(self):
+        # FileCheck of each encrypted file
+        self.checks = []
+        # Encrypted files without plaintext source
+        self.orphans = []
+        # Encrypted files not in git, or in git but not on disk
+        self.untracked = []
+        self.missing = []
+        # Chunks used by the manifest and not found
+        self.missing_chunks = []
+        self.seconds = 0.0
+
+    @property
+    def failed(self):
+        return [check for check in self.checks if not check.ok]
+
+    @property
+    def ok(self):
+        "True if all files are decrypted and nothing is missing"
+        return not (self.failed or self.orphans or self.untracked
+                    or self.missing or self.missing_chunks)
+
+    def lines(self):
+        "Return one line for each checked file and each problem found"
+        lines = ['%-6s %8.3fs %10d  %s%s' % (
+                 'ok' if check.ok else 'FAILED', check.seconds, check.bytes,
+                 check.path, '' if check.ok else ' (%s)' % check.status)
+                 for check in self.checks]
+        for label, paths in [('orphan', self.orphans),
+                             ('untracked', self.untracked),
+                             ('missing', self.missing),
+                             ('missing chunk', self.missing_chunks)]:
+            lines.extend('%s : %s' % (label, path) for path in paths)
+        return lines
+
+    def __str__(self):
+        return ('%d file(s), %d bytes in %.3fs : %d ok, %d failed, '
+                '%d orphan(s), %d untracked, %d missing' % (
+                    len(self.checks), sum(check.bytes for check in self.checks),
+                    self.seconds, len(self.checks) - len(self.failed),
+                    len(self.failed), len(self.orphans), len(self.untracked),
+                    len(self.missing) + len(self.missing_chunks)))
@@ -17,7 +17,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import sys
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    "Don't install the asyncio engine (python >= 3.5 syntax) on python 2"
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [module for module in modules
+                       if (module[0], module[1]) != ('passkeeper', 'aio')]
+        return modules
+
 
 setup(name='passkeeper',
       version='0.1',
@@ -27,5 +41,8 @@ setup(name='passkeeper',
       author_email='gael@netwiki.fr',
       url='https://github.com/shaftmx/passkeeper',
       packages=['passkeeper'],
-      scripts=['passkeeper-cli'],
+      scripts=['passkeeper-cli', 'passkeeper-benchmark'],
+      # Backend encrypting in process (--backend openpgp)
+      extras_require={'openpgp': ['cryptography']},
+      cmdclass={'build_py': BuildPy},
      )